@@ -0,0 +1,96 @@
+"""
+===========================
+Benchmark of HList activation-log parsing: get_activation_lists vs get_activation_arrays.
+===========================
+
+Writes synthetic HList-style logs for a 1000-node layer to a temporary directory, parses them with both functions,
+checks the results agree, and reports the throughput of each.
+
+For comparison it also times reading the same activations from HTK binary parameter files, which skips the text
+entirely.
+
+    python -m benchmarks.activation_log_parsing [n_words] [n_frames]
+
+The old_python scripts import each other flat, as they're run from that directory, so it's added to the path here.
+---------------------------
+"""
+from math import ceil
+from pathlib import Path
+from struct import pack
+from sys import argv, path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from numpy import array, array_equal
+from numpy.random import default_rng
+
+sys_path.append(str(Path(__file__).resolve().parent.parent / "old_python"))
+from extract_hidden_layer_activations import get_activation_lists, get_activation_arrays
+from htk_parameter_files import HEADER_FORMAT, load_htk_parameter_directory
+
+
+def synthetic_activations(n_frames: int, n_nodes: int):
+    return default_rng(0).uniform(-1, 1, (n_frames, n_nodes))
+
+
+def write_synthetic_log(path: Path, n_frames: int, n_nodes: int, nodes_per_line: int = 10):
+    """Writes a log in the layout HList -h produces: a header, then one block of lines per frame."""
+    values = synthetic_activations(n_frames, n_nodes)
+    with open(path, mode="w", encoding="utf-8") as log_file:
+        log_file.write(f"---------------------- Source: {path.stem}.mlp ----------------------\n")
+        log_file.write(f"  Sample Bytes:  {4 * n_nodes}      Sample Kind:   USER\n")
+        log_file.write(f"  Num Comps:     {n_nodes}      Sample Period: 10000.0 us\n")
+        log_file.write(f"  Num Samples:   {n_frames}      File Format:   HTK\n")
+        log_file.write("---------------------- Samples: 0->-1 ----------------------\n")
+        for frame in range(n_frames):
+            for line_i in range(ceil(n_nodes / nodes_per_line)):
+                line_values = values[frame, line_i * nodes_per_line:(line_i + 1) * nodes_per_line]
+                prefix = f"{frame}:" if line_i == 0 else ""
+                log_file.write(f"{prefix:<6}" + " ".join(f"{v:8.3f}" for v in line_values) + "\n")
+        log_file.write("---------------------- END ----------------------\n")
+
+
+def write_synthetic_parameter_file(path: Path, n_frames: int, n_nodes: int):
+    """Writes the same values as an HTK USER-kind parameter file."""
+    user_kind = 9
+    with open(path, mode="wb") as parameter_file:
+        parameter_file.write(pack(HEADER_FORMAT, n_frames, 100_000, 4 * n_nodes, user_kind))
+        parameter_file.write(synthetic_activations(n_frames, n_nodes).astype(">f4").tobytes())
+
+
+def run_benchmark(n_words: int = 20, n_frames: int = 60, n_nodes: int = 1000):
+    lines_per_block = ceil(n_nodes / 10)
+    with TemporaryDirectory() as tmp_dir:
+        word_list = [f"word{i:03d}" for i in range(n_words)]
+        for word in word_list:
+            write_synthetic_log(Path(tmp_dir, f"{word}.log"), n_frames, n_nodes)
+            write_synthetic_parameter_file(Path(tmp_dir, f"{word}.mlp"), n_frames, n_nodes)
+        input_path = str(Path(tmp_dir, "{0}.log"))
+        n_bytes = sum(p.stat().st_size for p in Path(tmp_dir).glob("*.log"))
+
+        start = perf_counter()
+        old = get_activation_lists(input_path, word_list, frame_cap=None, lines_per_block=lines_per_block)
+        old_duration = perf_counter() - start
+
+        start = perf_counter()
+        new = get_activation_arrays(input_path, word_list, frame_cap=None, lines_per_block=lines_per_block)
+        new_duration = perf_counter() - start
+
+        start = perf_counter()
+        load_htk_parameter_directory(tmp_dir, "mlp", word_list, silent=True)
+        binary_duration = perf_counter() - start
+
+    for word in word_list:
+        assert array_equal(array(old[word]), new[word]), word
+
+    megabytes = n_bytes / 1_000_000
+    print(f"{n_words} words x {n_frames} frames x {n_nodes} nodes ({megabytes:.1f} MB of logs)")
+    print(f"get_activation_lists:  {old_duration:7.3f} s  ({megabytes / old_duration:7.1f} MB/s)")
+    print(f"get_activation_arrays: {new_duration:7.3f} s  ({megabytes / new_duration:7.1f} MB/s)")
+    print(f"speed-up: {old_duration / new_duration:.1f}x")
+    print(f"load_htk_parameter_directory on .mlp files: {binary_duration:7.3f} s "
+          f"(speed-up over get_activation_lists: {old_duration / binary_duration:.1f}x)")
+
+
+if __name__ == "__main__":
+    run_benchmark(*[int(a) for a in argv[1:]])
@@ -0,0 +1,139 @@
+"""
+===========================
+Benchmark of load_and_stack_data_for_layer against the original list-based version.
+===========================
+
+Writes a synthetic layer of activations to a temporary .mat file with a random phonetic segmentation, stacks it both
+ways, checks the results are identical, and reports the time and peak traced memory of each.  (Timings are taken with
+tracemalloc running, which slows the list-based version most.)
+
+    python -m benchmarks.load_and_stack [n_words] [n_frames] [n_nodes]
+---------------------------
+"""
+from collections import defaultdict
+from pathlib import Path
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import start as start_tracing, stop as stop_tracing, get_traced_memory, reset_peak
+
+from numpy import array, array_equal, mean
+from numpy.random import default_rng
+from scipy.io import savemat
+
+from common.layers import DNNLayer, load_and_stack_data_for_layer, load_layer_activations
+from common.matlab_interop import load_matlab_file
+from common.segmentation import Phone, PhoneSegment, PhoneSegmentationSet
+
+
+FILE_PATTERN = "hidden_layer_{0}_activations.mat"
+
+
+def synthetic_segmentation(word_list, n_frames: int) -> PhoneSegmentationSet:
+    """Words start and end with silence, with phones of 3 to 12 frames between."""
+    rng = default_rng(0)
+    phones = [phone for phone in Phone if phone != Phone.sil]
+    segmentation = dict()
+    for word in word_list:
+        boundaries = [0, 5]
+        while boundaries[-1] < n_frames - 15:
+            boundaries.append(boundaries[-1] + int(rng.integers(3, 13)))
+        boundaries.append(n_frames)
+        labels = [Phone.sil] + [phones[i] for i in rng.integers(0, len(phones), len(boundaries) - 3)] + [Phone.sil]
+        segmentation[word] = [
+            PhoneSegment(onset_sample=onset * 100_000, offset_sample=offset * 100_000, label=label)
+            for onset, offset, label in zip(boundaries[:-1], boundaries[1:], labels)
+        ]
+    return PhoneSegmentationSet(segmentation)
+
+
+def load_and_stack_with_lists(layer, phone_segmentations, from_dir, file_pattern):
+    """The original implementation, which builds everything in lists and converts them to arrays at the end."""
+    layer_activations = load_matlab_file(Path(from_dir, file_pattern.format(layer.name)), use_cache=False)
+
+    activations_per_frame = []
+    labels_per_frame = []
+    activations_per_phone = defaultdict(list)
+    activations_per_word_phone = []
+    labels_per_word_phone = []
+    for word in phone_segmentations.words:
+        for segment in phone_segmentations[word]:
+            if segment.label == Phone.sil:
+                continue
+            activations_this_segment = layer_activations[word][segment.onset_frame:segment.offset_frame, :]
+            activations_per_frame.extend(activations_this_segment.tolist())
+            labels_per_frame.extend([segment.label for _ in range(len(activations_this_segment))])
+            activations_per_phone[segment.label].extend(activations_this_segment.tolist())
+            activations_per_word_phone.append(mean(activations_this_segment, 0).tolist())
+            labels_per_word_phone.append(segment.label)
+
+    activations_per_frame = array(activations_per_frame)
+    activations_per_word_phone = array(activations_per_word_phone)
+    activations_per_phone = {
+        phone: mean(activations, 0)
+        for phone, activations in activations_per_phone.items()
+    }
+
+    return (
+        activations_per_frame, labels_per_frame,
+        activations_per_word_phone, labels_per_word_phone,
+        activations_per_phone
+    )
+
+
+def stack_all_views(layer, phone_segmentations, from_dir, file_pattern):
+    return tuple(load_and_stack_data_for_layer(layer, phone_segmentations, from_dir, file_pattern))
+
+
+def stack_word_phone_means(layer, phone_segmentations, from_dir, file_pattern):
+    return load_and_stack_data_for_layer(layer, phone_segmentations, from_dir, file_pattern).activations_per_word_phone
+
+
+def timed(function, *args):
+    """(result, seconds, peak traced megabytes)"""
+    start_tracing()
+    reset_peak()
+    start = perf_counter()
+    result = function(*args)
+    duration = perf_counter() - start
+    _, peak = get_traced_memory()
+    stop_tracing()
+    return result, duration, peak / 1_000_000
+
+
+def run_benchmark(n_words: int = 200, n_frames: int = 60, n_nodes: int = 1000):
+    layer = DNNLayer.L2
+    word_list = [f"word{i:03d}" for i in range(n_words)]
+    phone_segmentations = synthetic_segmentation(word_list, n_frames)
+    rng = default_rng(1)
+    with TemporaryDirectory() as tmp_dir:
+        savemat(Path(tmp_dir, FILE_PATTERN.format(layer.name)), {
+            word: rng.standard_normal((n_frames, n_nodes))
+            for word in word_list
+        })
+
+        old, old_duration, old_peak = timed(load_and_stack_with_lists, layer, phone_segmentations, tmp_dir, FILE_PATTERN)
+
+        # The first load converts the .mat file into the activation store
+        _, conversion_duration, _ = timed(load_layer_activations, layer, tmp_dir, FILE_PATTERN)
+        new, new_duration, new_peak = timed(stack_all_views, layer, phone_segmentations, tmp_dir, FILE_PATTERN)
+        _, word_phone_duration, word_phone_peak = timed(stack_word_phone_means, layer, phone_segmentations, tmp_dir,
+                                                        FILE_PATTERN)
+
+    assert array_equal(old[0], new[0])
+    assert old[1] == new[1]
+    assert array_equal(old[2], new[2])
+    assert old[3] == new[3]
+    assert list(old[4].keys()) == list(new[4].keys())
+    assert all(array_equal(old[4][phone], new[4][phone]) for phone in old[4])
+
+    print(f"{n_words} words x {n_frames} frames x {n_nodes} nodes ({len(new[0])} non-silence frames)")
+    print(f"lists:        {old_duration:7.3f} s  peak {old_peak:8.1f} MB")
+    print(f"preallocated: {new_duration:7.3f} s  peak {new_peak:8.1f} MB"
+          f"  (plus {conversion_duration:.3f} s converting to the activation store, once)")
+    print(f"speed-up: {old_duration / new_duration:.1f}x, memory: {old_peak / new_peak:.1f}x less")
+    print(f"word-phone means only: {word_phone_duration:7.3f} s  peak {word_phone_peak:8.1f} MB")
+
+
+if __name__ == "__main__":
+    run_benchmark(*[int(a) for a in argv[1:]])
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from numpy import (ndarray, arange, array, asarray, concatenate, cumsum, dtype as numpy_dtype, empty, repeat,
+                   searchsorted, unique, zeros)
+
+from .activation_store import ActivationStore
+from .ragged import RaggedArray
+
+
+@dataclass
+class ActivationSet(RaggedArray):
+    """
+    A layer's word -> (time x node) activations as one contiguous (total_frames x node) array, with each word's frames
+    between its offsets.
+
+    Frames from many words can be gathered in one go by (word, onset frame, offset frame) lists, rather than indexing
+    each word's array in turn.
+
+    A store saved in several blocks is kept as its memory-mapped blocks rather than read into one array: data is then
+    None, and rows of the whole layer are read from whichever block holds them (see rows and take).
+    """
+    # For a multi-block store: each block (holding consecutive whole words), and the row of the layer each one starts at
+    blocks: Optional[List[ndarray]] = None
+    block_starts: Optional[ndarray] = None
+
+    @classmethod
+    def from_dict(cls, layer_activations: Dict[str, ndarray]) -> ActivationSet:
+        """From a word -> (time x node) dictionary, such as a loaded Matlab file (whose __header__ etc. are skipped)."""
+        words = [word for word in layer_activations.keys() if not word.startswith("__")]
+        ragged = RaggedArray.from_word_arrays(layer_activations, words)
+        return cls(words=ragged.words, data=ragged.data, offsets=ragged.offsets)
+
+    @classmethod
+    def from_store(cls, store: ActivationStore) -> ActivationSet:
+        """From an on-disk store, whose blocks stay memory-mapped."""
+        words = store.words
+        lengths = [store.n_frames(word) for word in words]
+        offsets = concatenate([[0], cumsum(lengths)]).astype(int)
+        if len(words) == 0:
+            return cls(words=words, data=zeros((0, store.n_nodes), dtype=store.dtype), offsets=offsets)
+        if len(store.blocks) == 1:
+            # Words are saved in order, so the block is already the contiguous array
+            return cls(words=words, data=store.block(0)[:offsets[-1]], offsets=offsets)
+        # Each block starts with the first word saved in it
+        block_starts = zeros(len(store.blocks), dtype=int)
+        for word_i in reversed(range(len(words))):
+            block_starts[store.word_block(words[word_i])] = offsets[word_i]
+        return cls(words=words, data=None, offsets=offsets,
+                   blocks=[store.block(block_i) for block_i in range(len(store.blocks))], block_starts=block_starts)
+
+    def __contains__(self, word):
+        return word in self._word_index
+
+    def keys(self):
+        return self._word_index.keys()
+
+    def __getitem__(self, word: str) -> ndarray:
+        """A word's time x node view."""
+        word_i = self._word_index[word]
+        return self.rows(self.offsets[word_i], self.offsets[word_i + 1])
+
+    @property
+    def n_nodes(self) -> int:
+        if self.data is None:
+            return self.blocks[0].shape[1]
+        return self.n_dims
+
+    @property
+    def dtype(self) -> numpy_dtype:
+        if self.data is None:
+            return self.blocks[0].dtype
+        return self.data.dtype
+
+    @property
+    def n_frames(self) -> int:
+        return int(self.offsets[-1])
+
+    def rows(self, start: int, stop: int) -> ndarray:
+        """A view of rows start to stop of the layer, which must all be in one word (or one block)."""
+        if self.data is None:
+            block_i = searchsorted(self.block_starts, start, side="right") - 1
+            block_start = self.block_starts[block_i]
+            return self.blocks[block_i][start - block_start:stop - block_start]
+        return self.data[start:stop]
+
+    def take(self, rows: ndarray) -> ndarray:
+        """The layer's rows at these positions, as a new rows x node array."""
+        if self.data is None:
+            taken = empty((len(rows), self.n_nodes), dtype=self.dtype)
+            row_blocks = searchsorted(self.block_starts, rows, side="right") - 1
+            for block_i in unique(row_blocks):
+                in_block = row_blocks == block_i
+                taken[in_block] = self.blocks[block_i][rows[in_block] - self.block_starts[block_i]]
+            return taken
+        return self.data[rows]
+
+    def word_positions(self, words: Sequence[str]) -> ndarray:
+        """The position of each word in self.words."""
+        return array([self._word_index[word] for word in words], dtype=int)
+
+    def segment_rows(self, words: Sequence[str], onset_frames: Sequence[int], offset_frames: Sequence[int]
+                     ) -> Tuple[ndarray, ndarray]:
+        """
+        The rows of the data holding frames onset_frames[i] to offset_frames[i] of words[i], for all i, in order;
+        and the number of frames in each segment.
+
+        Like word_activations[onset_frame:offset_frame, :], segments are clipped to the end of the word.
+        """
+        word_is = self.word_positions(words)
+        word_lengths = self.lengths[word_is]
+        onsets = asarray(onset_frames, dtype=int).clip(0, word_lengths)
+        offsets = asarray(offset_frames, dtype=int).clip(onsets, word_lengths)
+        segment_lengths = offsets - onsets
+        # Row within each segment, then shifted to each segment's first row
+        segment_starts = cumsum(segment_lengths) - segment_lengths
+        rows = (arange(segment_lengths.sum())
+                - repeat(segment_starts, segment_lengths)
+                + repeat(self.offsets[word_is] + onsets, segment_lengths))
+        return rows, segment_lengths
+
+    def gather(self, words: Sequence[str], onset_frames: Sequence[int], offset_frames: Sequence[int]
+               ) -> Tuple[ndarray, ndarray]:
+        """
+        The frames of many (word, onset, offset) segments stacked into one frames x node array, and the number of frames
+        in each segment.
+        """
+        rows, segment_lengths = self.segment_rows(words, onset_frames, offset_frames)
+        return self.take(rows), segment_lengths
+
+    def describe(self) -> str:
+        blocks = f" in {len(self.blocks)} blocks" if self.data is None else ""
+        return f"{len(self.words)} words, {self.n_frames} frames x {self.n_nodes} nodes ({self.dtype}){blocks}"
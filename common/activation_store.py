@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import json
+import os
+from os import PathLike
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from typing import Dict, List, Mapping, Optional, Tuple, Union
+
+from numpy import ndarray, asarray, concatenate, cumsum, dtype as numpy_dtype, load, save, zeros
+
+from .matlab_interop import LazyMatlabFile, open_matlab_file
+
+
+STORE_INDEX_FILE_NAME = "index.json"
+STORE_DIR_SUFFIX = ".store"
+
+# Target size of each .npy block
+DEFAULT_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def store_dir_for(matlab_path: Union[str, PathLike]) -> Path:
+    """The store built from a layer's .mat file lives next to it, e.g. hidden_layer_2_activations.mat.store/."""
+    return Path(str(matlab_path) + STORE_DIR_SUFFIX)
+
+
+class ActivationStore:
+    """
+    A layer's word -> (time x node) activations, saved as .npy blocks of whole words, with a JSON index of where each
+    word's frames are.
+
+    Blocks are memory-mapped read-only, so reading one word (or one segment of one word) only touches the pages holding
+    it, and processes reading the same store share those pages through the OS page cache.
+    """
+
+    def __init__(self, store_dir: Union[str, PathLike]):
+        self.store_dir = Path(store_dir)
+        with open(Path(self.store_dir, STORE_INDEX_FILE_NAME), encoding="utf-8") as index_file:
+            self._read_index(json.load(index_file))
+
+    def _read_index(self, index: Dict):
+        self.blocks: List[str] = index["blocks"]
+        self.n_nodes: int = index["n_nodes"]
+        self.dtype = numpy_dtype(index["dtype"])
+        self.source: Optional[Dict] = index.get("source")
+        # word -> (block, start row, stop row)
+        self._word_rows: Dict[str, Tuple[int, int, int]] = {
+            word: tuple(rows)
+            for word, rows in index["words"].items()
+        }
+        # Blocks are mapped the first time they're needed
+        self._mapped_blocks: Dict[int, ndarray] = dict()
+
+    def __len__(self):
+        return len(self._word_rows)
+
+    def __contains__(self, word):
+        return word in self._word_rows
+
+    @property
+    def words(self) -> List[str]:
+        return list(self._word_rows.keys())
+
+    def keys(self):
+        return self._word_rows.keys()
+
+    def block(self, block_i: int) -> ndarray:
+        """A whole block, memory-mapped."""
+        if block_i not in self._mapped_blocks:
+            self._mapped_blocks[block_i] = load(Path(self.store_dir, self.blocks[block_i]), mmap_mode="r")
+        return self._mapped_blocks[block_i]
+
+    def __getitem__(self, word: str) -> ndarray:
+        """A word's time x node activations, as a read-only memory-mapped view."""
+        block_i, start, stop = self._word_rows[word]
+        return self.block(block_i)[start:stop]
+
+    def frames(self, word: str, onset_frame: int, offset_frame: int) -> ndarray:
+        """Frames onset_frame to offset_frame of a word (like word_activations[onset_frame:offset_frame, :])."""
+        return self[word][onset_frame:offset_frame]
+
+    def word_block(self, word: str) -> int:
+        """The block a word is saved in."""
+        return self._word_rows[word][0]
+
+    def n_frames(self, word: str) -> int:
+        _, start, stop = self._word_rows[word]
+        return stop - start
+
+    def is_current_for(self, matlab_path: Union[str, PathLike]) -> bool:
+        """Whether this store was built from the .mat file as it is now."""
+        if self.source is None:
+            return False
+        stat = os.stat(matlab_path)
+        return stat.st_size == self.source["size"] and stat.st_mtime_ns == self.source["mtime_ns"]
+
+
+class InMemoryActivationStore(ActivationStore):
+    """
+    An ActivationStore held in memory as a single block, for when a store can't be written next to its .mat file.
+    """
+
+    def __init__(self, layer_activations: Mapping):
+        self.store_dir = None
+        words = [word for word in layer_activations.keys() if not word.startswith("__")]
+        word_arrays = [asarray(layer_activations[word]) for word in words]
+        data = concatenate(word_arrays, axis=0) if len(words) > 0 else zeros((0, 0))
+        word_stops = cumsum([len(word_array) for word_array in word_arrays]).tolist()
+        self._read_index({
+            "blocks": ["<memory>"],
+            "n_nodes": data.shape[1],
+            "dtype": data.dtype.str,
+            "source": None,
+            "words": {
+                word: [0, stop - len(word_array), stop]
+                for word, word_array, stop in zip(words, word_arrays, word_stops)
+            },
+        })
+        self._mapped_blocks[0] = data
+
+
+def write_activation_store(layer_activations: Mapping, store_dir: Union[str, PathLike],
+                           block_bytes: int = DEFAULT_BLOCK_BYTES,
+                           source: Optional[Dict] = None) -> ActivationStore:
+    """
+    Saves a word -> (time x node) mapping of activations as a store.
+
+    Words are kept whole and in order, with a new block started once a block reaches block_bytes.  The store is written
+    to a temporary directory beside store_dir and then moved into place, so other processes only ever see a complete
+    store (or none), and an interrupted write leaves any previous store as it was.
+
+    :param layer_activations: a dictionary, or a LazyMatlabFile (in which case only a block's worth of words is read
+    at once).  Matlab header entries (like __header__) are skipped.
+    :param store_dir:
+    :param block_bytes:
+    :param source: details of the file the activations came from, to check for staleness
+    """
+    store_dir = Path(store_dir)
+    store_dir.parent.mkdir(parents=True, exist_ok=True)
+    partial_dir = Path(mkdtemp(dir=store_dir.parent, prefix=f".{store_dir.name}.partial-"))
+    # mkdtemp makes directories only their owner can read
+    os.chmod(partial_dir, 0o755)
+    try:
+        _write_blocks(layer_activations, partial_dir, block_bytes, source)
+    except BaseException:
+        rmtree(partial_dir, ignore_errors=True)
+        raise
+    _move_into_place(partial_dir, store_dir)
+    return ActivationStore(store_dir)
+
+
+def _write_blocks(layer_activations: Mapping, store_dir: Path, block_bytes: int, source: Optional[Dict]):
+    """Writes the blocks and then the index of a store into an existing directory."""
+    words = [word for word in layer_activations.keys() if not word.startswith("__")]
+    first_array = asarray(layer_activations[words[0]]) if len(words) > 0 else None
+    n_nodes = first_array.shape[1] if first_array is not None else 0
+    store_dtype = first_array.dtype if first_array is not None else numpy_dtype(float)
+
+    blocks: List[str] = []
+    word_rows: Dict[str, List[int]] = dict()
+
+    def flush(block_words):
+        if len(block_words) == 0:
+            return
+        block_name = f"block{len(blocks):04d}.npy"
+        save(Path(store_dir, block_name),
+             concatenate([asarray(layer_activations[word]) for word in block_words], axis=0)
+             .astype(store_dtype, copy=False))
+        blocks.append(block_name)
+        if isinstance(layer_activations, LazyMatlabFile):
+            layer_activations.forget(block_words)
+
+    block_words: List[str] = []
+    block_rows = 0
+    for word in words:
+        word_n_frames = len(layer_activations[word])
+        if len(block_words) > 0 and (block_rows + word_n_frames) * n_nodes * store_dtype.itemsize > block_bytes:
+            flush(block_words)
+            block_words, block_rows = [], 0
+        word_rows[word] = [len(blocks), block_rows, block_rows + word_n_frames]
+        block_words.append(word)
+        block_rows += word_n_frames
+    flush(block_words)
+
+    with open(Path(store_dir, STORE_INDEX_FILE_NAME), mode="w", encoding="utf-8") as index_file:
+        json.dump({
+            "blocks": blocks,
+            "n_nodes": n_nodes,
+            "dtype": store_dtype.str,
+            "source": source,
+            "words": word_rows,
+        }, index_file)
+
+
+def _move_into_place(partial_dir: Path, store_dir: Path):
+    """Moves a newly written store to store_dir, replacing any store already there."""
+    stale_dir = None
+    if store_dir.exists():
+        # A directory with files in can't be replaced, so the old store is moved aside first.  Readers which already
+        # have its blocks mapped keep them.
+        stale_dir = Path(mkdtemp(dir=store_dir.parent, prefix=f".{store_dir.name}.stale-"))
+        try:
+            os.replace(store_dir, Path(stale_dir, store_dir.name))
+        except FileNotFoundError:
+            # Another process moved it
+            pass
+    try:
+        os.replace(partial_dir, store_dir)
+    except OSError:
+        # Another process put its store in place first
+        rmtree(partial_dir, ignore_errors=True)
+    if stale_dir is not None:
+        rmtree(stale_dir, ignore_errors=True)
+
+
+def open_activation_store(matlab_path: Union[str, PathLike],
+                          block_bytes: int = DEFAULT_BLOCK_BYTES) -> ActivationStore:
+    """
+    Opens the store for a layer's .mat file, building it first if there isn't one or the .mat file has changed since.
+    If the store can't be written because the .mat file's directory is read-only, the activations are loaded into an
+    InMemoryActivationStore instead.
+
+    :raises FileNotFoundError: if the .mat file doesn't exist
+    """
+    matlab_path = Path(matlab_path)
+    if not matlab_path.exists():
+        raise FileNotFoundError(matlab_path)
+    store_dir = store_dir_for(matlab_path)
+    if Path(store_dir, STORE_INDEX_FILE_NAME).exists():
+        store = ActivationStore(store_dir)
+        if store.is_current_for(matlab_path):
+            return store
+    stat = os.stat(matlab_path)
+    # The store is itself the converted copy, so the Matlab cache isn't needed too
+    layer_activations = open_matlab_file(matlab_path)
+    try:
+        if not os.access(store_dir.parent, os.W_OK):
+            return InMemoryActivationStore(layer_activations)
+        return write_activation_store(layer_activations, store_dir, block_bytes=block_bytes,
+                                      source={"path": str(matlab_path), "size": stat.st_size,
+                                              "mtime_ns": stat.st_mtime_ns})
+    finally:
+        if isinstance(layer_activations, LazyMatlabFile):
+            layer_activations.close()
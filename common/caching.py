@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+_V = TypeVar("_V")
+
+
+class ByteBoundedLRUCache(Generic[_V]):
+    """
+    An in-process cache which keeps the most recently used values up to a total size in bytes.
+
+    A value bigger than the whole budget is returned but not kept.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> (value, size in bytes), least recently used first
+        self._entries: OrderedDict[Hashable, Tuple[_V, int]] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[_V]:
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key: Hashable, value: _V, n_bytes: int):
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)[1]
+        if n_bytes > self.max_bytes:
+            return
+        self._entries[key] = (value, n_bytes)
+        self.total_bytes += n_bytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], _V], size_of: Callable[[_V], int]) -> _V:
+        """The cached value for key, or else the result of compute(), which is then cached."""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value, size_of(value))
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
@@ -1,14 +1,22 @@
 from __future__ import annotations
 
-from collections import defaultdict
+from dataclasses import dataclass
 from enum import Enum
+from functools import cached_property
+from itertools import compress
 from pathlib import Path
-from typing import Tuple, List, Dict, DefaultDict
+from typing import Tuple, List, Dict, Iterable, Optional
 
-from numpy import mean, array
+from numpy import array, array_equal, asfortranarray, concatenate, cumsum, empty, full, nan, repeat, searchsorted
 
-from .matlab_interop import load_matlab_file
-from common.segmentation import Phone, PhoneSegmentation
+from .activation_set import ActivationSet
+from .activation_store import ActivationStore, open_activation_store
+from .segment_reduction import Summary, reduce_by_label, reduce_segments
+from common.segmentation import Phone
+
+
+# The number of frames gathered at once when stacking a layer's activations
+_GATHER_SLAB_ROWS = 4096
 
 
 class DNNLayer(Enum):
@@ -42,82 +50,310 @@ class DNNLayer(Enum):
             return f"Layer{self.value}"
 
 
+def load_layer_activations(layer: DNNLayer, from_dir, file_pattern) -> ActivationStore:
+    """
+    The memory-mapped store of a layer's word -> (time x node) activations, built from its .mat file if needed.
+    """
+    # TODO: this naming is a real mess
+    try:
+        return open_activation_store(Path(from_dir, file_pattern.format(layer.name)))
+    except FileNotFoundError:
+        try:
+            return open_activation_store(Path(from_dir, file_pattern.format(layer.old_name)))
+        except FileNotFoundError:
+            return open_activation_store(Path(from_dir, file_pattern.format(layer.value)))
+
+
+class GatherPlan:
+    """
+    Which frames of a layer each (non-silence) segment of a segmentation covers, worked out once and applied to any
+    number of layers.
+
+    Layers whose words have the same frames (such as all the layers of one system) share the rows to gather, so applying
+    the plan to another layer costs one gather of its activations.
+    """
+
+    def __init__(self, segment_words: List[str], segment_onsets: List[int], segment_offsets: List[int],
+                 labels_per_word_phone: List[Phone]):
+        self.segment_words: List[str] = segment_words
+        self.segment_onsets: array = array(segment_onsets, dtype=int)
+        self.segment_offsets: array = array(segment_offsets, dtype=int)
+        # list of phone labels for individual occurrences
+        self.labels_per_word_phone: List[Phone] = labels_per_word_phone
+
+        # The layout (words and offsets) of the layer rows were last worked out for, and the rows and segment lengths
+        self._rows_layout: Optional[Tuple[List[str], array]] = None
+        self._rows: Optional[Tuple[array, array]] = None
+
+    @classmethod
+    def from_segmentation(cls, phone_segmentations) -> GatherPlan:
+        """The word, onset frame, offset frame and label of each segment, skipping silence."""
+        segment_words, segment_onsets, segment_offsets, segment_labels = phone_segmentations.segment_frames()
+        # Skip silence
+        keep = array([label != Phone.sil for label in segment_labels], dtype=bool)
+        return cls(list(compress(segment_words, keep)), segment_onsets[keep], segment_offsets[keep],
+                   list(compress(segment_labels, keep)))
+
+    def __len__(self):
+        return len(self.segment_words)
+
+    def rows_for(self, layer_activations: ActivationSet) -> Tuple[array, array]:
+        """
+        The rows of a layer's data holding each segment's frames, in order, and the number of frames in each segment
+        (see ActivationSet.segment_rows).
+        """
+        if (self._rows_layout is None
+                or self._rows_layout[0] != layer_activations.words
+                or not array_equal(self._rows_layout[1], layer_activations.offsets)):
+            self._rows = layer_activations.segment_rows(self.segment_words, self.segment_onsets, self.segment_offsets)
+            self._rows_layout = (layer_activations.words, layer_activations.offsets)
+        return self._rows
+
+
+@dataclass
+class LayerSummaries:
+    """Summaries of a layer's activations over each (non-silence) segment, and over all the frames of each phone."""
+    # Order matched to per_word_phone
+    labels_per_word_phone: List[Phone]
+    # summary -> phone_occurrences x node
+    per_word_phone: Dict[Summary, array]
+    # Order matched to per_phone
+    phones: List[Phone]
+    # summary -> phones x node
+    per_phone: Dict[Summary, array]
+
+
+class StackedLayerData:
+    """
+    A layer's activations distributed in various ways over the (non-silence) segments of a segmentation.
+
+    Each view is computed the first time it's used, and kept.  Iterating gives the five views in the order
+    load_and_stack_data_for_layer used to return them, so they can still be unpacked in one go.
+    """
+
+    def __init__(self, layer_activations: ActivationSet, plan: GatherPlan):
+        self.layer_activations: ActivationSet = layer_activations
+
+        # list of phone labels for individual occurrences
+        self.labels_per_word_phone: List[Phone] = plan.labels_per_word_phone
+
+        # Where every segment's frames are, so the views can be allocated up front
+        self._rows, self.segment_lengths = plan.rows_for(layer_activations)
+        self._segment_bounds = concatenate([[0], cumsum(self.segment_lengths)])
+
+    def __iter__(self):
+        return iter((
+            self.activations_per_frame, self.labels_per_frame,
+            self.activations_per_word_phone, self.labels_per_word_phone,
+            self.activations_per_phone
+        ))
+
+    @cached_property
+    def activations_per_frame(self) -> array:
+        """
+        frame x node array of activation values
+        """
+        # Filled a slab of rows at a time, so there's never more than a slab of temporary copies
+        activations_per_frame: array = empty((len(self._rows), self.layer_activations.n_nodes), dtype=float)
+        for slab_start in range(0, len(self._rows), _GATHER_SLAB_ROWS):
+            slab = slice(slab_start, slab_start + _GATHER_SLAB_ROWS)
+            activations_per_frame[slab] = self.layer_activations.take(self._rows[slab])
+        return activations_per_frame
+
+    @cached_property
+    def labels_per_frame(self) -> List[Phone]:
+        """
+        list of phone labels for each frame; order matched to activations_per_frame
+        """
+        return [label
+                for label, length in zip(self.labels_per_word_phone, self.segment_lengths)
+                for _ in range(length)]
+
+    @cached_property
+    def activations_per_word_phone(self) -> array:
+        """
+        phone_occurrences x node array of activation values (the mean over each segment's frames); order matched to
+        labels_per_word_phone.  Segments with no frames are NaN.
+        """
+        return self.summarise_segments([Summary.mean])[Summary.mean]
+
+    @cached_property
+    def activations_per_phone(self) -> Dict[Phone, array]:
+        """
+        dictionary of phone -> mean activation per node over all its frames
+        """
+        phones, per_phone = self._summarise_phones([Summary.mean])
+        phone_means = dict(zip(phones, per_phone[Summary.mean]))
+        # Phones whose segments are all empty have no frames to average
+        return {
+            phone: phone_means.get(phone, full(self.layer_activations.n_nodes, nan))
+            for phone in dict.fromkeys(self.labels_per_word_phone)
+        }
+
+    def _empty_summaries(self, summaries: List[Summary], n_rows: int) -> Dict[Summary, array]:
+        return {
+            summary: (empty(n_rows, dtype=int) if summary == Summary.count
+                      else empty((n_rows, self.layer_activations.n_nodes), dtype=float))
+            for summary in summaries
+        }
+
+    def summarise_segments(self, summaries: Iterable[Summary] = (Summary.mean,)) -> Dict[Summary, array]:
+        """
+        Summarises the activations over each segment, with any of the summaries in segment_reduction.Summary.
+
+        All the requested summaries come from one pass over the segments' frames, which are gathered a slab of whole
+        segments at a time, so the layer's frames are never all copied at once.
+
+        Each slab is Fortran-ordered and at the layer's own precision, as the arrays loaded from Matlab files were, so
+        the means are the same to the last bit as numpy.mean of each segment of those arrays.
+
+        :return: summary -> phone_occurrences x node array (or, for Summary.count, an array of segment lengths); order
+        matched to labels_per_word_phone
+        """
+        summaries = list(summaries)
+        n_segments = len(self.segment_lengths)
+        reduced = self._empty_summaries(summaries, n_segments)
+        first_segment = 0
+        while first_segment < n_segments:
+            # Whole segments up to a slab's worth of frames, and at least one segment
+            slab_end = self._segment_bounds[first_segment] + _GATHER_SLAB_ROWS
+            stop_segment = max(searchsorted(self._segment_bounds, slab_end, side="right") - 1, first_segment + 1)
+            slab_rows = self._rows[self._segment_bounds[first_segment]:self._segment_bounds[stop_segment]]
+            slab = reduce_segments(asfortranarray(self.layer_activations.take(slab_rows)),
+                                   self.segment_lengths[first_segment:stop_segment], summaries)
+            for summary, values in slab.items():
+                reduced[summary][first_segment:stop_segment] = values
+            first_segment = stop_segment
+        return reduced
+
+    def _summarise_phones(self, summaries: List[Summary]) -> Tuple[List[Phone], Dict[Summary, array]]:
+        """
+        Summaries over all the frames of each phone which has any, in order of first appearance.
+
+        Unless activations_per_frame has already been stacked, each phone's frames are gathered on their own, so only
+        one phone's frames are copied at once.  Either way the frames are doubles summed one row at a time, as when
+        each phone's frames were stacked into a list, so the means are the same to the last bit.
+        """
+        if "activations_per_frame" in self.__dict__:
+            return reduce_by_label(self.activations_per_frame, self.labels_per_frame, summaries)
+
+        phones = list(dict.fromkeys(compress(self.labels_per_word_phone, self.segment_lengths)))
+        frame_phones = repeat([label.value for label in self.labels_per_word_phone], self.segment_lengths)
+        per_phone = self._empty_summaries(summaries, len(phones))
+        for phone_i, phone in enumerate(phones):
+            phone_frames = self.layer_activations.take(self._rows[frame_phones == phone.value]).astype(float)
+            for summary, values in reduce_segments(phone_frames, [len(phone_frames)], summaries).items():
+                per_phone[summary][phone_i] = values[0]
+        return phones, per_phone
+
+    def summarise(self, summaries: Iterable[Summary] = (Summary.mean,)) -> LayerSummaries:
+        """
+        Summarises the activations per segment and per phone, with any of the summaries in segment_reduction.Summary.
+
+        Frames are gathered a slab of segments or one phone at a time (see summarise_segments), so the layer's frames
+        are never all copied at once.
+        """
+        summaries = list(summaries)
+        phones, per_phone = self._summarise_phones(summaries)
+        return LayerSummaries(
+            labels_per_word_phone=self.labels_per_word_phone,
+            per_word_phone=self.summarise_segments(summaries),
+            phones=phones,
+            per_phone=per_phone,
+        )
+
+
+def _as_gather_plan(phone_segmentations) -> GatherPlan:
+    if isinstance(phone_segmentations, GatherPlan):
+        return phone_segmentations
+    return GatherPlan.from_segmentation(phone_segmentations)
+
+
 def load_and_stack_data_for_layer(
     layer: DNNLayer,
     phone_segmentations,
     from_dir,
     file_pattern,
-) -> Tuple[
-    array, List[Phone],
-    array, List[Phone],
-    Dict[Phone, array]
-]:
+) -> StackedLayerData:
     """
-    Load data for the specified layer, and distribute it in various ways.
+    Load data for the specified layer, to be distributed in various ways (see StackedLayerData).
 
-    (I returning values like this isn't the best idea, but it'll work for now.)
+    phone_segmentations may be a PhoneSegmentationSet or a GatherPlan made from one.
+    """
+    plan = _as_gather_plan(phone_segmentations)
+    layer_activations = ActivationSet.from_store(load_layer_activations(layer, from_dir, file_pattern))
+    return StackedLayerData(layer_activations, plan)
 
-    returns:
 
-    activations_per_frame:
-        frame x node array of activation values
-    labels_per_frame:
-        list of phone labels for each frame; order matched to above
-    activations_per_word_phone:
-        phone_occurrences x node array of activation values
-    labels_per_word_phone:
-        list of phone labels for individual occurrences; order matched to above
-    activations_per_phone:
-        dictionary of phone -> list of activations per node
+class MultiLayerData:
+    """
+    Several layers' StackedLayerData over the same segments, in order.  Indexable by layer.
     """
 
-    # word -> (time x node) array
-    # TODO: this naming is a real mess
-    try:
-        layer_activations = load_matlab_file(Path(from_dir, file_pattern.format(layer.name)))
-    except FileNotFoundError:
-        try:
-            layer_activations = load_matlab_file(Path(from_dir, file_pattern.format(layer.old_name)))
-        except FileNotFoundError:
-            layer_activations = load_matlab_file(Path(from_dir, file_pattern.format(layer.value)))
-
-
-    # frame x node
-    activations_per_frame = []
-    labels_per_frame = []
-    # phone -> frame x node (to be averaged later)
-    activations_per_phone: DefaultDict[PhoneSegmentation.Label, List] = defaultdict(list)
-    # frame (mean over segments) x node
-    activations_per_word_phone = []
-    labels_per_word_phone = []
-    for word in phone_segmentations.words:
-        for segment in phone_segmentations[word]:
-            # Skip silence
-            if segment.label == Phone.sil:
-                continue
-            activations_this_segment = layer_activations[word][segment.onset_frame:segment.offset_frame, :]
-
-            # activations for each frame
-            activations_per_frame.extend(activations_this_segment.tolist())
-            labels_per_frame.extend([segment.label for _ in range(len(activations_this_segment))])
-
-            # activations for this phone
-            activations_per_phone[segment.label].extend(activations_this_segment.tolist())
-
-            # average activation for this segment of this word
-            activations_per_word_phone.append(mean(activations_this_segment, 0).tolist())
-            labels_per_word_phone.append(segment.label)
-
-    # Convert to arrays and do averaging as necessary
-    activations_per_frame: array = array(activations_per_frame)
-    activations_per_word_phone: array = array(activations_per_word_phone)
-    activations_per_phone: Dict[Phone, array] = {
-        phone: mean(activations, 0)
-        for phone, activations in activations_per_phone.items()
-    }
-
-    return (
-        activations_per_frame, labels_per_frame,
-        activations_per_word_phone, labels_per_word_phone,
-        activations_per_phone
-    )
+    def __init__(self, plan: GatherPlan, layer_data: Dict[DNNLayer, StackedLayerData]):
+        self.plan: GatherPlan = plan
+        self._layer_data: Dict[DNNLayer, StackedLayerData] = layer_data
+
+    @property
+    def layers(self) -> List[DNNLayer]:
+        return list(self._layer_data.keys())
+
+    @property
+    def labels_per_word_phone(self) -> List[Phone]:
+        """Shared by all the layers."""
+        return self.plan.labels_per_word_phone
+
+    def __len__(self):
+        return len(self._layer_data)
+
+    def __getitem__(self, layer: DNNLayer) -> StackedLayerData:
+        return self._layer_data[layer]
+
+    def __iter__(self):
+        return iter(self._layer_data.items())
+
+    def stacked_activations_per_word_phone(self) -> Tuple[array, Dict[DNNLayer, slice]]:
+        """
+        All the layers' word-phone means side by side: a phone_occurrences x (all layers' nodes) array, and the columns
+        of each layer.
+        """
+        columns = dict()
+        first_column = 0
+        for layer, layer_data in self._layer_data.items():
+            columns[layer] = slice(first_column, first_column + layer_data.layer_activations.n_nodes)
+            first_column = columns[layer].stop
+        stacked = empty((len(self.plan), first_column), dtype=float)
+        for layer, layer_data in self._layer_data.items():
+            stacked[:, columns[layer]] = layer_data.activations_per_word_phone
+        return stacked, columns
+
+
+def load_and_stack_data_for_layers(
+    layers: Iterable[DNNLayer],
+    phone_segmentations,
+    from_dir,
+    file_pattern,
+) -> MultiLayerData:
+    """
+    Load data for several layers (e.g. all of DNNLayer, or a system's hmm0--hmm5), sharing one GatherPlan.
+
+    phone_segmentations may be a PhoneSegmentationSet or a GatherPlan made from one.
+    """
+    plan = _as_gather_plan(phone_segmentations)
+    return MultiLayerData(plan, {
+        layer: load_and_stack_data_for_layer(layer, plan, from_dir, file_pattern)
+        for layer in layers
+    })
+
+
+def summarise_layer(
+    layer: DNNLayer,
+    phone_segmentations,
+    from_dir,
+    file_pattern,
+    summaries: Iterable[Summary] = (Summary.mean,),
+) -> LayerSummaries:
+    """
+    Load data for the specified layer, and summarise it per segment and per phone (see StackedLayerData.summarise).
+    """
+    return load_and_stack_data_for_layer(layer, phone_segmentations, from_dir, file_pattern).summarise(summaries)
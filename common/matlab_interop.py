@@ -1,17 +1,302 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+from collections.abc import Mapping
 from os import PathLike
-from typing import Union
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-import mat73
+import h5py
 import scipy.io
+from mat73.core import HDF5Decoder
+from numpy import ndarray, load, save
+
+
+# Converted .mat files are kept here, as .npy files which can be memory-mapped
+MATLAB_CACHE_DIR = Path(Path.home(), ".cache", "htk-postprocessing", "matlab")
+# Least-recently-used conversions are removed to keep the cache within this size
+MATLAB_CACHE_BUDGET_BYTES = 20 * 1024 ** 3
+
+_CACHE_INDEX_FILE_NAME = "index.json"
+# Values which aren't plain arrays (headers, nested structures from mat73, etc.)
+_CACHE_OTHER_FILE_NAME = "other.pickle"
+# Entries are written under this prefix before being moved into place
+_CACHE_PARTIAL_PREFIX = ".partial-"
+# Partial entries older than this were left by a process which died mid-conversion
+_CACHE_PARTIAL_MAX_AGE_SECONDS = 60 * 60
+
+
+class LazyMatlabFile(Mapping):
+    """
+    A read-only variable name -> value mapping over a Matlab v7.3 (HDF5) file, which reads each variable from the file
+    the first time it's accessed.  Values are decoded as mat73.loadmat would.
+
+    Opening the file only reads the names of its variables, so memory use grows only with the variables used.
+    Can be used as a context manager to close the file at the end of the block.
+    """
+
+    # HDF5 entries holding Matlab's internal data rather than variables
+    _internal_names = {"#refs#", "#subsystem#"}
+
+    def __init__(self, path: Union[str, PathLike]):
+        self.path = Path(path)
+        self._file = h5py.File(self.path, "r")
+        self._names: List[str] = [name for name in self._file.keys() if name not in self._internal_names]
+        self._decoder = HDF5Decoder(verbose=False)
+        if "#refs#" in self._file:
+            # For cell arrays
+            self._decoder.refs = self._file["#refs#"]
+        self._values: Dict = dict()
+
+    def __getitem__(self, name: str):
+        if name not in self._values:
+            if name not in self._names:
+                raise KeyError(name)
+            self._values[name] = self._decoder.unpack_mat(self._file[name])
+        return self._values[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def _file_offset(self, name: str) -> float:
+        """Where a variable's data starts in the file, or inf if it's not stored in one piece."""
+        entry = self._file[name]
+        if isinstance(entry, h5py.Dataset):
+            offset = entry.id.get_offset()
+            if offset is not None:
+                return offset
+        return float("inf")
+
+    def in_file_order(self, names: Optional[Iterable[str]] = None) -> List[str]:
+        """Variable names (by default all of them) in the order their data is stored in the file."""
+        return sorted(names if names is not None else self._names, key=self._file_offset)
+
+    def read_many(self, names: Optional[Iterable[str]] = None) -> Dict:
+        """
+        Reads many variables (by default all of them) in one pass through the file, in the order they're stored
+        rather than the order asked for.  Returns them in the order asked for.
+        """
+        names = list(names) if names is not None else list(self._names)
+        for name in self.in_file_order(names):
+            self[name]
+        return {
+            name: self[name]
+            for name in names
+        }
+
+    def forget(self, names: Optional[Iterable[str]] = None):
+        """Drops read values (by default all of them), so that they can be freed."""
+        for name in (names if names is not None else list(self._values.keys())):
+            self._values.pop(name, None)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_matlab_file(path: Union[str, PathLike]) -> Mapping:
+    """
+    A Matlab file's variables: for v7.3 files a LazyMatlabFile, which reads variables as they're used; for older
+    versions, which can't be read in parts, a dictionary of all of them.
+
+    :raises FileNotFoundError: if the file doesn't exist
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    if h5py.is_hdf5(str(path)):
+        return LazyMatlabFile(path)
+    # noinspection PyTypeChecker
+    return scipy.io.loadmat(str(path))
+
+
+def _parse_matlab_file(path: Union[str, PathLike]) -> Dict:
+    contents = open_matlab_file(path)
+    if isinstance(contents, LazyMatlabFile):
+        with contents:
+            return contents.read_many()
+    return contents
+
+
+class MatlabCache:
+    """
+    Converted copies of .mat files, one directory per file, keyed on the file's path, size and modification time (so a
+    changed file is converted afresh).
+
+    Arrays are saved as .npy files and loaded memory-mapped, so loading a converted file costs next to nothing until its
+    data is used.
+    """
+
+    def __init__(self, cache_dir: Union[str, PathLike] = MATLAB_CACHE_DIR,
+                 budget_bytes: int = MATLAB_CACHE_BUDGET_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.budget_bytes = budget_bytes
+
+    @staticmethod
+    def _key(path: Path) -> str:
+        stat = os.stat(path)
+        return hashlib.sha1(f"{path}\n{stat.st_size}\n{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+    def load(self, path: Union[str, PathLike]) -> Dict:
+        """
+        The contents of a .mat file, converting it into the cache first if it's not there already.
+
+        :raises FileNotFoundError: if the .mat file doesn't exist
+        """
+        path = Path(path).resolve()
+        entry_dir = Path(self.cache_dir, self._key(path))
+        if not Path(entry_dir, _CACHE_INDEX_FILE_NAME).exists():
+            self._convert(path, entry_dir)
+        contents = self._read(entry_dir)
+        # The index's modification time records when the entry was last used
+        os.utime(Path(entry_dir, _CACHE_INDEX_FILE_NAME))
+        return contents
+
+    def _convert(self, path: Path, entry_dir: Path):
+        contents = open_matlab_file(path)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Written to one side and then moved into place, so other processes never see a partial entry
+        partial_dir = Path(mkdtemp(dir=self.cache_dir, prefix=_CACHE_PARTIAL_PREFIX))
+        try:
+            arrays: List[str] = []
+            others = dict()
+            names = contents.in_file_order() if isinstance(contents, LazyMatlabFile) else list(contents.keys())
+            for name in names:
+                value = contents[name]
+                if isinstance(value, ndarray) and not value.dtype.hasobject:
+                    save(Path(partial_dir, f"{len(arrays)}.npy"), value)
+                    arrays.append(name)
+                else:
+                    others[name] = value
+                if isinstance(contents, LazyMatlabFile):
+                    # Only one variable of a v7.3 file need be in memory at once
+                    contents.forget([name])
+            if isinstance(contents, LazyMatlabFile):
+                contents.close()
+            with open(Path(partial_dir, _CACHE_OTHER_FILE_NAME), mode="wb") as other_file:
+                pickle.dump(others, other_file)
+            with open(Path(partial_dir, _CACHE_INDEX_FILE_NAME), mode="w", encoding="utf-8") as index_file:
+                json.dump({
+                    "path": str(path),
+                    # In the order of the original file
+                    "names": list(contents.keys()),
+                    "arrays": arrays,
+                }, index_file)
+        except BaseException:
+            # Including KeyboardInterrupt, so an abandoned conversion doesn't hold disk space outside the budget
+            if isinstance(contents, LazyMatlabFile):
+                contents.close()
+            rmtree(partial_dir, ignore_errors=True)
+            raise
+
+        try:
+            os.replace(partial_dir, entry_dir)
+        except OSError:
+            # Another process got there first
+            rmtree(partial_dir, ignore_errors=True)
+
+        self._evict(keep=entry_dir, stale_path=str(path))
+
+    @staticmethod
+    def _read(entry_dir: Path) -> Dict:
+        with open(Path(entry_dir, _CACHE_INDEX_FILE_NAME), encoding="utf-8") as index_file:
+            index = json.load(index_file)
+        with open(Path(entry_dir, _CACHE_OTHER_FILE_NAME), mode="rb") as other_file:
+            values = pickle.load(other_file)
+        for array_i, name in enumerate(index["arrays"]):
+            values[name] = load(Path(entry_dir, f"{array_i}.npy"), mmap_mode="r")
+        return {
+            name: values[name]
+            for name in index["names"]
+        }
+
+    def _entries(self) -> List[Tuple[Path, float, int, Optional[str]]]:
+        """(directory, last used, size in bytes, source path) for each complete entry."""
+        entries = []
+        if not self.cache_dir.exists():
+            return entries
+        for entry_dir in self.cache_dir.iterdir():
+            index_path = Path(entry_dir, _CACHE_INDEX_FILE_NAME)
+            if entry_dir.name.startswith(".") or not index_path.exists():
+                continue
+            try:
+                with open(index_path, encoding="utf-8") as index_file:
+                    source_path = json.load(index_file).get("path")
+                last_used = index_path.stat().st_mtime
+                size = sum(f.stat().st_size for f in entry_dir.iterdir())
+            except (OSError, ValueError):
+                # Being removed by another process
+                continue
+            entries.append((entry_dir, last_used, size, source_path))
+        return entries
+
+    def _evict(self, keep: Path, stale_path: Optional[str] = None):
+        """
+        Removes entries for earlier versions of stale_path, then least-recently-used entries until the cache is within
+        budget.  The entry at keep is never removed.
+
+        Partial entries left behind by processes which died mid-conversion are removed too.
+        """
+        self._remove_abandoned_partials()
+
+        entries = []
+        for entry_dir, last_used, size, source_path in self._entries():
+            if entry_dir != keep and stale_path is not None and source_path == stale_path:
+                rmtree(entry_dir, ignore_errors=True)
+            else:
+                entries.append((entry_dir, last_used, size))
+
+        total_size = sum(size for _, _, size in entries)
+        for entry_dir, _, size in sorted(entries, key=lambda entry: entry[1]):
+            if total_size <= self.budget_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+    def _remove_abandoned_partials(self):
+        cutoff = time() - _CACHE_PARTIAL_MAX_AGE_SECONDS
+        for partial_dir in self.cache_dir.glob(f"{_CACHE_PARTIAL_PREFIX}*"):
+            try:
+                abandoned = partial_dir.stat().st_mtime < cutoff
+            except OSError:
+                # Moved into place or removed by another process
+                continue
+            if abandoned:
+                rmtree(partial_dir, ignore_errors=True)
+
+    def clear(self):
+        rmtree(self.cache_dir, ignore_errors=True)
+
+
+_default_cache = MatlabCache()
+
 
+def load_matlab_file(path: Union[str, PathLike], use_cache: bool = True):
+    """
+    Load a layer's activations from a Matlab file.
 
-def load_matlab_file(path: Union[str, PathLike]):
-    """Load a layer's activations from a Matlab file"""
-    try:
-        # this works
-        # noinspection PyTypeChecker
-        activations = scipy.io.loadmat(str(path))
-    except NotImplementedError:
-        # scipy can't load matlab v7.3 files, so we use a different library
-        activations = mat73.loadmat(str(path))
-    return activations
+    Unless use_cache is False, the file is converted once into the Matlab cache and later loads are memory-mapped from
+    there.  Arrays loaded from the cache are read-only.
+    """
+    if not use_cache:
+        return _parse_matlab_file(path)
+    return _default_cache.load(path)
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from os import PathLike
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from numpy import ndarray, array, asarray, concatenate, cumsum, flatnonzero, load, savez, zeros
+from scipy.io import savemat
+
+
+@dataclass
+class RaggedArray:
+    """
+    Per-word frames x dims data of varying numbers of frames, stored as one concatenated (total_frames x dims) array
+    with each word's rows delimited by offsets.
+
+    A word's frames are a contiguous slice of the data and a single frame of a word is a row of it, so both
+    word-major and frame-major access give views into the one array rather than copies.
+    """
+    words: List[str]
+    # total_frames x dims
+    data: ndarray
+    # Word i's frames are rows offsets[i] to offsets[i+1]
+    offsets: ndarray
+    # The frame id of the first row of each word (e.g. HTK's 0, or 2 for frames after HVite's initial silence)
+    first_frame: int = 0
+    # Optional labels for the columns (e.g. node or triphone names)
+    column_labels: Optional[List[str]] = None
+    # word -> position in words
+    _word_index: Dict[str, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._word_index = {word: word_i for word_i, word in enumerate(self.words)}
+
+    @classmethod
+    def from_word_arrays(cls, word_arrays: Dict[str, ndarray], words: Optional[List[str]] = None,
+                         first_frame: int = 0, column_labels: Optional[List[str]] = None) -> RaggedArray:
+        """Concatenates a dictionary of word -> (frames x dims) arrays."""
+        if words is None:
+            words = list(word_arrays.keys())
+        blocks = [asarray(word_arrays[word]) for word in words]
+        lengths = [len(block) for block in blocks]
+        offsets = concatenate([[0], cumsum(lengths)]).astype(int)
+        data = concatenate(blocks, axis=0) if len(blocks) > 0 else zeros((0, 0))
+        return cls(words=list(words), data=data, offsets=offsets,
+                   first_frame=first_frame, column_labels=column_labels)
+
+    @classmethod
+    def from_frame_dicts(cls, word_frame_dicts: Dict[str, Dict[str, List[float]]],
+                         words: Optional[List[str]] = None) -> RaggedArray:
+        """
+        Builds from a dictionary of word -> frame id string -> vector, as the HList dump parsers produce.
+        Each word's frames must run consecutively from the same first frame.
+        """
+        if words is None:
+            words = list(word_frame_dicts.keys())
+        word_arrays = dict()
+        first_frame = None
+        for word in words:
+            frame_ids = sorted(int(frame_id) for frame_id in word_frame_dicts[word].keys())
+            if len(frame_ids) == 0:
+                word_arrays[word] = zeros((0, 0))
+                continue
+            if first_frame is None:
+                first_frame = frame_ids[0]
+            if frame_ids != list(range(first_frame, first_frame + len(frame_ids))):
+                raise ValueError(f"Frames for '{word}' don't run consecutively from frame {first_frame}")
+            word_arrays[word] = array([word_frame_dicts[word][str(frame_id)] for frame_id in frame_ids])
+        # Words without frames still need the right number of columns to be concatenated
+        n_dims = max((block.shape[1] for block in word_arrays.values() if block.ndim == 2 and len(block) > 0), default=0)
+        for word, block in word_arrays.items():
+            if len(block) == 0:
+                word_arrays[word] = zeros((0, n_dims))
+        return cls.from_word_arrays(word_arrays, words, first_frame=first_frame or 0)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, word: str) -> ndarray:
+        """A word's frames x dims view."""
+        word_i = self._word_index[word]
+        return self.data[self.offsets[word_i]:self.offsets[word_i + 1]]
+
+    @property
+    def lengths(self) -> ndarray:
+        """The number of frames of each word."""
+        return self.offsets[1:] - self.offsets[:-1]
+
+    @property
+    def n_dims(self) -> int:
+        return self.data.shape[1] if self.data.ndim > 1 else 0
+
+    @property
+    def frame_ids(self) -> range:
+        """Every frame id any word has."""
+        return range(self.first_frame, self.first_frame + (int(self.lengths.max()) if len(self.words) > 0 else 0))
+
+    def frame_rows(self, frame_id: int) -> Tuple[List[str], ndarray]:
+        """The words which have this frame, and the row of the data holding it for each."""
+        frame_i = frame_id - self.first_frame
+        word_is = flatnonzero(self.lengths > frame_i)
+        return [self.words[word_i] for word_i in word_is], self.offsets[word_is] + frame_i
+
+    def frame(self, frame_id: int) -> Dict[str, ndarray]:
+        """A word -> row view dictionary of a single frame, for each word which has it."""
+        words, rows = self.frame_rows(frame_id)
+        return {
+            word: self.data[row]
+            for word, row in zip(words, rows)
+        }
+
+    def frame_matrix(self, frame_id: int) -> Tuple[List[str], ndarray]:
+        """A single frame as a words x dims matrix (a copy), for the words which have it."""
+        words, rows = self.frame_rows(frame_id)
+        return words, self.data[rows]
+
+    def save(self, path: Union[str, PathLike]):
+        savez(path, words=array(self.words), data=self.data, offsets=self.offsets,
+              first_frame=self.first_frame,
+              column_labels=array(self.column_labels if self.column_labels is not None else []))
+
+    @classmethod
+    def load(cls, path: Union[str, PathLike]) -> RaggedArray:
+        with load(path) as saved:
+            column_labels = saved["column_labels"].tolist()
+            return cls(words=saved["words"].tolist(), data=saved["data"], offsets=saved["offsets"],
+                       first_frame=int(saved["first_frame"]),
+                       column_labels=column_labels if len(column_labels) > 0 else None)
+
+    def export_per_frame_mat(self, output_dir: Union[str, PathLike], file_name_pattern: str,
+                             frame_ids: Optional[range] = None):
+        """
+        Writes the old layout of one Matlab file per frame, each a word-keyed struct of that frame's vectors.
+
+        :param output_dir:
+        :param file_name_pattern: formatted with the frame id, e.g. "fbanks_all_frame{0:02d}"
+        :param frame_ids: defaults to all of them
+        """
+        for frame_id in (frame_ids if frame_ids is not None else self.frame_ids):
+            savemat(Path(output_dir, file_name_pattern.format(frame_id)), self.frame(frame_id), appendmat=True)
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from enum import Enum, auto
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple
+
+from numpy import (ndarray, add, arange, argsort, array, asarray, bincount, cumsum, empty, full, maximum, mean,
+                   minimum, median, nan, nanmedian, repeat, sqrt)
+
+
+class Summary(Enum):
+    """Summaries of the frames in a segment (or with a label), per node."""
+    mean   = auto()
+    std    = auto()
+    min    = auto()
+    max    = auto()
+    median = auto()
+    # The number of frames (one per segment, not per node)
+    count  = auto()
+
+
+# Medians are taken over segments padded to the longest segment when that needs no more than this many times as many
+# values as the frames themselves; otherwise segment by segment.
+_MEDIAN_PADDING_LIMIT = 4
+
+
+def reduce_segments(frames: ndarray, segment_lengths: Sequence[int],
+                    summaries: Iterable[Summary] = (Summary.mean,)) -> Dict[Summary, ndarray]:
+    """
+    Summarises consecutive segments of a frames x node array.
+
+    Minima, maxima and sums of squared deviations of all segments are each taken with a single ufunc.reduceat over the
+    frames.  Means are taken with numpy.mean segment by segment, since reduceat sums in a different order and so
+    differs from it in the last bits.  Each mean is therefore identical to numpy.mean of the segment's frames as laid
+    out in frames (numpy sums down contiguous columns pairwise, and across rows one row at a time).
+
+    :param frames: frames x node, with each segment's frames consecutive and the segments in order (so there are
+    sum(segment_lengths) frames)
+    :param segment_lengths: the number of frames in each segment (which may be 0)
+    :param summaries:
+    :return: summary -> segments x node array (or, for Summary.count, an array of segment lengths).  Summaries of
+    empty segments are NaN.
+    """
+    summaries = set(summaries)
+    segment_lengths = asarray(segment_lengths, dtype=int)
+    n_segments = len(segment_lengths)
+    n_nodes = frames.shape[1]
+
+    # reduceat can't take empty segments, but leaving them out leaves the others' boundaries as they are
+    nonempty = segment_lengths > 0
+    nonempty_lengths = segment_lengths[nonempty]
+    starts = (cumsum(segment_lengths) - segment_lengths)[nonempty]
+
+    def expand(nonempty_values: ndarray) -> ndarray:
+        """Puts values for the non-empty segments back among NaNs for the empty ones."""
+        if nonempty.all():
+            return nonempty_values
+        values = full((n_segments, n_nodes), nan)
+        values[nonempty] = nonempty_values
+        return values
+
+    reduced: Dict[Summary, ndarray] = dict()
+
+    if Summary.count in summaries:
+        reduced[Summary.count] = segment_lengths
+
+    if len(starts) == 0:
+        for summary in summaries - {Summary.count}:
+            reduced[summary] = full((n_segments, n_nodes), nan)
+        return reduced
+
+    if summaries & {Summary.mean, Summary.std}:
+        means = empty((len(starts), n_nodes), dtype=float)
+        for segment_i, (start, length) in enumerate(zip(starts, nonempty_lengths)):
+            means[segment_i] = mean(frames[start:start + length], axis=0)
+        if Summary.mean in summaries:
+            reduced[Summary.mean] = expand(means)
+        if Summary.std in summaries:
+            # Deviations from each segment's own mean, for accuracy
+            deviations = frames - repeat(means, nonempty_lengths, axis=0)
+            reduced[Summary.std] = expand(sqrt(add.reduceat(deviations ** 2, starts, axis=0)
+                                               / nonempty_lengths[:, None]))
+
+    if Summary.min in summaries:
+        reduced[Summary.min] = expand(minimum.reduceat(frames, starts, axis=0).astype(float))
+    if Summary.max in summaries:
+        reduced[Summary.max] = expand(maximum.reduceat(frames, starts, axis=0).astype(float))
+
+    if Summary.median in summaries:
+        reduced[Summary.median] = expand(_segment_medians(frames, starts, nonempty_lengths))
+
+    return reduced
+
+
+def _segment_medians(frames: ndarray, starts: ndarray, lengths: ndarray) -> ndarray:
+    """Medians of non-empty consecutive segments."""
+    longest = lengths.max()
+    if len(starts) * longest <= _MEDIAN_PADDING_LIMIT * lengths.sum():
+        # segments x longest x node, with NaN beyond the end of each segment
+        positions = arange(longest)
+        padded = frames[(starts[:, None] + positions).clip(max=len(frames) - 1)].astype(float)
+        padded[positions[None, :] >= lengths[:, None]] = nan
+        return nanmedian(padded, axis=1)
+    medians = empty((len(starts), frames.shape[1]))
+    for segment_i, (start, length) in enumerate(zip(starts, lengths)):
+        medians[segment_i] = median(frames[start:start + length], axis=0)
+    return medians
+
+
+def reduce_by_label(frames: ndarray, frame_labels: Sequence[Hashable],
+                    summaries: Iterable[Summary] = (Summary.mean,)) -> Tuple[List, Dict[Summary, ndarray]]:
+    """
+    Summarises the frames of a frames x node array with each label, wherever they are.
+
+    Each label's frames are gathered in their original order, so its mean is identical to numpy.mean of
+    frames[labels == label] (summed one row at a time).
+
+    :param frames:
+    :param frame_labels: a label for each frame
+    :param summaries:
+    :return: the labels, in order of first appearance; and summary -> labels x node array (or, for Summary.count, an
+    array of frame counts)
+    """
+    labels = list(dict.fromkeys(frame_labels))
+    label_index = {label: label_i for label_i, label in enumerate(labels)}
+    label_codes = array([label_index[label] for label in frame_labels], dtype=int)
+    # Gathering each label's frames together, in their original order, makes the labels into segments
+    order = argsort(label_codes, kind="stable")
+    return labels, reduce_segments(frames[order], bincount(label_codes, minlength=len(labels)), summaries)
@@ -1,18 +1,86 @@
 from __future__ import annotations
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
+from numpy import ndarray, arange, argsort, array, empty, load, savez, searchsorted
 from pandas import DataFrame
 
 from .matlab_interop import load_matlab_file
 
 
+SEGMENTATION_TABLE_FILE_NAME = "triphone_boundaries.npz"
+SEGMENTATION_MATLAB_FILE_NAME = "triphone_boundaries.mat"
+
+
+@dataclass
+class SegmentationTable:
+    """
+    A columnar table of phonetic segmentations: one row per segment, with all of a word's segments contiguous and in
+    order.
+    """
+    # Names indexed by the code columns
+    words: List[str]
+    phones: List[str]
+    triphones: List[str]
+
+    word_id: ndarray
+    # samples
+    onset: ndarray
+    offset: ndarray
+    phone_code: ndarray
+    # The full recognised label of the segment (a triphone, or e.g. sil), or -1 if not recorded
+    triphone_id: ndarray
+
+    # word -> position in words
+    _word_index: Dict[str, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._word_index = {word: word_i for word_i, word in enumerate(self.words)}
+
+    def __len__(self):
+        return len(self.word_id)
+
+    def word_rows(self, word: str) -> slice:
+        """
+        The rows of a word's segments.
+
+        :raises KeyError: if the word isn't in the table
+        """
+        word_i = self._word_index[word]
+        return slice(*searchsorted(self.word_id, [word_i, word_i + 1]))
+
+    def save(self, path):
+        savez(path,
+              words=array(self.words), phones=array(self.phones), triphones=array(self.triphones),
+              word_id=self.word_id, onset=self.onset, offset=self.offset,
+              phone_code=self.phone_code, triphone_id=self.triphone_id)
+
+    @classmethod
+    def load(cls, path) -> SegmentationTable:
+        with load(path) as saved:
+            return cls(words=saved["words"].tolist(),
+                       phones=saved["phones"].tolist(),
+                       triphones=saved["triphones"].tolist(),
+                       word_id=saved["word_id"], onset=saved["onset"], offset=saved["offset"],
+                       phone_code=saved["phone_code"], triphone_id=saved["triphone_id"])
+
+
 class PhoneSegmentationSet:
     """Represents a full collection of phonetic segmentations for a list of words."""
-    def __init__(self, from_dict: Dict):
+    def __init__(self, segmentation: Dict[str, PhoneSegmentation]):
+        self._segmentation: Dict[str, PhoneSegmentation] = segmentation
+        self._words: List[str] = sorted(segmentation.keys())
+        # When loaded from a SegmentationTable, a word's PhoneSegments are only made when the word is first used
+        self._table: Optional[SegmentationTable] = None
+        # Indexed by the table's phone codes
+        self._table_phones: List[Phone] = []
+
+    @classmethod
+    def from_matlab_dict(cls, from_dict: Dict) -> PhoneSegmentationSet:
         # Extract relevant data from Matlab dict
-        self._segmentation: Dict[str, PhoneSegmentation] = {
+        return cls({
             word: [
                 PhoneSegment(onset_sample=seg[0][0][0],
                              offset_sample=seg[1][0][0],
@@ -21,21 +89,76 @@ class PhoneSegmentationSet:
             ]
             for word in from_dict.keys()
             if "__" not in word
-        }
+        })
+
+    @classmethod
+    def from_table(cls, table: SegmentationTable) -> PhoneSegmentationSet:
+        segmentation_set = cls(dict())
+        segmentation_set._table = table
+        segmentation_set._words = sorted(table.words)
+        segmentation_set._table_phones = [Phone.from_name(name) for name in table.phones]
+        return segmentation_set
 
     def __getitem__(self, key: str):
-        if key not in self.words:
-            raise KeyError(key)
+        if key not in self._segmentation:
+            if self._table is None:
+                raise KeyError(key)
+            rows = self._table.word_rows(key)
+            phones = self._table_phones
+            self._segmentation[key] = [
+                PhoneSegment(onset_sample=onset, offset_sample=offset, label=phones[phone_code])
+                for onset, offset, phone_code in zip(self._table.onset[rows].tolist(),
+                                                     self._table.offset[rows].tolist(),
+                                                     self._table.phone_code[rows].tolist())
+            ]
         return self._segmentation[key]
 
     @property
     def words(self) -> List[str]:
         """Ordered list of words."""
-        return sorted(self._segmentation.keys())
+        return self._words
+
+    def segment_frames(self) -> Tuple[List[str], ndarray, ndarray, List[Phone]]:
+        """
+        The word, onset frame, offset frame and label of every segment, with words in order and each word's segments
+        in order.
+
+        From a SegmentationTable these are worked out column by column, without making a PhoneSegment per segment.
+        """
+        if self._table is None:
+            segments = [(word, segment) for word in self.words for segment in self[word]]
+            return ([word for word, _ in segments],
+                    array([segment.onset_frame for _, segment in segments], dtype=int),
+                    array([segment.offset_frame for _, segment in segments], dtype=int),
+                    [segment.label for _, segment in segments])
+
+        table = self._table
+        # Each word's position in self.words
+        word_order = argsort(array(table.words))
+        word_rank = empty(len(table.words), dtype=int)
+        word_rank[word_order] = arange(len(table.words))
+        # Rows are grouped by word and in order within each word, which a stable sort keeps
+        rows = argsort(word_rank[table.word_id], kind="stable")
+        phones = self._table_phones
+        # As PhoneSegment
+        onset_frames = (table.onset[rows] / PhoneSegment._samples_per_frame).astype(int)
+        offset_frames = (table.offset[rows] / PhoneSegment._samples_per_frame).astype(int)
+        return ([table.words[word_id] for word_id in table.word_id[rows].tolist()],
+                onset_frames, offset_frames,
+                [phones[phone_code] for phone_code in table.phone_code[rows].tolist()])
 
     @classmethod
     def load(cls, from_dir) -> PhoneSegmentationSet:
-        return cls(load_matlab_file(Path(from_dir, "triphone_boundaries.mat")))
+        """
+        Loads the segmentation table from a directory if there is an up-to-date one, else the Matlab file.
+        """
+        table_path = Path(from_dir, SEGMENTATION_TABLE_FILE_NAME)
+        matlab_path = Path(from_dir, SEGMENTATION_MATLAB_FILE_NAME)
+        # A table older than the Matlab file was compiled from an earlier segmentation
+        if table_path.exists() and (not matlab_path.exists()
+                                    or table_path.stat().st_mtime_ns >= matlab_path.stat().st_mtime_ns):
+            return cls.from_table(SegmentationTable.load(table_path))
+        return cls.from_matlab_dict(load_matlab_file(matlab_path))
 
 
 class PhoneSegment:
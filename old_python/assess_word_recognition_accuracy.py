@@ -8,46 +8,217 @@ import re
 import os
 
 import glob
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
+from typing import Dict, List, Optional
 
 import numpy
 import scipy
 import scipy.io
 
 from htk_extraction_tools import *
+from mlf_index import build_mlf_index, rec_lines
+
+use_repository_packages()
+from triphone_boundaries import compile_segmentation_table
+
+
+# Regular expression for a label line which starts a recognised word
+word_guess_re = re.compile((
+	# The onset of the segment
+	r"^(?P<onset>[0-9]+)\s+"
+	# The offset of the segment
+	r"(?P<offset>[0-9]+)\s+"
+	# The tri/phone
+	r"(?P<segment_label>[a-z\+\-]+)\s+"
+	# The log likelihood?
+	r"(?P<log_likelihood>\-?[0-9]+\.[0-9]+)\s"
+	# The word guess
+	r"(?P<word_guess>[A-Z]+).*$"))
+
+# MLF times are in 100ns units, and HTK frames are 10ms
+SAMPLES_PER_FRAME = 100_000
+
+
+@dataclass
+class RecognitionScore:
+	"""
+	How well one decoding run (one MLF) recognised a list of words.
+	"""
+	mlf_path: str
+	word_list: List[str]
+	# For each word in word_list, the words recognised in its utterance (empty if it has none)
+	word_guesses: List[List[str]]
+	# For each word in word_list, whether it was among the words recognised in its utterance
+	correct: numpy.ndarray
+	# Labels for the rows and columns of phone_confusion
+	phones: List[str]
+	# reference phone x recognised phone counts of frames, or None if there was no reference
+	phone_confusion: Optional[numpy.ndarray]
+
+	@property
+	def accuracy(self) -> float:
+		return float(numpy.mean(self.correct)) if len(self.correct) > 0 else numpy.nan
+
+	def save(self, path):
+		numpy.savez(path,
+					word_list=numpy.array(self.word_list),
+					word_guesses=numpy.array([" ".join(guesses) for guesses in self.word_guesses]),
+					correct=self.correct,
+					phones=numpy.array(self.phones),
+					phone_confusion=self.phone_confusion if self.phone_confusion is not None else numpy.zeros((0, 0)))
+
+
+def frame_phone_codes(table, word_i, code_map):
+	"""
+	The phone code of each frame of a word in a SegmentationTable, with -1 for frames in no segment (e.g. sp).
+
+	:param table:
+	:param word_i:
+	:param code_map: maps the table's phone codes into a shared code table
+	"""
+	rows = table.word_id == word_i
+	onset_frames = table.onset[rows] // SAMPLES_PER_FRAME
+	offset_frames = table.offset[rows] // SAMPLES_PER_FRAME
+	durations = numpy.maximum(offset_frames - onset_frames, 0)
+
+	codes = numpy.full(int(offset_frames.max(initial=0)), -1, dtype=numpy.int64)
+	# The frame numbers covered by each segment, all concatenated
+	segment_starts = numpy.cumsum(durations) - durations
+	frames = numpy.repeat(onset_frames, durations) + numpy.arange(durations.sum()) - numpy.repeat(segment_starts, durations)
+	codes[frames] = numpy.repeat(code_map[table.phone_code[rows]], durations)
+	return codes
+
+
+def phone_confusion_matrix(reference_table, recognised_table):
+	"""
+	Counts, over the frames of every word, how often each reference phone was recognised as each phone.
+
+	:param reference_table: a SegmentationTable of the reference transcriptions (e.g. forced alignments)
+	:param recognised_table: a SegmentationTable of the recognised transcriptions, with the same words
+	:return phones, confusion: the phone labels, and the reference phone x recognised phone matrix of frame counts
+	:raise ValueError: if the recognised table is missing any of the reference table's words
+	"""
+	recognised_word_ids = {word: word_i for word_i, word in enumerate(recognised_table.words)}
+	missing_words = [word for word in reference_table.words if word not in recognised_word_ids]
+	if len(missing_words) > 0:
+		raise ValueError("Recognised transcriptions are missing {0} of the reference words: {1}".format(
+			len(missing_words), " ".join(missing_words)))
+
+	phones = sorted(set(reference_table.phones) | set(recognised_table.phones))
+	phone_codes = {phone: code for code, phone in enumerate(phones)}
+	reference_code_map = numpy.array([phone_codes[phone] for phone in reference_table.phones], dtype=numpy.int64)
+	recognised_code_map = numpy.array([phone_codes[phone] for phone in recognised_table.phones], dtype=numpy.int64)
+
+	reference_codes = []
+	recognised_codes = []
+	for word_i, word in enumerate(reference_table.words):
+		reference = frame_phone_codes(reference_table, word_i, reference_code_map)
+		recognised = frame_phone_codes(recognised_table, recognised_word_ids[word], recognised_code_map)
+		n_frames = min(len(reference), len(recognised))
+		both_labelled = (reference[:n_frames] >= 0) & (recognised[:n_frames] >= 0)
+		reference_codes.append(reference[:n_frames][both_labelled])
+		recognised_codes.append(recognised[:n_frames][both_labelled])
+
+	confusion = numpy.bincount(
+		numpy.concatenate(reference_codes + [numpy.zeros(0, dtype=numpy.int64)]) * len(phones)
+		+ numpy.concatenate(recognised_codes + [numpy.zeros(0, dtype=numpy.int64)]),
+		minlength=len(phones) * len(phones)
+	).reshape((len(phones), len(phones)))
+
+	return phones, confusion
+
+
+def score_word_recognition(mlf_path, word_list, reference_mlf_path=None):
+	"""
+	Scores the words recognised in an MLF against the words which were actually spoken.
+
+	A word counts as correct if it's among the words recognised in its utterance.  Words with no utterance in the MLF
+	count as incorrect.
+
+	:param mlf_path:
+	:param word_list:
+	:param reference_mlf_path: an MLF of reference transcriptions for the phone confusion matrix, or None for none
+	:return score: a RecognitionScore
+	"""
+
+	word_list = list(word_list)
+
+	with build_mlf_index(mlf_path) as mlf_index:
+		words_present = [word for word in word_list if word in mlf_index]
+		utterances = dict(mlf_index.iter_utterances(words_present))
+
+		word_guesses = []
+		for word in word_list:
+			guesses = []
+			for line in utterances.get(word, []):
+				line_match = word_guess_re.match(line)
+				if line_match:
+					guesses.append(line_match.group("word_guess"))
+			word_guesses.append(guesses)
+
+		correct = numpy.array([
+			word.lower() in [guess.lower() for guess in guesses]
+			for word, guesses in zip(word_list, word_guesses)
+		], dtype=bool)
+
+		phones = []
+		phone_confusion = None
+		if reference_mlf_path is not None:
+			with build_mlf_index(reference_mlf_path) as reference_index:
+				reference_words = [word for word in words_present if word in reference_index]
+				reference_table = compile_segmentation_table(reference_index, reference_words)
+			recognised_table = compile_segmentation_table(mlf_index, reference_words)
+			phones, phone_confusion = phone_confusion_matrix(reference_table, recognised_table)
+
+	return RecognitionScore(mlf_path=str(mlf_path), word_list=word_list, word_guesses=word_guesses, correct=correct,
+							phones=phones, phone_confusion=phone_confusion)
+
+
+def score_word_recognition_parallel(mlf_paths, word_list, reference_mlf_path=None, max_workers: Optional[int] = None) -> Dict[str, RecognitionScore]:
+	"""
+	As score_word_recognition, for many MLFs (e.g. several systems and decoding configurations) at once, with each MLF
+	scored on a pool of worker processes.
+
+	:param mlf_paths:
+	:param word_list:
+	:param reference_mlf_path:
+	:param max_workers: number of worker processes; defaults to the number of CPUs
+	:return scores: MLF path-keyed dictionary of RecognitionScores, in the order of mlf_paths
+	"""
+	word_list = list(word_list)
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+		futures = [
+			executor.submit(score_word_recognition, mlf_path, word_list, reference_mlf_path)
+			for mlf_path in mlf_paths
+		]
+		return {
+			str(mlf_path): future.result()
+			for mlf_path, future in zip(mlf_paths, futures)
+		}
 
 
 def count_correct_words(input_dir_path, word_list):
 	"""
 	Checks to see which words HTK got right.
-	"""
-	word_guess_re = re.compile((
-		# The onset of the segment
-		r"^(?P<onset>[0-9]+)\s+"
-		# The offset of the segment
-		r"(?P<offset>[0-9]+)\s+"
-		# The tri/phone
-		r"(?P<segment_label>[a-z\+\-]+)\s+"
-		# The log likelihood?
-		r"(?P<log_likelihood>\-?[0-9]+\.[0-9]+)\s"
-		# The word guess
-		r"(?P<word_guess>[A-Z]+).*$"))
 
+	:param input_dir_path: a directory of .rec files split from an MLF by do_split, or an MLFIndex of the MLF itself
+	:param word_list:
+	"""
 	word_count   = 0
 	correct_count = 0
 
 	for word in sorted(word_list):
 		word_count += 1
-		word_file_path = os.path.join(input_dir_path, "{0}.rec".format(word))
-		with open(word_file_path, 'r', encoding='utf-8') as word_file:
-			for line in word_file:
-				line_match = word_guess_re.match(line)
-				if line_match:
-					word_guess = line_match.group("word_guess")
-					guess_correct = word.lower() == word_guess.lower()
-					prints("Guess for \"{0}\":\t{1}\t{2}".format(word, word_guess, "(y)" if guess_correct else "(INCORRECT)"))
-					if guess_correct:
-						correct_count += 1
+		for line in rec_lines(input_dir_path, word):
+			line_match = word_guess_re.match(line)
+			if line_match:
+				word_guess = line_match.group("word_guess")
+				guess_correct = word.lower() == word_guess.lower()
+				prints("Guess for \"{0}\":\t{1}\t{2}".format(word, word_guess, "(y)" if guess_correct else "(INCORRECT)"))
+				if guess_correct:
+					correct_count += 1
 
 	prints("==========")
 	prints("{0} correct guesses out of {1} total. {2}% accurate.".format(correct_count, word_count, (correct_count / word_count) * 100))
@@ -72,10 +243,57 @@ def main():
 	segmentation = count_correct_words(input_dir_path, word_list)
 
 
+def main_batch(argv):
+	"""
+	Scores any number of MLFs in one go.
+
+	python assess_word_recognition_accuracy.py words=<word-list-path> [reference=<reference-mlf-path>]
+		[output=<output-dir>] [workers=<n>] <mlf-path> [<mlf-path> ...]
+
+	:param argv:
+	"""
+	usage_text = (
+		"python assess_word_recognition_accuracy.py "
+		"words=<word-list-path> "
+		"[reference=<reference-mlf-path>] "
+		"[output=<output-dir>] "
+		"[workers=<n>] "
+		"<mlf-path> [<mlf-path> ...]"
+	)
+
+	(switches, parameters, commands) = parse_args(argv[1:])
+
+	word_list_file_path = get_parameter(parameters, "words", True, usage_text)
+	reference_mlf_path = get_parameter(parameters, "reference", usage_text=usage_text) or None
+	output_dir_path = get_parameter(parameters, "output", usage_text=usage_text)
+	workers = get_parameter(parameters, "workers", usage_text=usage_text)
+	mlf_paths = commands
+
+	if len(mlf_paths) == 0:
+		print(usage_text)
+		raise ValueError("Require at least one MLF.")
+
+	word_list = list(get_word_list(word_list_file_path, silent=True))
+
+	scores = score_word_recognition_parallel(mlf_paths, word_list, reference_mlf_path,
+											 max_workers=int(workers) if workers != "" else None)
+
+	for mlf_path, score in scores.items():
+		prints("{0}: {1} correct guesses out of {2} total. {3}% accurate.".format(
+			mlf_path, int(numpy.sum(score.correct)), len(score.correct), score.accuracy * 100))
+		if output_dir_path != "":
+			# e.g. system0-test.mlf, as each system's MLFs tend to share names
+			mlf_dir_path, mlf_file_name = os.path.split(os.path.abspath(mlf_path))
+			mlf_name = "{0}-{1}".format(os.path.basename(mlf_dir_path), os.path.splitext(mlf_file_name)[0])
+			score.save(os.path.join(output_dir_path, "word_recognition-{0}.npz".format(mlf_name)))
+
 
 # Boilerplate
 if __name__ == "__main__":
 
 	# Log to file
 	#with open(get_log_filename(__file__), mode="a", encoding="utf-8") as log_file, RedirectStdoutTo(log_file):
-		main()
+		if len(sys.argv) > 1:
+			main_batch(sys.argv)
+		else:
+			main()
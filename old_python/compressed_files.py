@@ -0,0 +1,74 @@
+"""
+Transparent reading of compressed HTK text dumps.
+
+The HList and HVite dumps are much larger than the data in them, so they are often kept gzip-, xz- or bzip2-compressed.
+Parsers open their inputs with open_dump, which decompresses as it reads.  A path to an uncompressed file which isn't
+there will also find a compressed copy of it, so e.g. "{0}.log" file patterns find "word.log.gz".
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+
+# Suffix -> function for opening files with that compression
+COMPRESSED_OPENERS = {
+	".gz": gzip.open,
+	".xz": lzma.open,
+	".bz2": bz2.open,
+}
+
+
+def resolve_dump_path(file_path) -> str:
+	"""
+	The path of the file to read for file_path: file_path itself if it exists, otherwise a compressed copy of it if
+	there is one.  If there's neither, file_path (so that opening it raises FileNotFoundError as usual).
+
+	:param file_path:
+	"""
+	file_path = str(file_path)
+	if os.path.exists(file_path):
+		return file_path
+	for suffix in COMPRESSED_OPENERS.keys():
+		if os.path.exists(file_path + suffix):
+			return file_path + suffix
+	return file_path
+
+
+def is_compressed(file_path) -> bool:
+	return os.path.splitext(str(file_path))[1] in COMPRESSED_OPENERS
+
+
+def open_dump(file_path, mode: str = "r", encoding: Optional[str] = "utf-8"):
+	"""
+	Opens a text dump for reading, decompressing it on the fly if it's compressed.
+
+	:param file_path: path to the dump, or to the uncompressed version of a compressed dump
+	:param mode: "r" for text or "rb" for bytes
+	:param encoding: for text mode
+	"""
+	file_path = resolve_dump_path(file_path)
+	binary = "b" in mode
+	opener = COMPRESSED_OPENERS.get(os.path.splitext(file_path)[1])
+	if opener is None:
+		return open(file_path, mode="rb" if binary else "r", encoding=None if binary else encoding)
+	return opener(file_path, mode="rb" if binary else "rt", encoding=None if binary else encoding)
+
+
+def parse_files_parallel(parse: Callable, file_paths: List, *args, max_workers: Optional[int] = None) -> List:
+	"""
+	Applies a parser to many files on a pool of worker processes, so that decompressing and parsing different files
+	happen concurrently.
+
+	:param parse: a picklable (i.e. module-level) function taking a file path and then *args
+	:param file_paths:
+	:param args: further arguments passed to each call of parse
+	:param max_workers: number of worker processes; defaults to the number of CPUs
+	:return: the results of parse, in the order of file_paths
+	"""
+	file_paths = list(file_paths)
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+		return list(executor.map(parse, file_paths, *[[arg] * len(file_paths) for arg in args]))
@@ -137,6 +137,16 @@ def get_log_filename(filepath):
     return log_filename
 
 
+def use_repository_packages():
+    """
+    Makes the packages at the root of this repository (e.g. common) importable from scripts which are run from this
+    directory, such as `python ece_extract_filterbank.py`.
+    """
+    repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if repository_root not in sys.path:
+        sys.path.append(repository_root)
+
+
 def prints(*args, sep=' ', end='\n', file=None, flush=False):
     """
     prints(value, ..., sep=' ', end='\n', file=sys.stdout, flush=False)
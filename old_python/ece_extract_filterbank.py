@@ -7,8 +7,13 @@ import re
 import scipy
 import scipy.io
 
+from compressed_files import open_dump, resolve_dump_path
+from extraction_manifest import ExtractionManifest, parse_files_recorded
 from htk_extraction_tools import *
 
+use_repository_packages()
+from common.ragged import RaggedArray
+
 
 def extract_fbanks_from_line(fbank_line):
 	fbanks = fbank_line.strip().split()
@@ -39,7 +44,7 @@ def single_word_fbk(file_path):
 
 	all_fbanks = dict()
 
-	with open(file_path, mode='r', encoding='utf-8') as fbank_file:
+	with open_dump(file_path) as fbank_file:
 
 		for line in fbank_file:
 
@@ -81,17 +86,26 @@ def single_word_fbk(file_path):
 	return all_fbanks, int(current_frame)
 
 
-def pull_fbk_values(in_path, word_list, suffix):
+def pull_fbk_values(in_path, word_list, suffix, max_workers=None, manifest=None):
+	"""
+	:param in_path:
+	:param word_list:
+	:param suffix:
+	:param max_workers: if given, the files are decompressed (if need be) and parsed on a pool of this many worker
+	processes
+	:param manifest: if given, only files which are new or have changed since they were recorded in it are parsed
+	"""
 
 	mfb_dict = dict()
 	min_max = 99999 # a really big number which approximates infinity
 	max_max = -1
 
-	for word in word_list:
+	# Compressed files are recorded in the manifest under their own paths
+	file_paths = [resolve_dump_path(os.path.join(in_path, '{0}.{1}'.format(word, suffix))) for word in word_list]
 
-		file_path = os.path.join(in_path, '{0}.{1}'.format(word, suffix))
+	results = parse_files_recorded(manifest, file_paths, "filterbank", single_word_fbk, max_workers=max_workers)
 
-		fbk_values, last_frame = single_word_fbk(file_path)
+	for word, (fbk_values, last_frame) in zip(word_list, results):
 
 		prints('{0}: \t last frame \t {1}'.format(word, last_frame))
 
@@ -136,6 +150,16 @@ def transform_and_save_all(word_list, mfb_dict, latest_final_frame, out_path):
 			appendmat=True)
 
 
+def save_store(word_list, mfb_dict, out_path):
+	"""
+	Saves all words' filterbank values in one ragged store, with a frames x filterbanks block per word.
+	Returns the store.
+	"""
+	store = RaggedArray.from_frame_dicts(mfb_dict, word_list)
+	store.save(os.path.join(out_path, "fbanks.npz"))
+	return store
+
+
 def main():
 
 	# for ece
@@ -146,17 +170,27 @@ def main():
 	in_path = '/Users/cai/Desktop/scratch/htk_out/filterbank_hlisted'
 	out_path = '/Users/cai/Desktop/scratch/py_out/filterbank'
 
+	# Where parsed files are kept between runs
+	manifest_path = os.path.join(out_path, 'manifest')
+
 	suffix = 'log'
 
+	# Also write the old .mat file per frame
+	per_frame_mat = False
+
 	word_list = get_word_list_from_file_list(in_path, suffix)
 
-	mfb_dict, earliest_final_frame, latest_final_frame = pull_fbk_values(in_path, word_list, suffix)
+	mfb_dict, earliest_final_frame, latest_final_frame = pull_fbk_values(in_path, word_list, suffix,
+																		 manifest=ExtractionManifest(manifest_path))
+
+	store = save_store(word_list, mfb_dict, out_path)
 
-	# for truncating up to earliest final frame
-	#transform_and_save(word_list, mfb_dict, earliest_final_frame, out_path)
+	if per_frame_mat:
+		# for truncating up to earliest final frame
+		#store.export_per_frame_mat(out_path, "fbanks_frame{0:02d}", range(0, earliest_final_frame))
 
-	# for not truncating
-	transform_and_save_all(word_list, mfb_dict, latest_final_frame, out_path)
+		# for not truncating
+		store.export_per_frame_mat(out_path, "fbanks_all_frame{0:02d}", range(0, latest_final_frame))
 
 #region if __name__ == "__main__": ...
 
@@ -8,15 +8,21 @@ import re
 import scipy
 import scipy.io
 
+from compressed_files import open_dump, resolve_dump_path
+from extraction_manifest import ExtractionManifest, parse_recorded
 from htk_extraction_tools import *
 
+use_repository_packages()
+from common.ragged import RaggedArray
 
-def get_activation_lists(input_dir_path, word_list, lines_per_block, suffix):
+
+def get_activation_lists(input_dir_path, word_list, lines_per_block, suffix, manifest=None):
 	"""
 
 	:param input_dir_path:
 	:param word_list:
 	:param lines_per_block: The number of lines in a single block of nodes
+	:param manifest: if given, only logs which are new or have changed since they were recorded in it are parsed
 	:return activations: a word-keyed dictionary of frame-indexed lists of node-indexed lists of activations
 	"""
 
@@ -30,9 +36,12 @@ def get_activation_lists(input_dir_path, word_list, lines_per_block, suffix):
 
 		prints("Getting activations for \"{0}\"".format(word))
 
-		word_file_path = os.path.join(input_dir_path, "{0}.{1}".format(word, suffix))
+		# Compressed logs are recorded in the manifest under their own paths
+		word_file_path = resolve_dump_path(os.path.join(input_dir_path, "{0}.{1}".format(word, suffix)))
 
-		word_activations, last_frame = single_word_activations(word_file_path, lines_per_block)
+		word_activations, last_frame = parse_recorded(manifest, word_file_path,
+													  "activations lines_per_block={0}".format(lines_per_block),
+													  single_word_activations, lines_per_block)
 
 		# htk 0-indexed
 		min_max = min(min_max, last_frame)
@@ -74,7 +83,7 @@ def single_word_activations(word_file_path, lines_per_block):
 	activation_collection = []
 	all_activations = dict()
 
-	with open(word_file_path, 'r', encoding='utf-8') as word_file:
+	with open_dump(word_file_path) as word_file:
 
 		# Read through each line of the file in turn
 		for line in word_file:
@@ -137,6 +146,16 @@ def save_activations(activations, word_list, earliest_final_frame, output_dir_pa
 			appendmat = True)
 
 
+def save_activation_store(activations, word_list, output_dir_path, layer_name):
+	"""
+	Saves all words' activations in one ragged store, with a frames x nodes block per word.
+	Returns the store.
+	"""
+	store = RaggedArray.from_frame_dicts(activations, word_list)
+	store.save(os.path.join(output_dir_path, "{0}_activations.npz".format(layer_name)))
+	return store
+
+
 def comma_separate_list(activation_list):
 	return ','.join([str(activation) for activation in activation_list])
 
@@ -165,17 +184,26 @@ def main():
 	#  3 for a bn layer
 	lines_per_block = 3
 
+	# Also write the old .mat file per frame
+	per_frame_mat = False
+
 	# Define some paths
 	input_path      = os.path.join('/Users', 'cai', 'Desktop', 'ece_scratch', 'htk_out', 'ece_{0}_log'.format(layer_name))
 	output_path     = os.path.join('/Users', 'cai', 'Desktop', 'ece_scratch', 'py_out', 'ece_dnn_activations')
+	# Where parsed logs are kept between runs
+	manifest_path   = os.path.join(output_path, 'manifest')
 
 	# Get the words from the words file
 	suffix = 'mlp.txt'
 	word_list = get_word_list_from_file_list(input_path, suffix)
 
-	activations, earliest_final_frame = get_activation_lists(input_path, word_list, lines_per_block, suffix)
+	activations, earliest_final_frame = get_activation_lists(input_path, word_list, lines_per_block, suffix,
+															 manifest=ExtractionManifest(manifest_path))
+
+	store = save_activation_store(activations, word_list, output_path, layer_name)
 
-	save_activations(activations, word_list, earliest_final_frame, output_path, layer_name)
+	if per_frame_mat:
+		store.export_per_frame_mat(output_path, layer_name + "_activations_frame{0:02d}", range(0, earliest_final_frame))
 
 	transform_to_flat_files(activations, word_list, earliest_final_frame, output_path, layer_name)
 
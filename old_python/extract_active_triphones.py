@@ -4,12 +4,19 @@ Extract some cepstral coefficients from HTK's output file.
 """
 
 import re
+from dataclasses import dataclass, field
+from typing import Dict, List
 
 import numpy
 import scipy
 import scipy.io
+import scipy.sparse
 
+from compressed_files import open_dump
+from extraction_manifest import ExtractionManifest
 from htk_extraction_tools import *
+from hvite_traces import read_recorded_triphone_likelihood_table
+from triphone_vocabulary import TriphoneVocabulary
 
 
 def get_triphone_lists(input_filename, frame_cap, silent):
@@ -43,7 +50,7 @@ def get_triphone_lists(input_filename, frame_cap, silent):
         prints("Getting triphone lists from {0}...".format(input_filename))
 
     # Start reading from the input file
-    with open(input_filename, encoding="utf-8") as input_file:
+    with open_dump(input_filename) as input_file:
         # Go through the file line by line
         for line in input_file:
             word_path_match = word_path_re.match(line)
@@ -132,16 +139,50 @@ def process_args(switches, parameters, commands):
 
     frame_cap = get_parameter(parameters, "frames", usage_text=usage_text)
 
+    # Where parsed traces are kept between runs
+    manifest_dir = get_parameter(parameters, "manifest", usage_text=usage_text)
+    manifest_dir = manifest_dir if manifest_dir != "" else os.path.join(output_dir, "manifest")
+
     extant_triphones = "extant-triphones" in commands
 
     # set defaults
     frame_cap = frame_cap if frame_cap != "" else 20 # default of 20
 
-    return silent, log, input_filename, output_dir, wordlist_filename, frame_cap, extant_triphones
+    return silent, log, input_filename, output_dir, wordlist_filename, frame_cap, manifest_dir, extant_triphones
+
+
+
+def active_triphone_entries(table, word_list, vocabulary, frame_cap):
+    """
+    Picks out the active triphones for each word in word_list from frame 2
+    up to frame_cap, keeping only triphones in the vocabulary, and with
+    duplicates within a frame removed.
+
+    Returns three aligned arrays: the position of the word in word_list,
+    the frame position counting from frame 2 (which has position 0), and
+    the vocabulary id of the triphone.
+
+    :param table: a hvite_traces.TriphoneLikelihoodTable
+    :param word_list:
+    :param vocabulary:
+    :param frame_cap:
+    """
+    word_rows = table.word_positions(word_list)[table.word_index]
+    # In the transcript from HVite, the first frame is numbered "frame 1"
+    # and it is apparently constrained to be silence.  There are only
+    # active triphones from frame 2 onwards.
+    frame_rows = table.frame.astype(numpy.int64) - 2
+    triphone_ids = vocabulary.ids_in_table(table)
+
+    wanted = ((word_rows >= 0)
+              & (frame_rows >= 0) & (frame_rows < int(frame_cap) - 1)
+              & (triphone_ids >= 0))
 
+    entries = numpy.unique(numpy.stack([word_rows[wanted], frame_rows[wanted], triphone_ids[wanted]]), axis=1)
+    return entries[0], entries[1], entries[2]
 
 
-def apply_triphone_count_model(words_data, word_list, phone_list, frame_cap, silent):
+def apply_triphone_count_model(table, word_list, vocabulary, phone_list, frame_cap, silent):
     """
     The active triphone count model will be calculated as follows.
 
@@ -152,56 +193,91 @@ def apply_triphone_count_model(words_data, word_list, phone_list, frame_cap, sil
     So to be returned is a phone-keyed dictionary of word-keyed dictionary of
     frame-indexed count vertors.
 
+    :param table: a hvite_traces.TriphoneLikelihoodTable
+    :param vocabulary:
     :param phone_list:
     :param silent:
     :param frame_cap:
     :param word_list:
-    :param words_data:
     """
 
     if not silent:
         prints("Applying active triphone model...")
 
-    # Prepare the dictionary
-    phones_data = dict()
-    for phone in phone_list:
-        phones_data[phone] = dict()
-        for word in word_list:
-            # The first frame is ignored, because there are only active
-            # triphones from the second frame (the first is apparently
-            # constrained to be silence).  So we subtract 1.
-            phones_data[phone][word] = zeros(int(frame_cap) - 1)
-
-    # Now we go through each word in turn
-    for word in word_list:
-
-        # In the transcript from HVite, the first frame is numbered "frame 1"
-        # and it is apparently constrained to be silence.  There are only
-        # active triphones from frame 2 onwards.
-        # So, we start at 2 (because that's where the data is) and we add 1
-        # (because the frames are 1-indexed).
-        for frame in range(2, int(frame_cap) + 1):
-            frame_id = str(frame)
-
-            triphone_list = words_data[word][frame_id]
-
-            for triphone in triphone_list:
-                # Ignore empty triphones and triphones presented in isolation
-                if triphone == '' or triphone == 'sil' or triphone == 'sp':
-                    continue
+    word_list = list(word_list)
+    # The first frame is ignored, because there are only active triphones
+    # from the second frame (the first is apparently constrained to be
+    # silence).  So we subtract 1.
+    n_frames = int(frame_cap) - 1
 
-                phone_triplet = triphone_to_phone_triplet(triphone)
+    word_rows, frame_rows, triphone_ids = active_triphone_entries(table, word_list, vocabulary, frame_cap)
 
-                if len(phone_triplet) != 3:
-                    raise ApplicationError("word:{0} triphone:{1}, frame_id:{2}".format(word, triphone, frame_id))
+    # phone x word x frame counts, all at once
+    centre_phones = vocabulary.centre[triphone_ids]
+    counts = numpy.bincount(
+        numpy.ravel_multi_index((centre_phones, word_rows, frame_rows),
+                                (len(vocabulary.phones), len(word_list), n_frames)),
+        minlength=len(vocabulary.phones) * len(word_list) * n_frames
+    ).reshape((len(vocabulary.phones), len(word_list), n_frames))
 
-                # increment the count for the center phone
-                phones_data[phone_triplet[1]][word][frame-2] += 1
+    # Float count vectors for every phone, so that every phone's .mat file holds doubles
+    phone_rows = {phone: phone_i for phone_i, phone in enumerate(vocabulary.phones)}
+    phones_data = dict()
+    for phone in phone_list:
+        phones_data[phone] = dict()
+        phone_i = phone_rows.get(phone)
+        for word_i, word in enumerate(word_list):
+            if phone_i is not None:
+                phones_data[phone][word] = counts[phone_i, word_i, :].astype(float)
+            else:
+                phones_data[phone][word] = numpy.zeros(n_frames)
 
     return phones_data
 
 
-def apply_triphone_vector_model(words_data, word_list, list_of_extant_triphones, frame_cap, silent):
+@dataclass
+class ActiveTriphoneVectorModel:
+    """
+    The active triphone vector model, stored sparsely.
+
+    For each phone there is a boolean CSR matrix with one row for each
+    frame of each word (word-major, so word i's frames are rows
+    i * n_frames to (i + 1) * n_frames), and one column for each extant
+    triphone with that centre phone.
+    """
+    word_list: List[str]
+    n_frames: int
+    phone_matrices: Dict[str, scipy.sparse.csr_matrix]
+    # word -> position in word_list
+    _word_index: Dict[str, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._word_index = {word: word_i for word_i, word in enumerate(self.word_list)}
+
+    def keys(self):
+        return self.phone_matrices.keys()
+
+    def word_frames(self, phone, word):
+        """
+        A dense frame-by-triphone array of the active triphones for one
+        word, as the model used to store it.
+        """
+        word_i = self._word_index[word]
+        rows = self.phone_matrices[phone][word_i * self.n_frames:(word_i + 1) * self.n_frames]
+        return rows.toarray().astype(float)
+
+    def word_dictionary(self, phone):
+        """
+        A word-keyed dictionary of dense frame-by-triphone arrays for one
+        phone, which is what save_features writes to each .mat file.
+        """
+        return {
+            word: self.word_frames(phone, word)
+            for word in self.word_list
+        }
+
+
+def apply_triphone_vector_model(table, word_list, vocabulary, frame_cap, silent):
     """
     The active triphone vector model will be calculated as follows.
 
@@ -210,14 +286,14 @@ def apply_triphone_vector_model(words_data, word_list, list_of_extant_triphones,
       active triphones with the current phone as the centre phone.  Only
       triphones which are ever present will be considered.
 
-    So to be returned is a phone-keyed dictionary of word-keyed dictionaries of
-    frame-by-triphone binary arrays.
+    So to be returned is an ActiveTriphoneVectorModel, with a sparse
+    (word, frame)-by-triphone binary matrix for each phone.
 
-    :param list_of_extant_triphones:
+    :param table: a hvite_traces.TriphoneLikelihoodTable
+    :param vocabulary: the extant triphones
     :param silent:
     :param frame_cap:
     :param word_list:
-    :param words_data:
     """
 
     # We will specifically ignore some of the phones, as we know there is not
@@ -274,97 +350,55 @@ def apply_triphone_vector_model(words_data, word_list, list_of_extant_triphones,
     if not silent:
         prints("Applying active triphone model...")
 
-    triphones_per_phone = deal_triphones_by_phone(list_of_extant_triphones)
-
-    # Prepare the dictionary
-    phones_data = dict()
-
-    for phone in PHONE_LIST:
-
-        # Add the key to the dictionary
-        phones_data[phone] = dict()
-
-        for word in word_list:
-            # Initialise the data for this phone with a frames-by-triphones matrix.
-            # These matrices will be different sizes for each word.
-            # We subtract 1 from the frames because there are only active triphones
-            # in the second frame (the first is apparently constrained to be silence.
-
-            # First make a 2-d list as appropriate
-            phones_data[phone][word] = numpy.zeros((int(frame_cap) - 1, len(triphones_per_phone[phone])))
-
-    # Now that we've preallocated, we go through each word in turn
-    for word in word_list:
+    word_list = list(word_list)
+    # We subtract 1 from the frames because there are only active
+    # triphones in the second frame (the first is apparently constrained
+    # to be silence.
+    n_frames = int(frame_cap) - 1
 
-        # In the transcript from HVite, the first frame is numbered "frame 1"
-        # and it is apparently constrained to be silence.  There are only
-        # active triphones from frame 2 onwards.
-        # So, we start at 2 (because that's where the data is) and we add 1
-        # (because the frames are 1-indexed).
-        for frame in range(2, int(frame_cap) + 1):
-            frame_id = str(frame)
+    word_rows, frame_rows, triphone_ids = active_triphone_entries(table, word_list, vocabulary, frame_cap)
 
-            # The list of triphones for this word this frame
-            triphone_list = words_data[word][frame_id]
+    # One (word, frame)-by-triphone matrix over the whole vocabulary, in
+    # which active triphones get a 1.  It's column-compressed, so because
+    # each phone's triphones are a contiguous range of ids, each phone's
+    # block of columns can be cut out without looking at any other phone's
+    # entries.
+    all_phones = scipy.sparse.csc_matrix(
+        (numpy.ones(len(triphone_ids), dtype=bool), (word_rows * n_frames + frame_rows, triphone_ids)),
+        shape=(len(word_list) * n_frames, len(vocabulary)))
 
-            for phone in PHONE_LIST:
-
-                # For each possible triphone containing this phone...
-                for triphone_i in range(0, len(triphones_per_phone[phone])):
-                    triphone = triphones_per_phone[phone][triphone_i]
+    phone_matrices = dict()
+    for phone in PHONE_LIST:
+        # A triphone's column is its position in the phone's id range.
+        phone_ids = vocabulary.ids_for_phone(phone)
+        phone_matrices[phone] = all_phones[:, phone_ids.start:phone_ids.stop].tocsr()
 
-                    # ...if it's active for this frame for this word...
-                    if triphone in triphone_list:
-                        # ...we give it a 1...
-                        phones_data[phone][word][frame-2][triphone_i] = 1
-                        # ...otherwise it stays a 0
+    return ActiveTriphoneVectorModel(word_list=word_list, n_frames=n_frames, phone_matrices=phone_matrices)
 
-    return phones_data
 
-
-def look_for_extant_triphones(words_data, word_list, frame_cap, silent):
+def look_for_extant_triphones(table, word_list, frame_cap, silent):
     """
+    Finds the triphones which are active for any of the words at any frame
+    from 2 up to the frame cap.
 
-    :param words_data:
+    :param table: a hvite_traces.TriphoneLikelihoodTable
     :param word_list:
     :param frame_cap:
     :param silent:
-    :return: :raise ApplicationError:
+    :return vocabulary: a TriphoneVocabulary of the extant triphones
     """
 
     if not silent:
         prints("Counting extant triphones...")
 
-    # I guess lazy instantiation wasn't so smart :[
-    local_word_list_copy = list(word_list)
-
-    # We'll use a set so we can just add new items without checking if they're already there each time
-    list_of_extant_triphones = set()
-
-    # Now we go through each word in turn
-    for word in local_word_list_copy:
-
-        if not silent:
-            prints("Processing {0}".format(word))
-
-        # In the transcript from HVite, the first frame is numbered "frame 1"
-        # and it is apparently constrained to be silence.  There are only
-        # active triphones from frame 2 onwards.
-        # So, we start at 2 (because that's where the data is) and we add 1
-        # (because the frames are 1-indexed).
-        for frame in range(2, int(frame_cap) + 1):
-            frame_id = str(frame)
-
-            triphone_list = words_data[word][frame_id]
-
-            for triphone in triphone_list:
-                # We don't care about some of them.
-                # todo: this particular couple of lines is repeated rather a lot
-                if triphone == '' or triphone == 'sil' or triphone == 'sp':
-                    continue
-                list_of_extant_triphones.add(triphone)
+    # In the transcript from HVite, the first frame is numbered "frame 1"
+    # and it is apparently constrained to be silence.  There are only
+    # active triphones from frame 2 onwards.
+    word_rows = table.word_positions(list(word_list))[table.word_index]
+    wanted = (word_rows >= 0) & (table.frame >= 2) & (table.frame <= int(frame_cap))
 
-    return list(list_of_extant_triphones)
+    # sil, sp etc. are dropped by the vocabulary
+    return TriphoneVocabulary(table.triphones[i] for i in numpy.unique(table.triphone_id[wanted]))
 
 
 def save_features(phones_data, output_dir, silent):
@@ -380,7 +414,12 @@ def save_features(phones_data, output_dir, silent):
         prints("Saving features to {0}".format(output_dir))
 
     for phone in phones_data.keys():
-        this_phone_data = phones_data[phone]
+        # The sparse model is saved as dense per-word arrays, so that the
+        # Matlab scripts can still load each phone's file as before
+        if isinstance(phones_data, ActiveTriphoneVectorModel):
+            this_phone_data = phones_data.word_dictionary(phone)
+        else:
+            this_phone_data = phones_data[phone]
         scipy.io.savemat("{1}active_triphone_model-{0}".format(phone, output_dir), this_phone_data, appendmat=True)
 
 
@@ -391,25 +430,26 @@ def main(argv):
     """
 
     (switches, parameters, commands) = parse_args(argv)
-    (silent, log, input_filename, output_dir, wordlist_filename, frame_cap, extant_triphones) = process_args(switches, parameters, commands)
+    (silent, log, input_filename, output_dir, wordlist_filename, frame_cap, manifest_dir, extant_triphones) = process_args(switches, parameters, commands)
 
     if not silent:
         prints("==================")
 
     word_list = list(get_word_list(wordlist_filename, silent))
-    word_data = get_triphone_lists(input_filename, frame_cap, silent)
+    table = read_recorded_triphone_likelihood_table(input_filename, frame_cap, silent,
+                                                    ExtractionManifest(manifest_dir))
 
-    list_of_extant_triphones = look_for_extant_triphones(word_data, word_list, frame_cap, silent)
+    vocabulary = look_for_extant_triphones(table, word_list, frame_cap, silent)
 
     # Different commands for different analyses
     if extant_triphones:
         if not silent:
             prints("Listing extant triphones:")
-            for triphone in list_of_extant_triphones:
+            for triphone in vocabulary.triphones:
                 prints("\t{0}".format(triphone))
     else:
-        #phones_data = apply_triphone_count_model(word_data, word_list, phone_list, frame_cap, silent)
-        phones_data = apply_triphone_vector_model(word_data, word_list, list_of_extant_triphones, frame_cap, silent)
+        #phones_data = apply_triphone_count_model(table, word_list, vocabulary, phone_list, frame_cap, silent)
+        phones_data = apply_triphone_vector_model(table, word_list, vocabulary, frame_cap, silent)
         save_features(phones_data, output_dir, silent)
 
     if not silent:
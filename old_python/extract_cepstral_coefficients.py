@@ -3,11 +3,168 @@
 Extract some cepstral coefficients from HTK's output file.
 """
 
+import hashlib
 import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy
 import scipy
 import scipy.io
 
+from compressed_files import open_dump, resolve_dump_path
 from cw_common import *
+from extraction_manifest import ExtractionManifest, parse_recorded
+
+
+# The order in which HList lists the coefficients of each frame: C01 to C12 then C00, and the same for the deltas (D)
+# and accelerations (A).
+COEFFICIENT_TYPES = "CDA"
+COEFFICIENT_INDICES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 0]
+COEFFICIENT_NAMES = ["{0}{1:02d}".format(coeff_type, i) for coeff_type in COEFFICIENT_TYPES for i in COEFFICIENT_INDICES]
+N_COEFFICIENTS = len(COEFFICIENT_NAMES)
+
+# Regular expression for name of a word
+_word_name_re = re.compile(r"^-+ Source: (?P<wordname>[a-z]+)\.wav -+$")
+
+# Regular expression for the start of a frame vector line
+_frame_vector_start_re = re.compile(r"^[0-9]+:")
+
+
+def coefficient_column(coeff_type, coeff_index):
+    """
+    The column of a coefficient in each frame vector.
+
+    :param coeff_type: "C", "D" or "A"
+    :param coeff_index: 0 to 12
+    """
+    return (COEFFICIENT_TYPES.index(coeff_type) * len(COEFFICIENT_INDICES)
+            + COEFFICIENT_INDICES.index(int(coeff_index)))
+
+
+@dataclass
+class CepstralCoefficients:
+    """
+    The cepstral coefficients of a list of words, as a words x frames x coefficients array.
+
+    Coefficients are in HList's order (see COEFFICIENT_NAMES), and frames which aren't in a word's dump (including
+    all frames of words which aren't in the dump at all) are NaN.
+    """
+    word_list: List[str]
+    values: numpy.ndarray
+
+    def columns(self, c_list, d_list, a_list):
+        """
+        The columns of the requested C, D and A coefficients, in that order.
+        """
+        return ([coefficient_column("C", c) for c in c_list]
+                + [coefficient_column("D", d) for d in d_list]
+                + [coefficient_column("A", a) for a in a_list])
+
+    def select(self, c_list, d_list, a_list):
+        """
+        A words x frames x coefficients array of only the requested C, D and A coefficients, in that order.
+        """
+        return self.values[:, :, self.columns(c_list, d_list, a_list)]
+
+    def as_coefficient_dictionaries(self, c_list, d_list, a_list):
+        """
+        The requested coefficients as a coefficient_id-keyed dictionary of word-keyed dictionaries of frame-indexed
+        arrays of coefficient values, as returned by filter_coefficients_from_htk.
+        """
+        coeffs = dict()
+        for column in self.columns(c_list, d_list, a_list):
+            coeffs[COEFFICIENT_NAMES[column]] = {
+                word: self.values[word_i, :, column]
+                for word_i, word in enumerate(self.word_list)
+            }
+        return coeffs
+
+    def save(self, path):
+        numpy.savez(path, word_list=numpy.array(self.word_list), values=self.values)
+
+    @classmethod
+    def load(cls, path) -> "CepstralCoefficients":
+        with numpy.load(path) as saved:
+            return cls(word_list=saved["word_list"].tolist(), values=saved["values"])
+
+
+def read_cepstral_coefficients(input_filename, word_list, frame_cap, silent) -> CepstralCoefficients:
+    """
+    Reads the coefficients of the words in word_list from an HList dump, for frames before frame_cap.
+
+    Each word's frame vector lines are converted to numbers in one go, rather than matched line by line.
+
+    :param input_filename:
+    :param word_list:
+    :param frame_cap:
+    :param silent:
+    """
+
+    word_list = list(word_list)
+    frame_cap = int(frame_cap)
+    word_positions = {word: word_i for word_i, word in enumerate(word_list)}
+
+    values = numpy.full((len(word_list), frame_cap, N_COEFFICIENTS), numpy.nan, dtype=numpy.float32)
+
+    def store_word(word, frame_lines):
+        if word not in word_positions or not frame_lines:
+            return
+        # Each line is "<frame_id>: <39 values>", so with the colon gone it's 40 numbers
+        numbers = numpy.fromstring(" ".join(frame_lines).replace(":", " "), dtype=numpy.float64, sep=" ")
+        if numbers.size != len(frame_lines) * (N_COEFFICIENTS + 1):
+            raise ValueError("Frame vectors for '{0}' in {1} don't all have {2} coefficients".format(
+                word, input_filename, N_COEFFICIENTS))
+        frame_vectors = numbers.reshape((len(frame_lines), N_COEFFICIENTS + 1))
+        frames = frame_vectors[:, 0].astype(int)
+        in_cap = frames < frame_cap
+        values[word_positions[word], frames[in_cap], :] = frame_vectors[in_cap, 1:]
+
+    this_word = None
+    this_word_frame_lines = []
+
+    with open_dump(input_filename) as input_file:
+        for line in input_file:
+            word_name_match = _word_name_re.match(line)
+
+            if word_name_match:
+                store_word(this_word, this_word_frame_lines)
+                this_word = word_name_match.group('wordname')
+                this_word_frame_lines = []
+                if not silent:
+                    prints(this_word)
+
+            # We only need the lines of words we're interested in
+            elif this_word in word_positions and _frame_vector_start_re.match(line):
+                this_word_frame_lines.append(line)
+
+    store_word(this_word, this_word_frame_lines)
+
+    return CepstralCoefficients(word_list=word_list, values=values)
+
+
+def read_recorded_cepstral_coefficients(input_filename, word_list, frame_cap, silent,
+                                        manifest: Optional[ExtractionManifest]) -> CepstralCoefficients:
+    """
+    As read_cepstral_coefficients, but the dump is only read if it's new or has changed since it was recorded in the
+    manifest for the same words and frame cap.
+
+    :param input_filename:
+    :param word_list:
+    :param frame_cap:
+    :param silent:
+    :param manifest: if None, the dump is always read
+    """
+    word_list = list(word_list)
+    settings = "cepstral coefficients frame_cap={0} words={1}".format(
+        int(frame_cap), hashlib.sha1("\n".join(word_list).encode("utf-8")).hexdigest())
+
+    def read_values(source_path):
+        # Only the array is recorded, as the word list is part of the settings
+        return read_cepstral_coefficients(source_path, word_list, frame_cap, silent).values
+
+    values = parse_recorded(manifest, resolve_dump_path(input_filename), settings, read_values)
+    return CepstralCoefficients(word_list=word_list, values=values)
 
 
 def filter_coefficients_from_htk(input_filename, word_list, c_list, d_list, a_list, frame_cap, silent):
@@ -92,7 +249,7 @@ def filter_coefficients_from_htk(input_filename, word_list, c_list, d_list, a_li
     this_word = None
 
     # Start reading from the input file
-    with open(input_filename, encoding="utf-8") as input_file:
+    with open_dump(input_filename) as input_file:
         for line in input_file:
             word_name_match = word_name_re.match(line)
             frame_vector_match = frame_vector_re.match(line)
@@ -125,6 +282,16 @@ def filter_coefficients_from_htk(input_filename, word_list, c_list, d_list, a_li
                     coeffs[coeff_name][this_word][frame] = float(this_coeff)
     return coeffs
 
+def save_coefficients(output_dirname, coefficients: CepstralCoefficients):
+    """
+    Saves all the coefficients of all the words as a single array in the specified output directory.
+
+    :param output_dirname:
+    :param coefficients:
+    """
+    coefficients.save(os.path.join(output_dirname, "cepstral-coefficients.npz"))
+
+
 def transform_and_save(output_dirname, coeffs):
     """
     Saves in the specified output directory a words-keyed struct of frame-indexed lists of coefficients for each
@@ -169,7 +336,9 @@ def process_args(switches, parameters, commands):
         "C=<CC-list> "
         "D=<DC-list> "
         "A=<AC-list> "
-        "frames=<frames|27>"
+        "frames=<frames|27> "
+        "[manifest=<manifest-dir|output-path/manifest>] "
+        "[export-mat]"
     )
 
     silent = "S" in switches
@@ -201,7 +370,15 @@ def process_args(switches, parameters, commands):
     # set defaults
     frame_cap = frame_cap if frame_cap != "" else 27 # default of 27
 
-    return silent, input_filename, output_dirname, words_filename, c_list, d_list, a_list, frame_cap
+    # Where parsed dumps are kept between runs
+    manifest_dirname = get_parameter(parameters, "manifest", usage_text=usage_text)
+    manifest_dirname = manifest_dirname if manifest_dirname != "" else os.path.join(output_dirname, "manifest")
+
+    # Also write a .mat file for each coefficient, as the Matlab scripts expect
+    export_mat = "export-mat" in commands
+
+    return (silent, input_filename, output_dirname, words_filename, c_list, d_list, a_list, frame_cap, manifest_dirname,
+            export_mat)
 
 
 def main(argv):
@@ -210,10 +387,13 @@ def main(argv):
     :param argv:
     """
     (switches, parameters, commands) = parse_args(argv)
-    (silent, input_filename, output_dirname, words_filename, c_list, d_list, a_list, frames) = process_args(switches, parameters, commands)
+    (silent, input_filename, output_dirname, words_filename, c_list, d_list, a_list, frames, manifest_dirname, export_mat) = process_args(switches, parameters, commands)
     word_list = get_words(words_filename)
-    coeffs = filter_coefficients_from_htk(input_filename, word_list, c_list, d_list, a_list, frames, silent)
-    transform_and_save(output_dirname, coeffs)
+    coefficients = read_recorded_cepstral_coefficients(input_filename, word_list, frames, silent,
+                                                       ExtractionManifest(manifest_dirname))
+    save_coefficients(output_dirname, coefficients)
+    if export_mat:
+        transform_and_save(output_dirname, coefficients.as_coefficient_dictionaries(c_list, d_list, a_list))
 
 #region if __name__ == "__main__": ...
 
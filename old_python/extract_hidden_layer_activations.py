@@ -4,46 +4,44 @@ Extract hidden layer activations from HTK's output file.
 
 import re
 import sys
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from math import ceil
 from os import path
 
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Deque, List, Optional, Tuple
 
 import numpy
 import scipy
 import scipy.io
 
-from old_python.cw_common import prints
-from old_python.htk_extraction_tools import get_word_list
+from compressed_files import open_dump, resolve_dump_path
+from cw_common import prints
+from extraction_manifest import ExtractionManifest, parse_files_recorded, parse_fingerprinted
+from frame_index import build_frame_index, last_frame_id, load_frame_index
+from htk_extraction_tools import get_word_list
 
 
-def get_min_frame_index(input_dir_path, word_list):
+def get_min_frame_index(input_dir_path, word_list, lines_per_block: Optional[int] = None):
 	"""
 	Gets the smallest final frame index amongst all word in the list.
+	Where a log has an up-to-date sidecar frame index, the final frame is read from that; otherwise only the end of
+	the log is read (all of it, if it's compressed).
 	:param input_dir_path:
 	:param word_list:
+	:param lines_per_block: The number of lines in a single block of nodes, which sidecar indices are built for.  If
+	                        not given, sidecars aren't used.
 	:return total_fram_min: the smallest final-frame inde in any word
 	"""
 
-	# Regular expression for frame and list of node activations
-	frame_data_1_re = re.compile((
-		# The frame number
-		r"(?P<frame_id>[0-9]+):\s+"
-		# The list of activation values
-		r"(?P<activation_list_1>(?:-?[0-9]+\.?[0-9]+\s*)+)$"))
-
 	total_frame_min = sys.maxsize
 	for word in word_list:
-		current_word_frame_max = 0
 		word_file_path = path.join(input_dir_path, "{0}.log".format(word))
-		with open(word_file_path, 'r', encoding='utf-8') as word_file:
-			for line in word_file:
-				frame_data_1_match = frame_data_1_re.match(line)
-				if frame_data_1_match:
-					current_word_frame_max = int(frame_data_1_match.group("frame_id"))
-		total_frame_min = min(total_frame_min, current_word_frame_max)
+		index = load_frame_index(word_file_path, lines_per_block, build=False) if lines_per_block is not None else None
+		word_last_frame = index.last_frame_id if index is not None else last_frame_id(word_file_path)
+		total_frame_min = min(total_frame_min, word_last_frame)
 
 	return total_frame_min
 
@@ -92,7 +90,7 @@ def get_activation_lists(input_path, word_list, frame_cap: Optional[int], lines_
 		word_activations = []
 
 		word_file_path = input_path.format(word)
-		with open(word_file_path, 'r', encoding='utf-8') as word_file:
+		with open_dump(word_file_path) as word_file:
 
 			# Read through each line of the file in turn
 			for line in word_file:
@@ -151,6 +149,89 @@ def get_activation_lists(input_path, word_list, frame_cap: Optional[int], lines_
 	return activations
 
 
+def single_word_activation_array(word_file_path, frame_cap: Optional[int], lines_per_block,
+								 use_index: bool = True) -> numpy.ndarray:
+	"""
+	Reads a single word's HList log in one go.
+
+	Blocks are located from the "N:" frame markers and the positions of newlines, and all of the numeric text is then
+	converted to a (frames x nodes) array in a single numpy call.
+
+	The block positions are saved in a sidecar frame index the first time a log is read.  When there is an up-to-date
+	index, only the part of the file up to the frame cap is read.
+
+	:param word_file_path:
+	:param frame_cap: As for get_activation_lists: frames with index greater than frame_cap are dropped.  None or 0 for
+	                  no cap.
+	:param lines_per_block: The number of lines in a single block of nodes
+	:param use_index: whether to use (and build) the sidecar frame index
+	:return activations: frames x nodes array of activations
+	"""
+
+	# The log may be compressed, in which case the index is of its decompressed text
+	word_file_path = resolve_dump_path(word_file_path)
+
+	index = load_frame_index(word_file_path, lines_per_block, build=False) if use_index else None
+
+	if index is not None:
+		n_frames = index.n_frames_up_to(frame_cap)
+		with open_dump(word_file_path, 'rb') as word_file:
+			data = word_file.read(index.block_ends[n_frames - 1] if n_frames > 0 else 0)
+	else:
+		with open_dump(word_file_path, 'rb') as word_file:
+			data = word_file.read()
+		index = build_frame_index(word_file_path, lines_per_block, data=data, save=use_index)
+		n_frames = index.n_frames_up_to(frame_cap)
+
+	if n_frames == 0:
+		return numpy.empty((0, 0))
+
+	# Everything after each "N:" up to the end of its block
+	numeric_text = b" ".join(data[data_start:block_end]
+							 for data_start, block_end in zip(index.data_starts[:n_frames], index.block_ends[:n_frames]))
+	values = numpy.fromstring(numeric_text, dtype=float, sep=" ")
+
+	if len(values) % n_frames != 0:
+		raise ValueError("{0}: {1} values can't be split evenly into {2} frames".format(
+			word_file_path, len(values), n_frames))
+
+	return values.reshape((n_frames, len(values) // n_frames))
+
+
+def activation_parse_settings(frame_cap: Optional[int], lines_per_block) -> str:
+	"""The parse settings under which an activation log's parsed array is recorded in an ExtractionManifest."""
+	return "activations frame_cap={0} lines_per_block={1}".format(frame_cap or 0, lines_per_block)
+
+
+def get_activation_arrays(input_path, word_list, frame_cap: Optional[int], lines_per_block,
+						  manifest: Optional[ExtractionManifest] = None, max_workers: Optional[int] = None):
+	"""
+	Vectorised alternative to get_activation_lists, with the same arguments.
+
+	Logs may be compressed (see compressed_files).
+
+	:param input_path:
+	:param word_list:
+	:param frame_cap:
+	:param lines_per_block: The number of lines in a single block of nodes
+	:param manifest: if given, only logs which are new or have changed since they were recorded in it are parsed
+	:param max_workers: if given, logs are decompressed and parsed on a pool of this many worker processes
+	:return activations: a word-keyed dictionary of frames x nodes arrays of activations
+	"""
+
+	# Compressed logs are recorded in the manifest under their own paths
+	word_file_paths = [resolve_dump_path(input_path.format(word)) for word in word_list]
+
+	if max_workers is not None:
+		prints("Getting activations for {0} words on {1} processes".format(len(word_list), max_workers))
+	else:
+		prints("Getting activations for {0} words".format(len(word_list)))
+	parsed = parse_files_recorded(manifest, word_file_paths, activation_parse_settings(frame_cap, lines_per_block),
+								  single_word_activation_array, frame_cap, lines_per_block, max_workers=max_workers)
+
+	return dict(zip(word_list, parsed))
+
+
 def save_activations(activations, output_dir_path, layer_name):
 	"""
 	Saves mat files for the activations
@@ -180,84 +261,161 @@ class Layer:
 		return ceil(self.nodes / nodes_per_line)
 
 
+ROOT = Path("/Users/cai/Dox/Academic/Analyses/Lexpro/DNN mapping")
+
+# Where the parsed logs are kept between runs
+MANIFEST_DIR = Path(ROOT, "extracted activations mat files", "manifest")
+
+SETTINGS = {
+	"system0": {
+		# Original setup
+		"dir": Path(ROOT, "network output", "system0"),
+		"file pattern": "{0}.log",
+		"layers": {
+			"filterbank_hlisted":   Layer(dirname="filterbank_hlisted",   nodes=720),  # Input layer
+			"hidden_layer_2_log":   Layer(dirname="hidden_layer_2_log",   nodes=1000),
+			"hidden_layer_3_log":   Layer(dirname="hidden_layer_3_log",   nodes=1000),
+			"hidden_layer_4_log":   Layer(dirname="hidden_layer_4_log",   nodes=1000),
+			"hidden_layer_5_log":   Layer(dirname="hidden_layer_5_log",   nodes=1000),
+			"hidden_layer_6_log":   Layer(dirname="hidden_layer_6_log",   nodes=1000),
+			"hidden_layer_7BN_log": Layer(dirname="hidden_layer_7BN_log", nodes=26),  # Previous to output layer
+		}
+	},
+	"system3": {
+		"dir": Path(ROOT, "network output", "system3"),
+		"file pattern": "{0}.txt",
+		"layers": {
+			"hmm0": Layer(dirname="hmm0", nodes=1000),  # First hidden layer
+			"hmm1": Layer(dirname="hmm1", nodes=1000),
+			"hmm2": Layer(dirname="hmm2", nodes=1000),
+			"hmm3": Layer(dirname="hmm3", nodes=1000),
+			"hmm4": Layer(dirname="hmm4", nodes=26),
+			"hmm5": Layer(dirname="hmm5", nodes=200),  # Previous to output layer
+		}
+	},
+	"system4": {
+		"dir": Path(ROOT, "network output", "system4"),
+		"file pattern": "{0}.txt",
+		"layers": {
+			"hmm0": Layer(dirname="hmm0", nodes=1000),  # First hidden layer
+			"hmm1": Layer(dirname="hmm1", nodes=1000),
+			"hmm2": Layer(dirname="hmm2", nodes=1000),
+			"hmm3": Layer(dirname="hmm3", nodes=26),
+			"hmm4": Layer(dirname="hmm4", nodes=350),
+			"hmm5": Layer(dirname="hmm5", nodes=350),  # Previous to output layer
+		}
+	},
+	"system5": {
+		"dir": Path(ROOT, "network output", "system5"),
+		"file pattern": "{0}.txt",
+		"layers": {
+			"hmm0": Layer(dirname="hmm0", nodes=1000),  # First hidden layer
+			"hmm1": Layer(dirname="hmm1", nodes=1000),
+			"hmm2": Layer(dirname="hmm2", nodes=26),
+			"hmm3": Layer(dirname="hmm3", nodes=460),
+			"hmm4": Layer(dirname="hmm4", nodes=460),
+			"hmm5": Layer(dirname="hmm5", nodes=460),  # Previous to output layer
+		}
+	},
+}
+
+
 def main(system_name, layer_name):
 	"""
 	Do dat analysis.
 	"""
 
-	root = Path("/Users/cai/Dox/Academic/Analyses/Lexpro/DNN mapping")
-
-	settings = {
-		"system0": {
-			# Original setup
-			"dir": Path(root, "network output", "system0"),
-			"file pattern": "{0}.log",
-			"layers": {
-				"filterbank_hlisted":   Layer(dirname="filterbank_hlisted",   nodes=720),  # Input layer
-				"hidden_layer_2_log":   Layer(dirname="hidden_layer_2_log",   nodes=1000),
-				"hidden_layer_3_log":   Layer(dirname="hidden_layer_3_log",   nodes=1000),
-				"hidden_layer_4_log":   Layer(dirname="hidden_layer_4_log",   nodes=1000),
-				"hidden_layer_5_log":   Layer(dirname="hidden_layer_5_log",   nodes=1000),
-				"hidden_layer_6_log":   Layer(dirname="hidden_layer_6_log",   nodes=1000),
-				"hidden_layer_7BN_log": Layer(dirname="hidden_layer_7BN_log", nodes=26),  # Previous to output layer
-			}
-		},
-		"system3": {
-			"dir": Path(root, "network output", "system3"),
-			"file pattern": "{0}.txt",
-			"layers": {
-				"hmm0": Layer(dirname="hmm0", nodes=1000),  # First hidden layer
-				"hmm1": Layer(dirname="hmm1", nodes=1000),
-				"hmm2": Layer(dirname="hmm2", nodes=1000),
-				"hmm3": Layer(dirname="hmm3", nodes=1000),
-				"hmm4": Layer(dirname="hmm4", nodes=26),
-				"hmm5": Layer(dirname="hmm5", nodes=200),  # Previous to output layer
-			}
-		},
-		"system4": {
-			"dir": Path(root, "network output", "system4"),
-			"file pattern": "{0}.txt",
-			"layers": {
-				"hmm0": Layer(dirname="hmm0", nodes=1000),  # First hidden layer
-				"hmm1": Layer(dirname="hmm1", nodes=1000),
-				"hmm2": Layer(dirname="hmm2", nodes=1000),
-				"hmm3": Layer(dirname="hmm3", nodes=26),
-				"hmm4": Layer(dirname="hmm4", nodes=350),
-				"hmm5": Layer(dirname="hmm5", nodes=350),  # Previous to output layer
-			}
-		},
-		"system5": {
-			"dir": Path(root, "network output", "system5"),
-			"file pattern": "{0}.txt",
-			"layers": {
-				"hmm0": Layer(dirname="hmm0", nodes=1000),  # First hidden layer
-				"hmm1": Layer(dirname="hmm1", nodes=1000),
-				"hmm2": Layer(dirname="hmm2", nodes=26),
-				"hmm3": Layer(dirname="hmm3", nodes=460),
-				"hmm4": Layer(dirname="hmm4", nodes=460),
-				"hmm5": Layer(dirname="hmm5", nodes=460),  # Previous to output layer
-			}
-		},
-	}
-
 	# Define some paths
-	output_dir_path = Path(root, 'extracted activations mat files', system_name)
-	word_list_file_path = Path(root, "stimulus wordlist.txt")
+	output_dir_path = Path(ROOT, 'extracted activations mat files', system_name)
+	word_list_file_path = Path(ROOT, "stimulus wordlist.txt")
 
-	system = settings[system_name]
+	system = SETTINGS[system_name]
 	layer = system["layers"][layer_name]
 
 	# Get the words from the words file
 	word_list = list(get_word_list(word_list_file_path))
 
-	activations = get_activation_lists(input_path=str(Path(system["dir"], layer.dirname, system["file pattern"])),
-									   word_list=word_list, frame_cap=None,
-									   lines_per_block=layer.lines_per_block)
+	activations = get_activation_arrays(input_path=str(Path(system["dir"], layer.dirname, system["file pattern"])),
+										word_list=word_list, frame_cap=None,
+										lines_per_block=layer.lines_per_block,
+										manifest=ExtractionManifest(MANIFEST_DIR))
 
 	save_activations(activations, output_dir_path, layer_name)
 
 
+def main_parallel(system_names: List[str], layer_names: List[str], max_workers: Optional[int] = None,
+				  max_layers_in_flight: int = 2):
+	"""
+	As main, for every combination of system and layer, with the words parsed in parallel.
+
+	Every (system, layer, word) file is parsed as a separate task on a pool of worker processes.  Results are
+	collected back in word order, and each layer is saved once, as soon as all of its words are in.
+
+	Layers are submitted a few at a time, so the pool stays busy across layer boundaries while only the layers in
+	flight are held in memory.
+
+	Logs which haven't changed since they were last parsed are taken from the manifest instead, and each parsed log is
+	recorded as soon as it's done, so an interrupted run picks up where it stopped.
+
+	:param system_names:
+	:param layer_names:
+	:param max_workers: number of worker processes; defaults to the number of CPUs
+	:param max_layers_in_flight: number of layers submitted to the pool but not yet saved
+	"""
+
+	word_list = list(get_word_list(Path(ROOT, "stimulus wordlist.txt")))
+	manifest = ExtractionManifest(MANIFEST_DIR)
+
+	def record_when_done(word_file_path, settings):
+		def record(future: Future):
+			if future.exception() is None:
+				source_fingerprint, word_activations = future.result()
+				manifest.record(word_file_path, settings, word_activations, source_fingerprint)
+		return record
+
+	def submit_layer(executor: ProcessPoolExecutor, system_name: str, layer_name: str) -> List[Future]:
+		"""Word-ordered futures for a layer, each giving a (fingerprint, activations) pair."""
+		system = SETTINGS[system_name]
+		layer = system["layers"][layer_name]
+		input_path = str(Path(system["dir"], layer.dirname, system["file pattern"]))
+		settings = activation_parse_settings(None, layer.lines_per_block)
+		layer_futures = []
+		for word in word_list:
+			word_file_path = resolve_dump_path(input_path.format(word))
+			recorded = manifest.lookup(word_file_path, settings)
+			if recorded is not None:
+				future = Future()
+				future.set_result((None, recorded))
+			else:
+				# Hashed on the worker, alongside the parse
+				future = executor.submit(parse_fingerprinted, word_file_path,
+										 single_word_activation_array, None, layer.lines_per_block)
+				future.add_done_callback(record_when_done(word_file_path, settings))
+			layer_futures.append(future)
+		return layer_futures
+
+	def save_layer(system_name: str, layer_name: str, layer_futures: List[Future]):
+		activations = {
+			word: future.result()[1]
+			for word, future in zip(word_list, layer_futures)
+		}
+		prints("Saving {0} {1}".format(system_name, layer_name))
+		save_activations(activations, Path(ROOT, 'extracted activations mat files', system_name), layer_name)
+
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+		# (system, layer, word-ordered futures) submitted but not yet saved, oldest first.
+		# Each layer's futures are dropped once it's saved, so that its arrays can be freed.
+		in_flight: Deque[Tuple[str, str, List[Future]]] = deque()
+		for system_name in system_names:
+			for layer_name in layer_names:
+				in_flight.append((system_name, layer_name, submit_layer(executor, system_name, layer_name)))
+				if len(in_flight) >= max_layers_in_flight:
+					save_layer(*in_flight.popleft())
+		while in_flight:
+			save_layer(*in_flight.popleft())
+
+
 if __name__ == "__main__":
-	for s in [4, 5]:
-		for l in [0, 1, 2, 3, 4, 5]:
-			main(system_name=f"system{s}", layer_name=f"hmm{l}")
+	main_parallel(system_names=[f"system{s}" for s in [4, 5]],
+				  layer_names=[f"hmm{l}" for l in [0, 1, 2, 3, 4, 5]])
@@ -3,138 +3,25 @@
 Extract some triphone probabilities from HTK's output file.
 """
 
-import re
 import numpy
 import scipy
 import scipy.io
 
+from extraction_manifest import ExtractionManifest
 from htk_extraction_tools import *
+from hvite_traces import (TriphoneLikelihoodTable, iter_frame_likelihoods,
+						  read_recorded_triphone_likelihood_table)
+from triphone_vocabulary import TriphoneVocabulary
 
+use_repository_packages()
+from common.ragged import RaggedArray
 
-def split_probability_triphone_pair(ptp):
-	"""
-	Splits a string like "-1.398829e+02|sil-b+ia" into a pair
-	[-139.8829, "sil-b-ia"].
-	:param ptp:
-	:return:
-	"""
-	pair = ptp.split("|")
-	triphone = pair[1]
-	probability = float(pair[0])
-	return [triphone, probability]
-
-
-def get_triphone_probability_lists(input_filename, frame_cap, silent):
-	"""
-	Want to return a word-keyed dictionary of frame_id-keyed dictionaries
-	of triphone-keyed dicttionaries of likelihood values.
-
-	A triphone looks like xx-xx+xx.
-
-	Expect this to be working on the output of the new version of `HVite`.
-	On a file called something like `hv.trace`.
-
-	:param input_filename:
-	:param frame_cap:
-	:param silent:
-	"""
-
-	# Regular expression for the path of a word
-	word_path_re = re.compile(r"^File: (?P<word_path>.+)\.mfc$")
-	word_path_re_dnn = re.compile(r"^File: (?P<word_path>.+)\.fbk$")
 
-	# Regular expression for frame and list of active triphones
-	frame_data_re = re.compile((
-		r"Activated phone models for frame "
-		# The frame number
-		r"(?P<frame_id>[0-9]+) "
-		# The count in parentheses (we don't care about this)
-		r"\([0-9]+\) : "
-		# The list of triphone-probability pairs
-		r"(?P<triphone_probability_pair_list>.+)$"))
+# All words' likelihoods in one store, rather than a .mat file per frame
+LIKELIHOOD_STORE_FILE_NAME = "triphone_likelihoods.npz"
 
-	triphone_probability_lists = dict()
-
-	# None value will be replaced by each word as it is read from the input stream
-	current_word = None
-
-	current_word_data = dict()
-
-	if not silent:
-		prints("Getting triphone probability vectors from {0}...".format(input_filename))
-
-	# Start reading from the input file
-	with open(input_filename, encoding="utf-8") as input_file:
-		# Go through the file line by line
-		for line in input_file:
-			word_path_match = word_path_re_dnn.match(line)
-			frame_data_match = frame_data_re.match(line)
-
-			# So what's up with this line we've just read?
-
-			if word_path_match:
-				# We've matched a new word path.
-				# My regular expression wasn't smart enough to get the
-				# actual word out, so we can do that here.
-				word_path = word_path_match.group('word_path')
-				word_file = word_path.split('/')[-1]
-				word_name = word_file.split('.')[0]
-
-				# If there is already a previous word being remembered, we
-				# want to store all the appropriate data before we start
-				# on a new word
-				if current_word is not None:
-					triphone_probability_lists[current_word] = current_word_data
-
-				# Now that everything we were trying to remember is written
-				# down, we can start a new page
-				current_word = word_name
-				current_word_data = dict()
-
-				# Feedback
-				if not silent:
-					prints("Getting triphone lists for '{0}'...".format(word_name))
-
-			elif frame_data_match:
-				# We've matched the list of active triphones for a given
-				# frame.
-				frame_id = frame_data_match.group('frame_id')
-
-				# If the frame_id we've extracted is larger than our
-				# user-specified cap, we can skip this one.
-				# Frames from HVite are 1-indexed.
-				if int(frame_id) > int(frame_cap):
-					continue
-
-				# Otherwise continue to break down the list of triphones
-				# which my regular expression wasn't smart enough to get
-				# individually
-				triphones = frame_data_match.group('triphone_probability_pair_list').split(' ')
-
-				# Filter out any empty ones which may have crept in from
-				# splitting on the space.
-				triphones = list(filter(
-					lambda t: t != "",
-					triphones))
-
-				triphone_probability_pairs = list(map(
-					split_probability_triphone_pair,
-					triphones))
-
-				# We add what we've got to the current word's data
-				current_word_data[frame_id] = dict()
-				for tpp in triphone_probability_pairs:
-					# dict entry is keyed by a triphone, and the value is the
-					# likelihood.
-					current_word_data[frame_id][tpp[0]] = tpp[1]
-
-	# When the file is over, we just have to store the last word's data and
-	# we're done
-	triphone_probability_lists[current_word] = current_word_data
-	if not silent:
-		print("") # For the newline
-
-	return triphone_probability_lists
+# The number of set bits in each possible byte
+_bit_counts = numpy.array([bin(byte).count("1") for byte in range(256)], dtype=numpy.int64)
 
 
 # noinspection PyUnusedLocal
@@ -160,152 +47,144 @@ def process_args(switches, parameters, commands):
 
 	frame_cap = get_parameter(parameters, "frames", usage_text=usage_text)
 
+	# Where parsed traces are kept between runs
+	manifest_dir = get_parameter(parameters, "manifest", usage_text=usage_text)
+	manifest_dir = manifest_dir if manifest_dir != "" else os.path.join(output_dir, "manifest")
+
 	# set defaults
 	frame_cap = frame_cap if frame_cap != "" else 20 # default of 20
 
-	return silent, log, input_filename, output_dir, wordlist_filename, frame_cap
+	# Also write a .mat file for each frame, as the Matlab scripts expect
+	export_mat = "export-mat" in commands
 
+	return silent, log, input_filename, output_dir, wordlist_filename, frame_cap, manifest_dir, export_mat
 
-def apply_triphone_probability_model(triphone_probability_lists, word_list, PHONE_LIST, used_triphones_overall, frame_cap, silent):
-	"""
-	The active triphone vector model will be calculated as follows.
-
-	- There will be one model for each phone.
-	- The models will give, for each frame and each words, a vector of the
-	  active triphone probabilities, for triphones with the current phone
-	  as the centre phone.  Only triphones which are present for every word in
-	each frame will be considered.
 
-	So to be returned is a frame_id-keyed dictionary of phone-keyed dictionaries
-	of word-by-triphone probability matrices.
+def triphone_likelihood_store(table: TriphoneLikelihoodTable, word_list, used_triphones_overall, frame_cap, silent) -> RaggedArray:
+	"""
+	The triphone likelihoods of each word in frames 2 to frame_cap, as one frames x triphones block per word in a single
+	ragged store.  Columns are the used triphones grouped by centre phone (as TriphoneVocabulary orders them), and
+	triphones which aren't active for a word in a frame are NaN.
 
+	:param table: a hvite_traces.TriphoneLikelihoodTable
+	:param word_list:
 	:param used_triphones_overall:
-	:param PHONE_LIST:
-	:param silent:
 	:param frame_cap:
-	:param word_list:
-	:param triphone_probability_lists:
+	:param silent:
 	"""
 
-	triphones_per_phone = deal_triphones_by_phone(used_triphones_overall)
+	word_list = list(word_list)
+	vocabulary = TriphoneVocabulary(used_triphones_overall)
 
-	# In the transcript from HVite, the first frame is numbered "frame 1"
-	# and it is apparently constrained to be silence.  There are only
-	# active triphones from frame 2 onwards.
-	# So, we start at 2 (because that's where the data is) and we add 1
-	# (because the frames are 1-indexed).
-	likelihood_data = dict()
-	for frame in irange(2, int(frame_cap)):
-		frame_id = str(frame)
+	# Frames are 1-indexed, and the first is constrained to be silence
+	frames = list(irange(2, int(frame_cap)))
 
+	# Word-major, so each word's frames are a contiguous block
+	data = numpy.full((len(word_list), len(frames), len(vocabulary)), numpy.nan)
+	for frame, likelihoods in iter_frame_likelihoods(table, word_list, frames, vocabulary.triphones):
 		if not silent:
 			prints('Applying triphone probability model in frame {0}...'.format(frame))
+		data[:, frame - 2, :] = likelihoods
 
-		likelihood_data[frame_id] = dict()
-
-		for phone in triphones_per_phone.keys():
-
-			triphones_this_phone = triphones_per_phone[phone]
-
-			# We pre-fill everything with nans, which can be treated as missing
-			# data if it doesn't get covered up by real numbers
-			likelihood_data[frame_id][phone] = numpy.empty((
-				len(word_list),
-				len(triphones_this_phone)))
-			likelihood_data[frame_id][phone][:] = numpy.nan
+	return RaggedArray(
+		words=word_list,
+		data=data.reshape((len(word_list) * len(frames), len(vocabulary))),
+		offsets=numpy.arange(len(word_list) + 1) * len(frames),
+		first_frame=2,
+		column_labels=list(vocabulary.triphones))
 
-			for word_i in range(0, len(word_list)):
-				word = word_list[word_i]
 
-				for triphone_i in range(0, len(triphones_this_phone)):
-					triphone = triphones_this_phone[triphone_i]
-
-					# See if there is likelihood data for this word and phone
-					# at this frame.
-					triphone_likelihood = triphone_probability_lists[word][frame_id].get(triphone, None)
-
-					if triphone_likelihood is not None:
-						likelihood_data[frame_id][phone][word_i][triphone_i] = triphone_likelihood
+def likelihood_data_from_store(store: RaggedArray):
+	"""
+	Splits a store from triphone_likelihood_store into a frame_id-keyed dictionary of phone-keyed dictionaries of
+	word-by-triphone probability matrices, as save_features writes.
 
+	:param store:
+	"""
+	vocabulary = TriphoneVocabulary(store.column_labels)
+	likelihood_data = dict()
+	for frame in store.frame_ids:
+		_, likelihoods = store.frame_matrix(frame)
+		likelihood_data[str(frame)] = {
+			phone: likelihoods[:, start:stop]
+			for phone, (start, stop) in vocabulary.centre_ranges.items()
+		}
 	return likelihood_data
 
 
-def which_triphones_are_used(triphone_probability_lists, word_list, frame_cap, output_dir, silent):
+def which_triphones_are_used(table: TriphoneLikelihoodTable, word_list, frame_cap, output_dir, silent):
 	"""
 We want probability feature vectors.  Therefore, we need to ensure that we are
 looking in a common set of triphones for each pair of words for each frame.
 
-This function will return a frame_id-keyed dictionary lists of triphones.
+Each word's active triphones in a frame are a bitset over the vocabulary of
+triphones in the trace, so intersecting them down the word list is a
+cumulative bitwise and, and one pass does all the words of a frame.
 
 	:param output_dir:
-	:param triphone_probability_lists:
+	:param table: a hvite_traces.TriphoneLikelihoodTable
 	:param word_list:
 	:param frame_cap:
 	:param silent:
-	:return: :raise ApplicationError:
+	:return triphone_counts, used_triphones_overall: the words x frames array of
+	the number of triphones common to each word and all the words before it, and
+	the list of triphones ever common to any run of words.
 	"""
 
 	# I guess lazy instantiation wasn't so smart :[
 	local_word_list = list(word_list)
 
+	# sil, sp etc. are left out of the vocabulary
+	vocabulary = TriphoneVocabulary(table.triphones)
+	word_rows = table.word_positions(local_word_list)[table.word_index]
+	triphone_ids = vocabulary.ids_in_table(table)
+	wanted = (word_rows >= 0) & (triphone_ids >= 0)
+
+	# Bit i of a bitset is bit (7 - i % 8) of byte i // 8, as for numpy.packbits
+	n_bytes = (len(vocabulary) + 7) // 8
+	bitset_bytes = triphone_ids >> 3
+	bitset_bits = (0x80 >> (triphone_ids & 7)).astype(numpy.uint8)
+
 	# We will record used triphones per frame in each word.
 	# It will be a n_frames x n_words array of counts.
 	triphone_counts = numpy.zeros((len(local_word_list), int(frame_cap)))
 
-	used_triphones_overall = set()
+	used_triphones_overall = numpy.zeros(n_bytes, dtype=numpy.uint8)
 
 	# In the transcript from HVite, the first frame is numbered
 	# "frame 1" and it is apparently constrained to be silence.
 	# There are only active triphones from frame 2 onwards.
-	# So, we start at 2 (because that's where the data is) and we add 1
-	# (because the frames are 1-indexed).
 	for frame in irange(2, int(frame_cap)):
-		frame_id = str(frame)
 
 		if not silent:
-			prints("Looking for triphones used in frame {0}...".format(frame_id))
-
-		triphone_list_this_word = None
-
-		# Now we go through each word in turn.
+			prints("Looking for triphones used in frame {0}...".format(frame))
 
-		# We count the words for purposes of indexing.
-		word_i = 0
+		# One bitset of active triphones per word
+		in_frame = wanted & (table.frame == frame)
+		bitsets = numpy.zeros((len(local_word_list), n_bytes), dtype=numpy.uint8)
+		numpy.bitwise_or.at(bitsets, (word_rows[in_frame], bitset_bytes[in_frame]), bitset_bits[in_frame])
 
-		for word in local_word_list:
-			word_i += 1
+		# Row i is the triphones common to ALL of the first i+1 words
+		common_triphones = numpy.bitwise_and.accumulate(bitsets, axis=0)
 
-			triphones = list(triphone_probability_lists[word][frame_id].keys())
-			triphones = filter(
-				lambda triphone: triphone != '' and triphone != 'sil' and triphone != 'sp',
-				triphones)
+		used_triphones_overall |= numpy.bitwise_or.reduce(common_triphones, axis=0)
 
-			# For the first word, we will just take the list of triphones as is
-			if triphone_list_this_word is None:
-				triphone_list_this_word = list(triphones)
-			# For the rest of the words we will intersect the list of triphones
-			# so that by the end of it we only have triphones common to ALL
-			# words.
-			else:
-				triphone_list_this_word = list(set(triphone_list_this_word).intersection(set(triphones)))
+		# -1 to convert 1-indexed frames to 0-indexed array.
+		triphone_counts[:, frame-1] = _bit_counts[common_triphones].sum(axis=1)
 
-			used_triphones_overall = list(set(used_triphones_overall).union(set(triphone_list_this_word)))
-
-			# -1 to conver 1-indexed words and frames to 0-indexed array.
-			triphone_counts[word_i-1, frame-1] = len(triphone_list_this_word)
-
-		# Need to wrap the array in a dictionary in order to save it.
-		scipy.io.savemat(
-			os.path.join(
-				output_dir,
-				"used_triphones"),
-			# savemat requires a dictionary here
-			{
-				"triphone_counts": triphone_counts
-			},
-			appendmat=True)
+	# Need to wrap the array in a dictionary in order to save it.
+	scipy.io.savemat(
+		os.path.join(
+			output_dir,
+			"used_triphones"),
+		# savemat requires a dictionary here
+		{
+			"triphone_counts": triphone_counts
+		},
+		appendmat=True)
 
-	return triphone_counts, used_triphones_overall
+	used_ids = numpy.flatnonzero(numpy.unpackbits(used_triphones_overall)[:len(vocabulary)])
+	return triphone_counts, [vocabulary.triphones[i] for i in used_ids]
 
 
 def save_features(likelihood_data, output_dir, frame_cap, silent=False):
@@ -332,31 +211,29 @@ def save_features(likelihood_data, output_dir, frame_cap, silent=False):
 			appendmat=True)
 
 
-def show_average_triphone_counts(triphone_probability_lists, word_list, frame_cap):
+def show_average_triphone_counts(table: TriphoneLikelihoodTable, word_list, frame_cap):
 	"""
 	Shows the averge-over-words number of triphones available per frame.
 	:param word_list:
-	:param triphone_probability_lists: a word-keyed dictionary of frame_id-keyed dictionaries of triphone-keyed dicttionaries of likelihood values.
+	:param table: a hvite_traces.TriphoneLikelihoodTable
 	:param frame_cap:
 	:return:
 	"""
+	word_rows = table.word_positions(list(word_list))[table.word_index]
 	for frame in irange(2, int(frame_cap)):
-		frame_id = str(frame)
-		total_triphone_count = 0
-		for word in word_list:
-			triphones_this_word = list(triphone_probability_lists[word][frame_id].keys())
-			triphone_count_this_word = len(triphones_this_word)
-			total_triphone_count += triphone_count_this_word
-		average_triphone_count = total_triphone_count / len(word_list)
+		in_frame = (word_rows >= 0) & (table.frame == frame)
+		# Each triphone is only counted once per word
+		word_triphone_pairs = numpy.unique(numpy.stack([word_rows[in_frame], table.triphone_id[in_frame]]), axis=1)
+		average_triphone_count = word_triphone_pairs.shape[1] / len(word_list)
 		prints("The average number of triphones active in frame {0:02d} is {1}.".format(frame, average_triphone_count))
 
 
-def save_features_ungrouped(triphone_probability_lists, used_triphones_overall, word_list, output_dir, frame_cap, silent=False):
+def save_features_ungrouped(table: TriphoneLikelihoodTable, used_triphones_overall, word_list, output_dir, frame_cap, silent=False):
 	"""
 	Saves the data in a Matlab-readable format.
 	This will be a phone-keyed dictionary of
 	:param used_triphones_overall:
-	:param triphone_probability_lists:
+	:param table: a hvite_traces.TriphoneLikelihoodTable
 	:param output_dir:
 	:param frame_cap:
 	:param silent:
@@ -365,31 +242,20 @@ def save_features_ungrouped(triphone_probability_lists, used_triphones_overall,
 	if not silent:
 		prints("Saving triphone likelihood estimates to {0}".format(output_dir))
 
+	word_list = list(word_list)
 	n_triphones = len(used_triphones_overall)
 
-	all_data = dict()
-
-	for word in word_list:
-
-		# Preallocate
-		data_this_word    = numpy.empty((frame_cap-1, n_triphones))
-		data_this_word[:] = numpy.nan
-
-		for frame in irange(2, int(frame_cap)):
-			frame_id = str(frame)
-
-			triphone_i = 0
-			for triphone in used_triphones_overall:
+	# Preallocate
+	all_data = {
+		word: numpy.empty((frame_cap-1, n_triphones))
+		for word in word_list
+	}
 
-				# Check if this triphone is even present here.
-				if triphone in triphone_probability_lists[word][frame_id]:
-					data_this_word[frame-2, triphone_i] = triphone_probability_lists[word][frame_id][triphone]
-				else:
-					data_this_word[frame-2, triphone_i] = 0
-
-				triphone_i += 1
-
-		all_data[word] = data_this_word
+	# Triphones which aren't present in a frame get a 0
+	frames = list(irange(2, int(frame_cap)))
+	for frame, likelihoods in iter_frame_likelihoods(table, word_list, frames, used_triphones_overall, fill_value=0):
+		for word_i, word in enumerate(word_list):
+			all_data[word][frame-2, :] = likelihoods[word_i, :]
 
 	scipy.io.savemat(
 		os.path.join(
@@ -410,6 +276,7 @@ def main_ungrouped():
 	input_filename = "/Users/cai/Desktop/scratch/htk_out/triphone_likelihoods/dnn_test_10k_prune.log"
 	frame_cap = 27
 	output_dir = "/Users/cai/Desktop/scratch/py_out/triphone_likelihoods"
+	manifest_dir = os.path.join(output_dir, "manifest")
 
 
 	if not silent:
@@ -417,11 +284,11 @@ def main_ungrouped():
 
 	word_list = list(get_word_list(wordlist_filename, silent))
 
-	triphone_probability_lists = get_triphone_probability_lists(input_filename, frame_cap, silent)
+	table = read_recorded_triphone_likelihood_table(input_filename, frame_cap, silent, ExtractionManifest(manifest_dir))
 
-	triphone_count_by_frame, used_triphones_overall = which_triphones_are_used(triphone_probability_lists, word_list, frame_cap, output_dir, silent)
+	triphone_count_by_frame, used_triphones_overall = which_triphones_are_used(table, word_list, frame_cap, output_dir, silent)
 
-	save_features_ungrouped(triphone_probability_lists, used_triphones_overall, word_list, output_dir, frame_cap, silent)
+	save_features_ungrouped(table, used_triphones_overall, word_list, output_dir, frame_cap, silent)
 
 	if not silent:
 		prints("==== DONE! =======")
@@ -484,76 +351,27 @@ def main(argv):
 	#    "zh",
 	]
 	#endregion
-	#region PHONE_LIST_DNN = [ ... ]
-	PHONE_LIST_DNN = [
-		#"sil",
-		"aa",
-		"ae",
-		"ah",
-		"ao",
-		"aw",
-		"ax",
-		"ay",
-		"b",
-		"ch",
-		"d",
-		"dh",
-		"ea",
-		"eh",
-		"el",
-		"em",
-		"en",
-		"er",
-		"ey",
-		"f",
-		"g",
-		"hh",
-		"ia",
-		"ih",
-		"iy",
-		"jh",
-		"k",
-		"l",
-		"m",
-		"n",
-		"ng",
-		"oh",
-		"ow",
-		"oy",
-		"p",
-		"r",
-		"s",
-		"sh",
-		"t",
-		"th",
-		"ua",
-		"uh",
-		"uw",
-		"v",
-		"w",
-		"y",
-		"z",
-		"zh",
-	]
-	#endregion
 
 	(switches, parameters, commands) = parse_args(argv)
-	(silent, log, input_filename, output_dir, wordlist_filename, frame_cap) = process_args(switches, parameters, commands)
+	(silent, log, input_filename, output_dir, wordlist_filename, frame_cap, manifest_dir, export_mat) = process_args(switches, parameters, commands)
 
 	if not silent:
 		prints("==================")
 
 	word_list = list(get_word_list(wordlist_filename, silent))
 
-	triphone_probability_lists = get_triphone_probability_lists(input_filename, frame_cap, silent)
+	table = read_recorded_triphone_likelihood_table(input_filename, frame_cap, silent, ExtractionManifest(manifest_dir))
+
+	show_average_triphone_counts(table, word_list, frame_cap)
 
-	show_average_triphone_counts(triphone_probability_lists, word_list, frame_cap)
+	triphone_count_by_frame, used_triphones_overall = which_triphones_are_used(table, word_list, frame_cap, output_dir, silent)
 
-	triphone_count_by_frame, used_triphones_overall = which_triphones_are_used(triphone_probability_lists, word_list, frame_cap, output_dir, silent)
+	likelihood_store = triphone_likelihood_store(table, word_list, used_triphones_overall, frame_cap, silent)
 
-	likelihood_data = apply_triphone_probability_model(triphone_probability_lists, word_list, PHONE_LIST_DNN,  used_triphones_overall, frame_cap, silent)
+	likelihood_store.save(os.path.join(output_dir, LIKELIHOOD_STORE_FILE_NAME))
 
-	save_features(likelihood_data, output_dir, frame_cap, silent)
+	if export_mat:
+		save_features(likelihood_data_from_store(likelihood_store), output_dir, frame_cap, silent)
 
 	if not silent:
 		prints("==== DONE! =======")
@@ -0,0 +1,227 @@
+"""
+A manifest of parsed word files, so that extractions only re-parse files which are new or have changed.
+
+For each source file parsed with some settings, the manifest records the file's size, modification time and content
+hash, along with the chunk file the parsed output was saved to.  Entries are appended to the manifest as each file is
+parsed, so an interrupted extraction can pick up where it stopped.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy
+
+from compressed_files import parse_files_parallel
+
+
+MANIFEST_FILE_NAME = "manifest.jsonl"
+CHUNKS_DIR_NAME = "chunks"
+
+_hash_block_bytes = 1024 * 1024
+
+
+def content_hash(file_path) -> str:
+	"""The SHA-1 hash of a file's contents."""
+	sha1 = hashlib.sha1()
+	with open(file_path, 'rb') as source_file:
+		for block in iter(lambda: source_file.read(_hash_block_bytes), b""):
+			sha1.update(block)
+	return sha1.hexdigest()
+
+
+def fingerprint(source_path) -> Dict:
+	"""
+	The size, modification time and content hash of a source file, as recorded in an ExtractionManifest.
+
+	Taken before the file is parsed, so that a file which changes while it's being parsed is seen as changed next time.
+	"""
+	stat = os.stat(source_path)
+	return {
+		"size": stat.st_size,
+		"mtime_ns": stat.st_mtime_ns,
+		"hash": content_hash(source_path),
+	}
+
+
+def parse_fingerprinted(source_path, parse: Callable, *args) -> Tuple[Dict, Any]:
+	"""
+	The fingerprint of a source file, and parse(source_path, *args).
+
+	Being module-level, this can be run on worker processes, so that each file is hashed by the worker which parses it.
+	"""
+	source_fingerprint = fingerprint(source_path)
+	return source_fingerprint, parse(source_path, *args)
+
+
+class ExtractionManifest:
+	"""
+	Parsed outputs of source files, keyed on the source path and a string describing the parse settings (so that
+	e.g. changing a frame cap causes a re-parse).
+
+	A file whose size and modification time haven't changed is assumed unchanged.  Otherwise its content hash is
+	compared, so a file which was touched or copied but not changed isn't re-parsed either.
+	"""
+
+	def __init__(self, manifest_dir_path):
+		self.manifest_dir_path = Path(manifest_dir_path)
+		self.manifest_path = Path(self.manifest_dir_path, MANIFEST_FILE_NAME)
+		self.chunks_dir_path = Path(self.manifest_dir_path, CHUNKS_DIR_NAME)
+		self.chunks_dir_path.mkdir(parents=True, exist_ok=True)
+
+		# (source path, settings) -> entry
+		self._entries: Dict[Tuple[str, str], Dict] = dict()
+		# Drivers may record results from executor callback threads
+		self._lock = threading.Lock()
+
+		if self.manifest_path.exists():
+			with open(self.manifest_path, encoding="utf-8") as manifest_file:
+				for line in manifest_file:
+					try:
+						entry = json.loads(line)
+					except json.JSONDecodeError:
+						# A line cut short by an interruption
+						continue
+					# Later entries supersede earlier ones
+					self._entries[(entry["path"], entry["settings"])] = entry
+
+	def __len__(self):
+		return len(self._entries)
+
+	def lookup(self, source_path, settings: str) -> Optional[Any]:
+		"""
+		The saved output for a source file, or None if it's new, has changed since it was parsed, or no longer exists.
+
+		:param source_path:
+		:param settings:
+		"""
+		source_path = os.path.abspath(source_path)
+		entry = self._entries.get((source_path, settings))
+		if entry is None:
+			return None
+
+		chunk_path = Path(self.chunks_dir_path, entry["chunk"])
+		if not chunk_path.exists():
+			return None
+
+		try:
+			stat = os.stat(source_path)
+		except FileNotFoundError:
+			return None
+		if stat.st_size != entry["size"]:
+			return None
+		if stat.st_mtime_ns != entry["mtime_ns"]:
+			if content_hash(source_path) != entry["hash"]:
+				return None
+			# Same contents, so just remember the new modification time
+			self._append({**entry, "mtime_ns": stat.st_mtime_ns})
+
+		if chunk_path.suffix == ".npy":
+			return numpy.load(chunk_path)
+		with open(chunk_path, 'rb') as chunk_file:
+			return pickle.load(chunk_file)
+
+	def record(self, source_path, settings: str, output: Any, source_fingerprint: Dict):
+		"""
+		Saves the output of parsing a source file, and records it in the manifest.
+
+		:param source_path:
+		:param settings:
+		:param output: an array, which is saved as a .npy file, or anything else which can be pickled (and whose type
+		               can be imported, i.e. isn't defined in a script being run as __main__)
+		:param source_fingerprint: the source's fingerprint, taken when it was parsed (see parse_fingerprinted)
+		"""
+		source_path = os.path.abspath(source_path)
+
+		# Chunks are named for their source's contents and the settings, so identical files share a chunk
+		is_array = isinstance(output, numpy.ndarray)
+		chunk_name = "{0}.{1}".format(
+			hashlib.sha1("{0}\n{1}".format(source_fingerprint["hash"], settings).encode("utf-8")).hexdigest(),
+			"npy" if is_array else "pickle")
+		chunk_path = Path(self.chunks_dir_path, chunk_name)
+		partial_chunk_path = Path(self.chunks_dir_path, "{0}.{1}.partial".format(chunk_name, threading.get_ident()))
+		with open(partial_chunk_path, 'wb') as chunk_file:
+			if is_array:
+				numpy.save(chunk_file, output)
+			else:
+				pickle.dump(output, chunk_file, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(partial_chunk_path, chunk_path)
+
+		self._append({
+			"path": source_path,
+			"settings": settings,
+			"size": source_fingerprint["size"],
+			"mtime_ns": source_fingerprint["mtime_ns"],
+			"hash": source_fingerprint["hash"],
+			"chunk": chunk_name,
+		})
+
+	def _append(self, entry: Dict):
+		with self._lock:
+			self._entries[(entry["path"], entry["settings"])] = entry
+			with open(self.manifest_path, mode="a", encoding="utf-8") as manifest_file:
+				manifest_file.write(json.dumps(entry) + "\n")
+				manifest_file.flush()
+				os.fsync(manifest_file.fileno())
+
+
+def parse_recorded(manifest: Optional[ExtractionManifest], source_path, settings: str, parse: Callable, *args) -> Any:
+	"""
+	parse(source_path, *args), or its output from the manifest if the source hasn't changed since it was recorded
+	there with these settings.  New outputs are recorded.
+
+	:param manifest: if None, the source is always parsed
+	:param source_path:
+	:param settings: describes the parse, e.g. any frame cap
+	:param parse:
+	:param args: further arguments passed to parse
+	"""
+	if manifest is None:
+		return parse(source_path, *args)
+	output = manifest.lookup(source_path, settings)
+	if output is None:
+		source_fingerprint, output = parse_fingerprinted(source_path, parse, *args)
+		manifest.record(source_path, settings, output, source_fingerprint)
+	return output
+
+
+def parse_files_recorded(manifest: Optional[ExtractionManifest], source_paths: List, settings: str, parse: Callable,
+						 *args, max_workers: Optional[int] = None) -> List:
+	"""
+	As parse_recorded, for many source files.  Only the new and changed files are parsed.
+
+	:param manifest: if None, every source is parsed
+	:param source_paths:
+	:param settings:
+	:param parse: if max_workers is given, a picklable (i.e. module-level) function
+	:param args:
+	:param max_workers: if given, files are parsed on a pool of this many worker processes
+	:return: the outputs, in the order of source_paths
+	"""
+	source_paths = list(source_paths)
+	outputs = [manifest.lookup(source_path, settings) if manifest is not None else None
+			   for source_path in source_paths]
+	to_parse = [i for i, output in enumerate(outputs) if output is None]
+
+	# Files to be recorded are fingerprinted as they're parsed, on the same process
+	file_parse, file_parse_args = ((parse_fingerprinted, (parse,) + args)
+								   if manifest is not None
+								   else (parse, args))
+	paths_to_parse = [source_paths[i] for i in to_parse]
+	if max_workers is not None:
+		parsed = parse_files_parallel(file_parse, paths_to_parse, *file_parse_args, max_workers=max_workers)
+	else:
+		# Lazily, so each file is recorded as soon as it's parsed and an interrupted run keeps what it's done
+		parsed = (file_parse(source_path, *file_parse_args) for source_path in paths_to_parse)
+
+	for i, result in zip(to_parse, parsed):
+		if manifest is not None:
+			source_fingerprint, outputs[i] = result
+			manifest.record(source_paths[i], settings, outputs[i], source_fingerprint)
+		else:
+			outputs[i] = result
+	return outputs
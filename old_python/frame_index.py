@@ -0,0 +1,221 @@
+"""
+Frame indices for HList activation logs.
+
+A frame index records, for one word's log, the id of each frame and the byte range of its block of lines.  It is
+saved next to the log as a sidecar file (<log>.frames.npz), so that frame counts, frame caps and reading a single frame
+don't need the whole log to be read and parsed again.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy
+
+from compressed_files import is_compressed, open_dump, resolve_dump_path
+
+
+# Matches the "N:" which starts the first line of each frame block
+_frame_marker_re = re.compile(rb"(?P<frame_id>[0-9]+):")
+
+# How much of the end of a log to read at a time when looking for its last frame
+_tail_chunk_bytes = 64 * 1024
+
+
+@dataclass
+class FrameIndex:
+	# The id of each frame, in file order
+	frame_ids: numpy.ndarray
+	# Byte offset of the start of each frame's data (just after its "N:")
+	data_starts: numpy.ndarray
+	# Byte offset of the end of each frame's block (its final newline)
+	block_ends: numpy.ndarray
+	# The log this was built from, so we can tell if it's stale
+	lines_per_block: int
+	file_size: int
+	file_mtime_ns: int
+
+	@property
+	def n_frames(self) -> int:
+		return len(self.frame_ids)
+
+	@property
+	def last_frame_id(self) -> int:
+		"""The id of the last complete frame, or 0 if there are none (as get_min_frame_index always assumed)."""
+		return int(self.frame_ids[-1]) if self.n_frames > 0 else 0
+
+	def n_frames_up_to(self, frame_cap: Optional[int]) -> int:
+		"""The number of frames with id no greater than frame_cap.  None or 0 for no cap."""
+		if not frame_cap:
+			return self.n_frames
+		return int(numpy.searchsorted(self.frame_ids, frame_cap, side="right"))
+
+	def position_of(self, frame_id: int) -> int:
+		"""The position in the index of the frame with this id."""
+		position = int(numpy.searchsorted(self.frame_ids, frame_id))
+		if position >= self.n_frames or self.frame_ids[position] != frame_id:
+			raise KeyError(frame_id)
+		return position
+
+	def is_fresh_for(self, word_file_path, lines_per_block) -> bool:
+		stat = os.stat(word_file_path)
+		return (self.lines_per_block == lines_per_block
+				and self.file_size == stat.st_size
+				and self.file_mtime_ns == stat.st_mtime_ns)
+
+	def save(self, index_path):
+		numpy.savez(index_path,
+					frame_ids=self.frame_ids, data_starts=self.data_starts, block_ends=self.block_ends,
+					lines_per_block=self.lines_per_block,
+					file_size=self.file_size, file_mtime_ns=self.file_mtime_ns)
+
+	@classmethod
+	def load(cls, index_path) -> "FrameIndex":
+		with numpy.load(index_path) as saved:
+			return cls(frame_ids=saved["frame_ids"], data_starts=saved["data_starts"], block_ends=saved["block_ends"],
+					   lines_per_block=int(saved["lines_per_block"]),
+					   file_size=int(saved["file_size"]), file_mtime_ns=int(saved["file_mtime_ns"]))
+
+
+def sidecar_path(word_file_path) -> str:
+	return "{0}.frames.npz".format(word_file_path)
+
+
+def locate_frame_blocks(data: bytes, lines_per_block):
+	"""
+	Finds every complete frame block in the text of a log.
+
+	:param data: the whole text of the log
+	:param lines_per_block: The number of lines in a single block of nodes
+	:return frame_ids, data_starts, block_ends: arrays as in FrameIndex
+	"""
+
+	# Positions of each line end.  A missing final newline is treated as if it were there.
+	chars = numpy.frombuffer(data, dtype=numpy.uint8)
+	newline_positions = numpy.flatnonzero(chars == ord("\n"))
+	if not data.endswith(b"\n"):
+		newline_positions = numpy.append(newline_positions, len(data))
+
+	# Only lines starting with a digit can be frame markers, so only those need checking with the regex
+	line_starts = numpy.concatenate(([0], newline_positions[:-1] + 1))
+	line_starts = line_starts[line_starts < len(data)]
+	candidate_lines = numpy.flatnonzero((chars[line_starts] >= ord("0")) & (chars[line_starts] <= ord("9")))
+
+	frame_ids = []
+	data_starts = []
+	block_ends = []
+	for line_i in candidate_lines:
+		marker = _frame_marker_re.match(data, line_starts[line_i])
+		if marker is None:
+			continue
+		last_line_i = line_i + lines_per_block - 1
+		# An incomplete final block is dropped, as by get_activation_lists
+		if last_line_i >= len(newline_positions):
+			break
+		frame_ids.append(int(marker.group("frame_id")))
+		data_starts.append(marker.end())
+		block_ends.append(newline_positions[last_line_i])
+
+	return (numpy.array(frame_ids, dtype=numpy.int64),
+			numpy.array(data_starts, dtype=numpy.int64),
+			numpy.array(block_ends, dtype=numpy.int64))
+
+
+def build_frame_index(word_file_path, lines_per_block, data: Optional[bytes] = None, save: bool = True) -> FrameIndex:
+	"""
+	Builds the frame index for a log, and (by default) saves it as a sidecar.
+
+	:param word_file_path:
+	:param lines_per_block: The number of lines in a single block of nodes
+	:param data: the text of the log, if it has already been read
+	:param save: whether to write the sidecar file
+	:return index:
+	"""
+	word_file_path = resolve_dump_path(word_file_path)
+	stat = os.stat(word_file_path)
+	if data is None:
+		with open_dump(word_file_path, 'rb') as word_file:
+			data = word_file.read()
+	frame_ids, data_starts, block_ends = locate_frame_blocks(data, lines_per_block)
+	index = FrameIndex(frame_ids=frame_ids, data_starts=data_starts, block_ends=block_ends,
+					   lines_per_block=lines_per_block,
+					   file_size=stat.st_size, file_mtime_ns=stat.st_mtime_ns)
+	if save:
+		try:
+			index.save(sidecar_path(word_file_path))
+		except OSError:
+			# The index is only a cache, so a read-only data directory isn't a problem
+			pass
+	return index
+
+
+def load_frame_index(word_file_path, lines_per_block, build: bool = True) -> Optional[FrameIndex]:
+	"""
+	Loads the sidecar index for a log if there is an up-to-date one.
+
+	:param word_file_path:
+	:param lines_per_block: The number of lines in a single block of nodes
+	:param build: if there's no up-to-date sidecar, build one (otherwise return None)
+	:return index:
+	"""
+	word_file_path = resolve_dump_path(word_file_path)
+	index_path = sidecar_path(word_file_path)
+	if os.path.isfile(index_path):
+		index = FrameIndex.load(index_path)
+		if index.is_fresh_for(word_file_path, lines_per_block):
+			return index
+	if build:
+		return build_frame_index(word_file_path, lines_per_block)
+	return None
+
+
+def last_frame_id(word_file_path) -> int:
+	"""
+	The id of the last frame in a log, found by scanning backwards from the end of the file for the last "N:" line.
+	Only the last block or so of the file is read, unless it's compressed, in which case it has to be read through.
+
+	:param word_file_path:
+	:return frame_id: or 0 if the log has no frames
+	"""
+	word_file_path = resolve_dump_path(word_file_path)
+	if is_compressed(word_file_path):
+		frame_id = 0
+		with open_dump(word_file_path, 'rb') as word_file:
+			for line in word_file:
+				marker = _frame_marker_re.match(line)
+				if marker:
+					frame_id = int(marker.group("frame_id"))
+		return frame_id
+
+	with open(word_file_path, 'rb') as word_file:
+		file_size = word_file.seek(0, os.SEEK_END)
+		chunk_bytes = _tail_chunk_bytes
+		while True:
+			start = max(0, file_size - chunk_bytes)
+			word_file.seek(start)
+			tail = word_file.read(file_size - start)
+			# The first line of the chunk may be partial unless we're at the start of the file
+			first_line_start = 0 if start == 0 else tail.find(b"\n") + 1
+			markers = [m for m in re.finditer(rb"^[0-9]+:", tail[first_line_start:], re.MULTILINE)]
+			if markers:
+				return int(markers[-1].group()[:-1])
+			if start == 0:
+				return 0
+			chunk_bytes *= 2
+
+
+def read_frame(word_file_path, index: FrameIndex, frame_id: int) -> numpy.ndarray:
+	"""
+	Reads the activations of a single frame, using the index to go straight to its block.
+
+	:param word_file_path:
+	:param index:
+	:param frame_id:
+	:return activations: node-indexed array of activations
+	"""
+	position = index.position_of(frame_id)
+	with open_dump(word_file_path, 'rb') as word_file:
+		word_file.seek(index.data_starts[position])
+		block = word_file.read(index.block_ends[position] - index.data_starts[position])
+	return numpy.fromstring(block, dtype=float, sep=" ")
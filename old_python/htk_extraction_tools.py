@@ -3,7 +3,9 @@
 Some common tools for extracting data from HTK's output.
 """
 import glob
+from compressed_files import COMPRESSED_OPENERS
 from cw_common import *
+from triphone_vocabulary import TriphoneVocabulary
 
 
 def triphone_to_phone_triplet(triphone):
@@ -18,21 +20,14 @@ def triphone_to_phone_triplet(triphone):
 def deal_triphones_by_phone(list_of_extant_triphones):
 	"""
 	Given list of triphones, returns a phone-keyed dictionary of triphones with the key as the central phone.
+	Each phone's triphones are in TriphoneVocabulary id order.
 	:param list_of_extant_triphones:
 	"""
-	phone_dictionary = dict()
-	for triphone in list_of_extant_triphones:
-		# Skip these erroneous entries
-		if triphone == '' or triphone == 'sil' or triphone == 'sp':
-			continue
-
-		central_phone = triphone_to_phone_triplet(triphone)[1]
-		if central_phone in phone_dictionary.keys():
-			phone_dictionary[central_phone] += [triphone]
-		else:
-			phone_dictionary[central_phone] = [triphone]
-
-	return phone_dictionary
+	vocabulary = TriphoneVocabulary(list_of_extant_triphones)
+	return {
+		phone: vocabulary.triphones_for_phone(phone)
+		for phone in vocabulary.centre_phones
+	}
 
 
 def get_word_list(wordlist_filename, silent=False):
@@ -50,10 +45,15 @@ def get_word_list(wordlist_filename, silent=False):
 			yield word.strip()
 
 def get_word_list_from_file_list(in_path, suffix):
-	path_list = glob.iglob(os.path.join(in_path, '*.{0}'.format(suffix)))
+	# Compressed files count too, as the parsers can read them
+	path_list = [
+		file_path
+		for pattern_suffix in [''] + list(COMPRESSED_OPENERS.keys())
+		for file_path in glob.iglob(os.path.join(in_path, '*.{0}{1}'.format(suffix, pattern_suffix)))
+	]
 	file_list = [os.path.basename(file_path) for file_path in path_list]
 	word_list = [file_name.split('.')[0] for file_name in file_list]
-	word_list.sort()
+	word_list = sorted(set(word_list))
 	return word_list
 
 
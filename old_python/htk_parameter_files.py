@@ -0,0 +1,150 @@
+"""
+Read HTK binary parameter files (.fbk, .mfc, .mlp) directly into numpy arrays.
+
+This avoids the round trip through `HList -h` text logs (see shell/batch_hlist.sh) and the regex-based parsing of those
+logs.
+
+An HTK parameter file is a 12-byte big-endian header:
+
+	nSamples   (int32)  number of frames
+	sampPeriod (int32)  frame period in 100ns units
+	sampSize   (int16)  bytes per frame
+	parmKind   (int16)  base parameter kind and qualifier flags
+
+followed by nSamples frames of big-endian float32 values.
+"""
+
+import os
+import struct
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy
+
+from cw_common import prints
+from htk_extraction_tools import get_word_list_from_file_list
+
+
+HEADER_FORMAT = ">iihh"
+HEADER_BYTES = struct.calcsize(HEADER_FORMAT)
+
+# Base parameter kinds (the low 6 bits of parmKind)
+WAVEFORM = 0
+DISCRETE = 10
+
+# Qualifier flag for compressed files
+_C = 0o002000
+
+_BASE_KIND_MASK = 0o77
+
+
+@dataclass
+class HTKHeader:
+	n_samples: int
+	sample_period: int
+	sample_size: int
+	parameter_kind: int
+
+	@property
+	def base_kind(self) -> int:
+		return self.parameter_kind & _BASE_KIND_MASK
+
+	@property
+	def is_compressed(self) -> bool:
+		return bool(self.parameter_kind & _C)
+
+	@property
+	def n_frames(self) -> int:
+		"""The number of data frames (compressed files count their scale and offset vectors in nSamples)."""
+		if self.is_compressed:
+			return self.n_samples - 4
+		return self.n_samples
+
+	@property
+	def dims(self) -> int:
+		"""The number of values per frame."""
+		if self.is_compressed or self.base_kind == WAVEFORM:
+			# 2-byte values
+			return self.sample_size // 2
+		return self.sample_size // 4
+
+
+def read_htk_header(file_path) -> HTKHeader:
+	"""
+	Reads the 12-byte header of an HTK parameter file.
+	:param file_path:
+	:return header:
+	"""
+	with open(file_path, mode="rb") as htk_file:
+		header_bytes = htk_file.read(HEADER_BYTES)
+	if len(header_bytes) < HEADER_BYTES:
+		raise ValueError("{0} is too short to be an HTK parameter file".format(file_path))
+	return HTKHeader(*struct.unpack(HEADER_FORMAT, header_bytes))
+
+
+def load_htk_parameter_file(file_path, frame_cap: Optional[int] = None, mmap: bool = True) -> numpy.ndarray:
+	"""
+	Loads an HTK parameter file as a (frames x dims) array.
+
+	Uncompressed float files are memory-mapped, so the returned array is a read-only big-endian view onto the file and
+	nothing is read until it is used.  Compressed (_C) files are decoded into a new float32 array.
+
+	:param file_path:
+	:param frame_cap: if given, only frames 0..frame_cap (inclusive, as with get_activation_lists) are returned.
+	:param mmap: memory-map the file rather than reading it.
+	:return: a (frames x dims) array
+	"""
+	header = read_htk_header(file_path)
+
+	if header.base_kind == DISCRETE:
+		raise ValueError("DISCRETE parameter files are not supported ({0})".format(file_path))
+
+	n_frames = header.n_frames
+	if frame_cap is not None and frame_cap > 0:
+		n_frames = min(n_frames, frame_cap + 1)
+
+	if header.is_compressed:
+		# Compressed files store float32 scale (A) and offset (B) vectors, then int16 values x = (c + B) / A
+		with open(file_path, mode="rb") as htk_file:
+			htk_file.seek(HEADER_BYTES)
+			scale = numpy.fromfile(htk_file, dtype=">f4", count=header.dims)
+			offset = numpy.fromfile(htk_file, dtype=">f4", count=header.dims)
+			compressed = numpy.fromfile(htk_file, dtype=">i2", count=n_frames * header.dims)
+		compressed = compressed.reshape((n_frames, header.dims))
+		return ((compressed + offset) / scale).astype(numpy.float32)
+
+	dtype = ">i2" if header.base_kind == WAVEFORM else ">f4"
+	if mmap:
+		return numpy.memmap(file_path, dtype=dtype, mode="r", offset=HEADER_BYTES, shape=(n_frames, header.dims))
+	with open(file_path, mode="rb") as htk_file:
+		htk_file.seek(HEADER_BYTES)
+		values = numpy.fromfile(htk_file, dtype=dtype, count=n_frames * header.dims)
+	return values.reshape((n_frames, header.dims))
+
+
+def load_htk_parameter_directory(input_dir_path, suffix: str, word_list: Optional[List[str]] = None,
+								 frame_cap: Optional[int] = None, silent: bool = False) -> Dict[str, numpy.ndarray]:
+	"""
+	Loads a directory of per-word HTK parameter files (e.g. <word>.mlp) into a word-keyed dictionary of
+	(frames x dims) native-endian arrays, ready to be passed to save_activations.
+
+	:param input_dir_path:
+	:param suffix: file extension, e.g. "mlp", "fbk" or "mfc"
+	:param word_list: words to load; defaults to every file with the suffix in the directory
+	:param frame_cap: if given, only frames 0..frame_cap (inclusive) are kept
+	:param silent:
+	:return activations: word-keyed dictionary of (frames x dims) arrays
+	"""
+	if word_list is None:
+		word_list = get_word_list_from_file_list(input_dir_path, suffix)
+
+	activations = dict()
+	for word in word_list:
+		if not silent:
+			prints("Reading parameters for \"{0}\"".format(word))
+		word_file_path = os.path.join(input_dir_path, "{0}.{1}".format(word, suffix))
+		word_parameters = load_htk_parameter_file(word_file_path, frame_cap=frame_cap, mmap=True)
+		# One bulk byteswap into native order, which also detaches the array from the file
+		activations[word] = word_parameters.astype(word_parameters.dtype.newbyteorder("="))
+
+	return activations
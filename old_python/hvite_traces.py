@@ -0,0 +1,306 @@
+"""
+Columnar reading of HVite traces (files called something like `hv.trace` or `dnn_test_10k_prune.log`).
+
+Instead of nested word -> frame_id -> triphone -> likelihood dictionaries, a trace is read into a
+TriphoneLikelihoodTable: one row per (word, frame, triphone) entry, stored as parallel numpy columns, with triphone
+strings interned to integer ids.
+"""
+
+import io
+import mmap
+import os
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy
+
+from compressed_files import is_compressed, open_dump, resolve_dump_path
+from cw_common import prints
+from extraction_manifest import ExtractionManifest, parse_recorded
+
+
+# Regular expression for the path of a word.  Older traces were run on .mfc files, DNN ones on .fbk files.
+_word_path_re = re.compile(r"^File: (?P<word_path>.+)\.(?:mfc|fbk)$")
+
+# Regular expression for frame and list of active triphones
+_frame_data_re = re.compile((
+	r"Activated phone models for frame "
+	# The frame number
+	r"(?P<frame_id>[0-9]+) "
+	# The count in parentheses (we don't care about this)
+	r"\([0-9]+\) : "
+	# The list of triphones, or triphone-probability pairs
+	r"(?P<triphone_list>.+)$"))
+
+# Where each utterance starts, after the previous one's last line
+_utterance_start = b"\nFile: "
+
+
+@dataclass
+class TriphoneLikelihoodTable:
+	"""
+	One row per triphone activated in each frame of each word.
+
+	Rows are in trace order, so all of a word's rows are contiguous.
+	"""
+	# Word names, in trace order.  word_index indexes this.
+	words: List[str]
+	# Interned triphone strings, in order of first appearance.  triphone_id indexes this.
+	triphones: List[str]
+	word_index: numpy.ndarray
+	# HVite frame numbers, which are 1-indexed
+	frame: numpy.ndarray
+	triphone_id: numpy.ndarray
+	# NaN for traces which list active triphones without likelihoods
+	log_likelihood: numpy.ndarray
+
+	def __len__(self):
+		return len(self.word_index)
+
+	def word_positions(self, word_list: List[str]) -> numpy.ndarray:
+		"""
+		Maps each entry of self.words to its position in word_list, or -1 if it isn't there.
+		If a word appears more than once in the trace, only its last appearance is mapped (as the dictionaries
+		would have been overwritten).
+		"""
+		position_of_word = {word: i for i, word in enumerate(word_list)}
+		last_appearance = {word: i for i, word in enumerate(self.words)}
+		return numpy.array([position_of_word.get(word, -1) if last_appearance[word] == i else -1
+							for i, word in enumerate(self.words)], dtype=numpy.int64)
+
+	def triphone_ids(self, triphones: List[str]) -> numpy.ndarray:
+		"""The ids of the given triphones in this table, or -1 for any which never appear."""
+		id_of_triphone = {triphone: i for i, triphone in enumerate(self.triphones)}
+		return numpy.array([id_of_triphone.get(triphone, -1) for triphone in triphones], dtype=numpy.int64)
+
+
+def read_triphone_likelihood_table(input_filename, frame_cap, silent) -> TriphoneLikelihoodTable:
+	"""
+	Streams through an HVite trace, building a TriphoneLikelihoodTable.
+
+	Works on traces listing "likelihood|triphone" pairs and on ones listing bare triphones (as read by
+	get_triphone_lists).  Frames after frame_cap (1-indexed, as HVite's) are skipped.
+
+	:param input_filename:
+	:param frame_cap:
+	:param silent:
+	:return table:
+	"""
+
+	if not silent:
+		prints("Getting triphone probability vectors from {0}...".format(input_filename))
+
+	with open_dump(input_filename) as input_file:
+		return _parse_trace_lines(input_file, frame_cap, silent)
+
+
+def _parse_trace_lines(lines: Iterable[str], frame_cap, silent) -> TriphoneLikelihoodTable:
+	"""
+	Builds a TriphoneLikelihoodTable from the lines of (part of) an HVite trace.  Lines before the first "File:" line
+	are ignored.
+	"""
+
+	frame_cap = int(frame_cap)
+
+	words: List[str] = []
+	triphone_ids: Dict[str, int] = dict()
+
+	# Compact typed buffers, converted to numpy arrays without copying at the end
+	word_index_column = array("i")
+	frame_column = array("i")
+	triphone_id_column = array("i")
+	log_likelihood_column = array("f")
+
+	for line in lines:
+		word_path_match = _word_path_re.match(line)
+		if word_path_match:
+			word_name = word_path_match.group("word_path").split('/')[-1].split('.')[0]
+			words.append(word_name)
+			if not silent:
+				prints("Getting triphone lists for '{0}'...".format(word_name))
+			continue
+
+		frame_data_match = _frame_data_re.match(line)
+		if not frame_data_match or not words:
+			continue
+
+		frame = int(frame_data_match.group("frame_id"))
+		if frame > frame_cap:
+			continue
+
+		# "likelihood|triphone" or just "triphone"
+		pairs = [token.rpartition("|") for token in frame_data_match.group("triphone_list").split()]
+
+		n_pairs = len(pairs)
+		word_index_column.extend([len(words) - 1] * n_pairs)
+		frame_column.extend([frame] * n_pairs)
+		triphone_id_column.extend([triphone_ids.setdefault(triphone, len(triphone_ids))
+								   for _, _, triphone in pairs])
+		log_likelihood_column.extend([float(likelihood) if likelihood else numpy.nan
+									  for likelihood, _, _ in pairs])
+
+	return TriphoneLikelihoodTable(
+		words=words,
+		triphones=list(triphone_ids.keys()),
+		word_index=numpy.frombuffer(word_index_column, dtype=numpy.int32),
+		frame=numpy.frombuffer(frame_column, dtype=numpy.int32),
+		triphone_id=numpy.frombuffer(triphone_id_column, dtype=numpy.int32),
+		log_likelihood=numpy.frombuffer(log_likelihood_column, dtype=numpy.float32),
+	)
+
+
+def find_utterance_chunks(input_filename, chunk_bytes: int) -> List[Tuple[int, int]]:
+	"""
+	Splits an HVite trace into byte ranges of roughly chunk_bytes each, every one starting at a "File:" line, so that
+	each utterance lies entirely within one range.
+
+	Only the region around each nominal split point is searched, so this takes very little time even for a huge trace.
+
+	:param input_filename:
+	:param chunk_bytes:
+	:return ranges: (start, end) byte ranges covering the whole file, in order
+	"""
+	with open(input_filename, 'rb') as input_file:
+		file_size = input_file.seek(0, os.SEEK_END)
+		if file_size == 0:
+			return []
+		with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as trace:
+			boundaries = [0]
+			for nominal_split in range(chunk_bytes, file_size, chunk_bytes):
+				if nominal_split <= boundaries[-1]:
+					continue
+				# The start of the next utterance after the nominal split
+				newline_position = trace.find(_utterance_start, nominal_split - 1)
+				if newline_position < 0:
+					break
+				boundaries.append(newline_position + 1)
+	boundaries.append(file_size)
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _read_trace_byte_range(input_filename, start: int, end: int, frame_cap) -> TriphoneLikelihoodTable:
+	"""Parses the utterances in one byte range of an HVite trace.  Runs on a worker process."""
+	with open(input_filename, 'rb') as input_file:
+		input_file.seek(start)
+		text = input_file.read(end - start).decode("utf-8")
+	return _parse_trace_lines(io.StringIO(text, newline=None), frame_cap, silent=True)
+
+
+def concatenate_tables(tables: List[TriphoneLikelihoodTable]) -> TriphoneLikelihoodTable:
+	"""
+	Joins tables read from consecutive parts of a trace into the table which would have been read from the whole.
+	Triphones are re-interned so ids are still in order of first appearance.
+	"""
+	words: List[str] = []
+	triphone_ids: Dict[str, int] = dict()
+	word_index_columns = []
+	triphone_id_columns = []
+	for table in tables:
+		word_index_columns.append(table.word_index + len(words))
+		words.extend(table.words)
+		id_map = numpy.array([triphone_ids.setdefault(triphone, len(triphone_ids)) for triphone in table.triphones],
+							 dtype=numpy.int32)
+		triphone_id_columns.append(id_map[table.triphone_id] if len(id_map) > 0 else table.triphone_id)
+
+	return TriphoneLikelihoodTable(
+		words=words,
+		triphones=list(triphone_ids.keys()),
+		word_index=numpy.concatenate(word_index_columns + [numpy.zeros(0, dtype=numpy.int32)]).astype(numpy.int32),
+		frame=numpy.concatenate([table.frame for table in tables] + [numpy.zeros(0, dtype=numpy.int32)]),
+		triphone_id=numpy.concatenate(triphone_id_columns + [numpy.zeros(0, dtype=numpy.int32)]).astype(numpy.int32),
+		log_likelihood=numpy.concatenate([table.log_likelihood for table in tables]
+										 + [numpy.zeros(0, dtype=numpy.float32)]),
+	)
+
+
+def read_triphone_likelihood_table_parallel(input_filename, frame_cap, silent,
+											max_workers: Optional[int] = None,
+											chunk_bytes: int = 64 * 1024 * 1024) -> TriphoneLikelihoodTable:
+	"""
+	As read_triphone_likelihood_table, but with the trace split at utterance boundaries into chunks which are parsed
+	on a pool of worker processes, then merged back in utterance order.
+
+	Compressed traces can't be split by byte offset, so they're read as by read_triphone_likelihood_table.
+
+	:param input_filename:
+	:param frame_cap:
+	:param silent:
+	:param max_workers: number of worker processes; defaults to the number of CPUs
+	:param chunk_bytes: the approximate size of each chunk
+	:return table:
+	"""
+
+	input_filename = resolve_dump_path(input_filename)
+	if is_compressed(input_filename):
+		return read_triphone_likelihood_table(input_filename, frame_cap, silent)
+
+	chunks = find_utterance_chunks(input_filename, chunk_bytes)
+
+	if not silent:
+		prints("Getting triphone probability vectors from {0} in {1} chunks...".format(input_filename, len(chunks)))
+
+	with ProcessPoolExecutor(max_workers=max_workers) as executor:
+		futures = [
+			executor.submit(_read_trace_byte_range, input_filename, start, end, frame_cap)
+			for start, end in chunks
+		]
+		return concatenate_tables([future.result() for future in futures])
+
+
+def read_recorded_triphone_likelihood_table(input_filename, frame_cap, silent, manifest: Optional[ExtractionManifest],
+											max_workers: Optional[int] = None) -> TriphoneLikelihoodTable:
+	"""
+	As read_triphone_likelihood_table_parallel, but the trace is only read if it's new or has changed since it was
+	recorded in the manifest with the same frame cap.
+
+	:param input_filename:
+	:param frame_cap:
+	:param silent:
+	:param manifest: if None, the trace is always read
+	:param max_workers:
+	:return table:
+	"""
+	settings = "triphone likelihoods frame_cap={0}".format(frame_cap)
+	return parse_recorded(manifest, resolve_dump_path(input_filename), settings,
+						  read_triphone_likelihood_table_parallel, frame_cap, silent, max_workers)
+
+
+def iter_frame_likelihoods(table: TriphoneLikelihoodTable, word_list: List[str], frames: List[int],
+						   triphones: List[str], fill_value: float = numpy.nan) -> Iterator[Tuple[int, numpy.ndarray]]:
+	"""
+	For each requested frame, a words x triphones array of the likelihoods of the given triphones, filled with
+	fill_value where a triphone wasn't active.
+
+	:param table:
+	:param word_list: rows of each array
+	:param frames: HVite (1-indexed) frame numbers
+	:param triphones: columns of each array
+	:param fill_value:
+	:return: iterator of (frame, likelihoods) pairs
+	"""
+
+	# Lookups from table ids into result rows and columns
+	rows_of_words = table.word_positions(word_list)
+	columns_of_ids = numpy.full(len(table.triphones), -1, dtype=numpy.int64)
+	ids = table.triphone_ids(triphones)
+	columns_of_ids[ids[ids >= 0]] = numpy.flatnonzero(ids >= 0)
+
+	# Group the rows by frame, keeping trace order within each frame so later duplicates win, as they did in the
+	# dictionaries
+	frame_order = numpy.argsort(table.frame, kind="stable")
+	sorted_frames = table.frame[frame_order]
+
+	for frame in frames:
+		likelihoods = numpy.full((len(word_list), len(triphones)), fill_value, dtype=float)
+
+		in_frame = frame_order[numpy.searchsorted(sorted_frames, frame, side="left"):
+							   numpy.searchsorted(sorted_frames, frame, side="right")]
+		rows = rows_of_words[table.word_index[in_frame]]
+		columns = columns_of_ids[table.triphone_id[in_frame]]
+		wanted = (rows >= 0) & (columns >= 0)
+		likelihoods[rows[wanted], columns[wanted]] = table.log_likelihood[in_frame[wanted]]
+
+		yield frame, likelihoods
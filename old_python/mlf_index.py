@@ -0,0 +1,169 @@
+"""
+Random access to the utterances in an HTK master label file (MLF), without splitting it into per-word .rec files.
+
+One scan of the MLF records the byte range of each utterance's label lines, after which any utterance can be read
+directly (optionally through a memory map), or all of them read in file order.
+"""
+
+import mmap
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# The line naming an utterance, like "test/word.rec", possibly with a "*/" wildcard directory
+_label_line_re = re.compile(rb"^\"(?P<label_path>.+)\"\r?$")
+# The line ending an utterance
+_end_line_re = re.compile(rb"^\.\r?$")
+
+
+def label_path_to_word(label_path: str) -> str:
+	"""
+	Gets the word out of an MLF label path like "test/word.rec", as do_split names the .rec files.
+	"""
+	return os.path.splitext(label_path.split('/')[-1])[0]
+
+
+class MLFIndex:
+	"""
+	The byte range of each utterance in an MLF.
+
+	Can be used as a context manager, in which case the MLF is kept open (or memory-mapped) until the end of the block
+	rather than being opened for each read.
+	"""
+
+	def __init__(self, mlf_path, ranges: Dict[str, Tuple[int, int]], use_mmap: bool = False):
+		self.mlf_path = mlf_path
+		# word -> (start, end) of its label lines, not including the label path or the final "."
+		self.ranges = ranges
+		self.use_mmap = use_mmap
+
+		self._file = None
+		self._mmap: Optional[mmap.mmap] = None
+
+	def __len__(self):
+		return len(self.ranges)
+
+	def __contains__(self, word):
+		return word in self.ranges
+
+	@property
+	def words(self) -> List[str]:
+		"""The words in the MLF, in file order."""
+		return sorted(self.ranges.keys(), key=lambda word: self.ranges[word][0])
+
+	def open(self) -> "MLFIndex":
+		if self._file is None:
+			self._file = open(self.mlf_path, 'rb')
+			if self.use_mmap:
+				self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		return self
+
+	def close(self):
+		if self._mmap is not None:
+			self._mmap.close()
+			self._mmap = None
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def __enter__(self):
+		return self.open()
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+	def _read(self, start, end) -> bytes:
+		if self._mmap is not None:
+			return self._mmap[start:end]
+		self._file.seek(start)
+		return self._file.read(end - start)
+
+	def utterance_bytes(self, word) -> bytes:
+		"""
+		The raw text of a word's label lines.
+
+		:raises KeyError: if the word isn't in the MLF
+		"""
+		start, end = self.ranges[word]
+		if self._file is not None:
+			return self._read(start, end)
+		with self:
+			return self._read(start, end)
+
+	def lines(self, word) -> List[str]:
+		"""
+		A word's label lines, as they would be read from its .rec file.
+
+		:raises KeyError: if the word isn't in the MLF
+		"""
+		return self.utterance_bytes(word).decode('utf-8').splitlines(keepends=True)
+
+	def iter_utterances(self, word_list=None) -> Iterator[Tuple[str, List[str]]]:
+		"""
+		Yields (word, label lines) pairs for each word in word_list (or every word in the MLF), reading in file order.
+
+		:raises KeyError: if a word in word_list isn't in the MLF
+		"""
+		if word_list is None:
+			words = self.words
+		else:
+			words = sorted(word_list, key=lambda word: self.ranges[word][0])
+		opened_here = self._file is None
+		self.open()
+		try:
+			for word in words:
+				start, end = self.ranges[word]
+				yield word, self._read(start, end).decode('utf-8').splitlines(keepends=True)
+		finally:
+			if opened_here:
+				self.close()
+
+
+def build_mlf_index(mlf_path, use_mmap: bool = False) -> MLFIndex:
+	"""
+	Scans an MLF once, recording where each utterance's label lines are.
+	If an utterance appears more than once, the last one is used (as do_split would overwrite its .rec file).
+
+	:param mlf_path:
+	:param use_mmap: whether reads from the index should go through a memory map of the MLF
+	:return index:
+	"""
+
+	ranges = dict()
+
+	current_word = None
+	current_start = 0
+
+	offset = 0
+	with open(mlf_path, 'rb') as mlf_file:
+		for line in mlf_file:
+			line_end = offset + len(line)
+
+			label_line_match = _label_line_re.match(line)
+			if label_line_match:
+				current_word = label_path_to_word(label_line_match.group("label_path").decode('utf-8'))
+				current_start = line_end
+
+			elif _end_line_re.match(line):
+				if current_word is not None:
+					ranges[current_word] = (current_start, offset)
+				current_word = None
+
+			offset = line_end
+
+	return MLFIndex(mlf_path, ranges, use_mmap=use_mmap)
+
+
+def rec_lines(rec_source, word) -> List[str]:
+	"""
+	The label lines for a word, either from its .rec file in a directory of files split by do_split, or from an MLFIndex.
+
+	:param rec_source: a directory path or an MLFIndex
+	:param word:
+	"""
+	if isinstance(rec_source, (str, os.PathLike)):
+		word_file_path = os.path.join(rec_source, "{0}.rec".format(word))
+		with open(word_file_path, 'r', encoding='utf-8') as word_file:
+			return word_file.readlines()
+	return rec_source.lines(word)
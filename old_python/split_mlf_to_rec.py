@@ -9,6 +9,12 @@ from pathlib import Path
 
 
 def do_split(mlf_path, output_dir_path):
+	"""
+	Writes each utterance in an MLF to its own .rec file.
+
+	The readers of .rec files can now read straight from the MLF through an mlf_index.MLFIndex instead, which avoids
+	creating and opening a file per word.
+	"""
 
 	rec_label_line_re = re.compile((
 		r"^\"test/(?P<rec_label>[a-z]+\.rec)\"$"
@@ -10,21 +10,31 @@ import numpy
 import scipy
 import scipy.io
 
+from common.segmentation import SegmentationTable, SEGMENTATION_TABLE_FILE_NAME
 from old_python.htk_extraction_tools import get_word_list, triphone_to_phone_triplet
+from old_python.mlf_index import build_mlf_index, rec_lines
+
+
+# Regular expression for frame and list of node activations
+_segment_re = re.compile((
+	# The onset of the segment
+	r"^(?P<onset>[0-9]+)\s+"
+	# The offset of the segment
+	r"(?P<offset>[0-9]+)\s+"
+	# The tri/phone
+	r"(?P<segment_label>[a-z+\-]+)\s+"
+	# The rest
+	r".*$"))
 
 
 def get_segmentation(input_dir_path, word_list, convert_to_phones=True):
+	"""
+	Reads the segments of each word's recognised transcription.
 
-	# Regular expression for frame and list of node activations
-	segment_re = re.compile((
-		# The onset of the segment
-		r"^(?P<onset>[0-9]+)\s+"
-		# The offset of the segment
-		r"(?P<offset>[0-9]+)\s+"
-		# The tri/phone
-		r"(?P<segment_label>[a-z+\-]+)\s+"
-		# The rest
-		r".*$"))
+	:param input_dir_path: a directory of .rec files split from an MLF by do_split, or an MLFIndex of the MLF itself
+	:param word_list:
+	:param convert_to_phones:
+	"""
 
 	# a word-keyed dictionary of sequence-indexed lists of (onset, offset, segment_label)-tuples.
 	boundaries = {}
@@ -34,20 +44,18 @@ def get_segmentation(input_dir_path, word_list, convert_to_phones=True):
 
 		word_boundaries = []
 
-		word_file_path = os.path.join(input_dir_path, "{0}.rec".format(word))
-		with open(word_file_path, 'r', encoding='utf-8') as word_file:
-			for line in word_file:
-				line_match = segment_re.match(line)
-				if line_match:
-					onset    = int(line_match.group("onset"))
-					offset   = int(line_match.group("offset"))
-					segment_label = line_match.group("segment_label")
-
-					if segment_label == 'sp':
-						continue
-					if convert_to_phones and segment_label != 'sil':
-						segment_label = triphone_to_phone_triplet(segment_label)[1]
-					word_boundaries.append((onset, offset, segment_label))
+		for line in rec_lines(input_dir_path, word):
+			line_match = _segment_re.match(line)
+			if line_match:
+				onset    = int(line_match.group("onset"))
+				offset   = int(line_match.group("offset"))
+				segment_label = line_match.group("segment_label")
+
+				if segment_label == 'sp':
+					continue
+				if convert_to_phones and segment_label != 'sil':
+					segment_label = triphone_to_phone_triplet(segment_label)[1]
+				word_boundaries.append((onset, offset, segment_label))
 
 		# Now save this word's activations list into a dictionary keyed on that word
 		boundaries[word] = word_boundaries.copy()
@@ -55,6 +63,81 @@ def get_segmentation(input_dir_path, word_list, convert_to_phones=True):
 	return boundaries
 
 
+def compile_segmentation_table(mlf_index, word_list):
+	"""
+	Reads the segments of each word's recognised transcription straight from an MLF into a columnar SegmentationTable.
+	Phone labels are as get_segmentation gives with convert_to_phones, and the full label of each segment is kept as
+	its triphone_id.
+
+	:param mlf_index: an MLFIndex of the MLF
+	:param word_list:
+	:return table:
+	"""
+
+	word_list = list(word_list)
+
+	phone_codes = dict()
+	triphone_ids = dict()
+
+	word_id_column = []
+	onset_column = []
+	offset_column = []
+	phone_code_column = []
+	triphone_id_column = []
+
+	# The index reads the words in file order, but the table's rows are in word_list order
+	utterances = dict(mlf_index.iter_utterances(word_list))
+	for word_i, word in enumerate(word_list):
+		for line in utterances[word]:
+			line_match = _segment_re.match(line)
+			if not line_match:
+				continue
+			segment_label = line_match.group("segment_label")
+			if segment_label == 'sp':
+				continue
+			phone = segment_label if segment_label == 'sil' else triphone_to_phone_triplet(segment_label)[1]
+
+			word_id_column.append(word_i)
+			onset_column.append(int(line_match.group("onset")))
+			offset_column.append(int(line_match.group("offset")))
+			phone_code_column.append(phone_codes.setdefault(phone, len(phone_codes)))
+			triphone_id_column.append(triphone_ids.setdefault(segment_label, len(triphone_ids)))
+
+	return SegmentationTable(
+		words=word_list,
+		phones=list(phone_codes.keys()),
+		triphones=list(triphone_ids.keys()),
+		word_id=numpy.array(word_id_column, dtype=numpy.int32),
+		onset=numpy.array(onset_column, dtype=numpy.int64),
+		offset=numpy.array(offset_column, dtype=numpy.int64),
+		phone_code=numpy.array(phone_code_column, dtype=numpy.int16),
+		triphone_id=numpy.array(triphone_id_column, dtype=numpy.int32),
+	)
+
+
+def boundaries_from_table(table):
+	"""
+	Converts a SegmentationTable into the word-keyed dictionary of lists of (onset, offset, phone)-tuples which
+	get_segmentation returns, e.g. for saving with save_boundaries.
+
+	:param table:
+	"""
+	boundaries = {word: [] for word in table.words}
+	for word_i, onset, offset, phone_code in zip(table.word_id.tolist(), table.onset.tolist(),
+												  table.offset.tolist(), table.phone_code.tolist()):
+		boundaries[table.words[word_i]].append((onset, offset, table.phones[phone_code]))
+	return boundaries
+
+
+def save_segmentation_table(table, output_dir_path):
+	"""
+	Saves the segmentation table which PhoneSegmentationSet.load reads.
+	:param table:
+	:param output_dir_path:
+	"""
+	table.save(os.path.join(output_dir_path, SEGMENTATION_TABLE_FILE_NAME))
+
+
 def save_boundaries(boundaries, output_dir_path):
 	"""
 	Saves mat files for the activations
@@ -92,12 +175,17 @@ if __name__ == "__main__":
 
 	for s in [0, 3, 4, 5]:
 		system_root_dir = Path(input_root, f"system{s}")
-		rec_dir = Path(system_root_dir, "separated")
 		output_dir_path = Path(system_root_dir, "segmentation")
 
 		if not output_dir_path.is_dir():
 			output_dir_path.mkdir()
 
-		segmentation = get_segmentation(rec_dir, word_list)
+		# Read straight from the MLF rather than from the .rec files split out of it
+		mlf_path = list(system_root_dir.glob("*.mlf"))[0]
+		with build_mlf_index(mlf_path, use_mmap=True) as mlf_index:
+			segmentation_table = compile_segmentation_table(mlf_index, word_list)
+
+		save_segmentation_table(segmentation_table, output_dir_path)
 
-		save_boundaries(segmentation, output_dir_path)
+		# The Matlab scripts still use the .mat version
+		save_boundaries(boundaries_from_table(segmentation_table), output_dir_path)
@@ -0,0 +1,112 @@
+"""
+A shared vocabulary of triphones.
+
+Each triphone gets a dense integer id, with the ids grouped by centre phone, so that everything which used to be done
+by splitting and comparing triphone strings can be done with integer arrays.
+"""
+
+from typing import Dict, Iterable, List, Tuple
+
+import numpy
+
+
+# Entries in HTK's output which aren't triphones, and which we always skip
+NON_TRIPHONES = {'', 'sil', 'sp'}
+
+
+def split_triphone(triphone: str) -> Tuple[str, str, str]:
+	"""
+	Splits a triphone like x1-x2+x3 into its (left, centre, right) phones.
+	Biphones like x1-x2 or x2+x3 get an empty left or right context.
+	"""
+	left, _, rest = triphone.rpartition('-')
+	centre, _, right = rest.partition('+')
+	return left, centre, right
+
+
+class TriphoneVocabulary:
+	"""
+	Dense ids for a set of triphones.
+
+	Triphones are sorted by centre phone and then by name, so the ids for each centre phone form a contiguous range.
+	Phones are coded by their position in self.phones, and the left, centre and right phone of each triphone are
+	precomputed as arrays of those codes (-1 for a missing context).
+	"""
+
+	def __init__(self, triphones: Iterable[str]):
+		split = {
+			triphone: split_triphone(triphone)
+			for triphone in set(triphones) - NON_TRIPHONES
+		}
+
+		# id -> triphone
+		self.triphones: List[str] = sorted(split.keys(), key=lambda t: (split[t][1], t))
+		# triphone -> id
+		self._ids: Dict[str, int] = {triphone: i for i, triphone in enumerate(self.triphones)}
+
+		# code -> phone
+		self.phones: List[str] = sorted({phone for triplet in split.values() for phone in triplet} - {''})
+		phone_codes = {phone: code for code, phone in enumerate(self.phones)}
+		phone_codes[''] = -1
+
+		self.left = numpy.array([phone_codes[split[t][0]] for t in self.triphones], dtype=numpy.int16)
+		self.centre = numpy.array([phone_codes[split[t][1]] for t in self.triphones], dtype=numpy.int16)
+		self.right = numpy.array([phone_codes[split[t][2]] for t in self.triphones], dtype=numpy.int16)
+
+		# centre phone -> (first id, last id + 1)
+		self.centre_ranges: Dict[str, Tuple[int, int]] = dict()
+		codes_present = numpy.unique(self.centre)
+		starts = numpy.searchsorted(self.centre, codes_present, side="left")
+		stops = numpy.searchsorted(self.centre, codes_present, side="right")
+		for code, start, stop in zip(codes_present, starts, stops):
+			if code == -1:
+				# Entries with no centre phone aren't filed under any phone
+				continue
+			self.centre_ranges[self.phones[code]] = (int(start), int(stop))
+
+	def __len__(self):
+		return len(self.triphones)
+
+	def __contains__(self, triphone: str):
+		return triphone in self._ids
+
+	@property
+	def centre_phones(self) -> List[str]:
+		"""The phones which are the centre of some triphone, in code order."""
+		return list(self.centre_ranges.keys())
+
+	def id_of(self, triphone: str) -> int:
+		"""The id of a triphone, or -1 if it isn't in the vocabulary."""
+		return self._ids.get(triphone, -1)
+
+	def ids_of(self, triphones: Iterable[str]) -> numpy.ndarray:
+		"""The ids of some triphones, with -1 for any which aren't in the vocabulary."""
+		return numpy.array([self._ids.get(triphone, -1) for triphone in triphones], dtype=numpy.int64)
+
+	def ids_in_table(self, table) -> numpy.ndarray:
+		"""
+		The vocabulary id of the triphone in each row of a hvite_traces.TriphoneLikelihoodTable, with -1 for rows whose
+		triphone isn't in the vocabulary (including sil, sp, etc.).
+		"""
+		return self.ids_of(table.triphones)[table.triphone_id]
+
+	def ids_for_phone(self, phone: str) -> range:
+		"""The ids of the triphones with this centre phone."""
+		start, stop = self.centre_ranges.get(phone, (0, 0))
+		return range(start, stop)
+
+	def triphones_for_phone(self, phone: str) -> List[str]:
+		"""The triphones with this centre phone, in id order."""
+		start, stop = self.centre_ranges.get(phone, (0, 0))
+		return self.triphones[start:stop]
+
+	def save(self, path):
+		"""Saves the vocabulary as a text file with one triphone per line, in id order."""
+		with open(path, mode="w", encoding="utf-8") as vocabulary_file:
+			for triphone in self.triphones:
+				vocabulary_file.write("{0}\n".format(triphone))
+
+	@classmethod
+	def load(cls, path) -> "TriphoneVocabulary":
+		with open(path, encoding="utf-8") as vocabulary_file:
+			return cls(line.strip() for line in vocabulary_file)
@@ -17,8 +17,10 @@ caiwingfield.net
 from collections import namedtuple
 from dataclasses import dataclass
 from enum import Enum, auto
+from functools import lru_cache
+from hashlib import sha1
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Callable, List, Optional, Tuple
 from logging import getLogger, basicConfig, INFO, FileHandler
 
 from numpy import array, nan, full, where
@@ -28,14 +30,20 @@ from sklearn.metrics import davies_bouldin_score, silhouette_score
 
 from jqm_cvi.jqmcvi.base import dunn_fast
 
-from common.layers import load_and_stack_data_for_layer, DNNLayer
+from common.caching import ByteBoundedLRUCache
+from common.layers import load_and_stack_data_for_layer, DNNLayer, GatherPlan
 from common.logging import print_progress
 from common.maths import quantile_of_score, shuffle
+from common.segment_reduction import Summary
 from common.segmentation import PhoneSegmentationSet, Phone
 from fisher.fisher import GetFisher
 
 logger = getLogger(__name__)
 
+# Memory budgets for data reused across labellings
+LAYER_DATA_CACHE_BYTES = 4 * 1024 ** 3
+PCA_CACHE_BYTES = 1024 ** 3
+
 
 class Measure(Enum):
     Fisher        = auto()
@@ -56,36 +64,73 @@ class ClusteringResult:
     cluster_statistic_p_default: Optional[bool]
 
 
+# Word-phone activations (and labels), keyed by (segmentation path, activations path, file pattern, layer, summary)
+_layer_data_cache: ByteBoundedLRUCache[Tuple[List[Phone], array]] = ByteBoundedLRUCache(LAYER_DATA_CACHE_BYTES)
+# PCA projections (and explained variance ratios), keyed by (layer data key, dims, rows kept)
+_pca_cache: ByteBoundedLRUCache[Tuple[array, array]] = ByteBoundedLRUCache(PCA_CACHE_BYTES)
+
+
+@lru_cache(maxsize=8)
+def _gather_plan(segmentation_path: Path) -> GatherPlan:
+    """The segments of a segmentation, shared by every layer of the system."""
+    return GatherPlan.from_segmentation(PhoneSegmentationSet.load(from_dir=segmentation_path))
+
+
+def _load_word_phone_activations(segmentation_path: Path, activations_path: Path, file_pattern: str,
+                                 layer: DNNLayer, summary: Summary) -> Tuple[List[Phone], array]:
+    # Only the word-phone view is computed
+    layer_data = load_and_stack_data_for_layer(layer, _gather_plan(segmentation_path),
+                                               from_dir=activations_path, file_pattern=file_pattern)
+    return layer_data.labels_per_word_phone, layer_data.summarise_segments([summary])[summary]
+
+
+def _fit_pca(activations_per_word_phone: array, pca_dims: int) -> Tuple[array, array]:
+    """The PCA projection of the activations, and the ratio of variance explained by each component."""
+    pca = PCA(n_components=pca_dims)
+    return pca.fit_transform(activations_per_word_phone), pca.explained_variance_ratio_
+
+
 def statistics_for_class(segmentation_path: Path, activations_path: Path, file_pattern: str,
                          layer: DNNLayer, class_labelling: Callable[[Phone], Optional[int]], measure: Measure,
-                         pca_dims: Optional[int], p_value_perms: Optional[int]) -> ClusteringResult:
+                         pca_dims: Optional[int], p_value_perms: Optional[int],
+                         summary: Summary = Summary.mean) -> ClusteringResult:
+    """
+    summary: how each word-phone's frames are summarised into a single point to cluster
+    """
 
+    if summary == Summary.count:
+        raise ValueError("Summary.count gives one value per segment, not a point to cluster")
 
     with_pca = pca_dims is not None
     compute_p_value = p_value_perms is not None
 
-    phone_segmentations = PhoneSegmentationSet.load(from_dir=segmentation_path)
-
-    # Load data in a very redundant way (but we already have code for it)
-    _, _, activations_per_word_phone, labels_per_word_phone, _ = load_and_stack_data_for_layer(layer, phone_segmentations,
-                                                                                               from_dir=activations_path,
-                                                                                               file_pattern=file_pattern)
+    # Cached across labellings, which all use the same data
+    layer_data_key = (str(segmentation_path), str(activations_path), file_pattern, layer, summary)
+    labels_per_word_phone, activations_per_word_phone = _layer_data_cache.get_or_compute(
+        layer_data_key,
+        lambda: _load_word_phone_activations(segmentation_path, activations_path, file_pattern, layer, summary),
+        size_of=lambda labels_and_activations: labels_and_activations[1].nbytes + 8 * len(labels_and_activations[0]))
 
     # using numpy for fast shuffling, so labels must be in array of ints (underlying value of Phone)
     label_array: array = array([class_labelling(l) for l in labels_per_word_phone])
 
     # Filter out rows where labels are None
-    activations_per_word_phone = activations_per_word_phone[where(label_array != None)[0], :]
-    label_array = label_array[where(label_array != None)[0]]
+    kept_rows = where(label_array != None)[0]
+    activations_per_word_phone = activations_per_word_phone[kept_rows, :]
+    label_array = label_array[kept_rows]
 
     activations: array
     if with_pca:
         logger.info(f"\tApplying PCA ({activations_per_word_phone.shape[1]} -> {pca_dims} dims)")
-        pca = PCA(n_components=pca_dims)
-        activations = pca.fit_transform(activations_per_word_phone)
-        logger.info(f"\t\tExplained variance: {sum(pca.explained_variance_ratio_)} ({', '.join(list(f'{v:0.2}' for v in pca.explained_variance_ratio_))})")
+        # Labellings which keep the same rows share a projection
+        pca_key = (layer_data_key, pca_dims, sha1(kept_rows.tobytes()).hexdigest())
+        activations, explained_variance_ratio = _pca_cache.get_or_compute(
+            pca_key,
+            lambda: _fit_pca(activations_per_word_phone, pca_dims),
+            size_of=lambda projection: projection[0].nbytes + projection[1].nbytes)
+        logger.info(f"\t\tExplained variance: {sum(explained_variance_ratio)} ({', '.join(list(f'{v:0.2}' for v in explained_variance_ratio))})")
     else:
-        pca = None
+        explained_variance_ratio = None
         activations = activations_per_word_phone
 
     observed_value = statistic_for_labelling(activations, label_array, measure)
@@ -136,7 +181,7 @@ def statistics_for_class(segmentation_path: Path, activations_path: Path, file_p
     return ClusteringResult(
         pca=with_pca,
         pca_dims=pca_dims,
-        pca_explained_variance_total=sum(pca.explained_variance_ratio_) if pca is not None else None,
+        pca_explained_variance_total=sum(explained_variance_ratio) if explained_variance_ratio is not None else None,
         cluster_statistic_type=measure,
         cluster_statistic_value=observed_value,
         cluster_statistic_p_perms=p_value_perms if compute_p_value else None,
@@ -25,7 +25,7 @@ from numpy import array, load as np_load, save as np_save
 from sklearn.manifold import TSNE
 from matplotlib import pyplot
 
-from common.layers import DNNLayer, load_and_stack_data_for_layer
+from common.layers import DNNLayer, GatherPlan, load_and_stack_data_for_layer
 from common.paths import TSNE_SAVE_DIR
 from common.segmentation import PhoneSegmentationSet, Feature
 
@@ -37,6 +37,9 @@ def run_tsne_script():
 
     phone_segmentations = PhoneSegmentationSet.load(from_dir=Path("/Users/cai/Dox/Academic/Analyses/Lexpro/DNN mapping/phonetic alignments/system0/segmentation"))
 
+    # The segments' frames are worked out once for all the layers
+    gather_plan = GatherPlan.from_segmentation(phone_segmentations)
+
     for layer in reversed(DNNLayer):  # run top-to-bottom
 
         logger.info(f"DNN layer {layer.name}")
@@ -45,7 +48,7 @@ def run_tsne_script():
             activations_per_frame, labels_per_frame,
             activations_per_word_phone, labels_per_word_phone,
             activations_per_phone
-        ) = load_and_stack_data_for_layer(layer, phone_segmentations,
+        ) = load_and_stack_data_for_layer(layer, gather_plan,
                                           from_dir=Path("/Users/cai/Dox/Academic/Analyses/Lexpro/DNN mapping/extracted activations mat files/system0"),
                                           file_pattern="hidden_layer_{0}_activations.mat")
 
@@ -1,6 +1,10 @@
 #!/bin/bash
 #
 # Runs HList on each word file, logging the results.
+#
+# The .mlp files can instead be read directly with
+# old_python/htk_parameter_files.load_htk_parameter_directory, which skips the
+# text logs entirely.
 
 ROOT_DIR=/imaging/cw04/Neurolex/Lexpro/Analysis_DNN/Building_models/HTK_versions/HTK-Neurolex-2015-07-23
 LOG_DIR=/imaging/cw04/Neurolex/Lexpro/Analysis_DNN/Building_models/scratch_htk/bottleneck_log